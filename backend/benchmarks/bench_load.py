@@ -0,0 +1,280 @@
+"""Load test of the backend against a simulated Gemini backend.
+
+For every scenario and concurrency level a fresh server process is started
+with ``fake_gemini`` installed, then driven over HTTP by a closed loop of
+``concurrency`` clients. Throughput, latency percentiles, errors and the
+server's peak RSS are printed and written as JSON, so runs can be compared
+offline with ``--compare``. No API key or network access is needed.
+
+Result caching is disabled and every request uses a distinct prompt, so
+each request reaches the (fake) upstream.
+
+Usage (from the backend directory):
+    python benchmarks/bench_load.py --scenarios chat,process_file,batch --concurrency 1,8,32 \\
+        --requests 200 --latency lognormal:0.8:0.5 --output load.json
+    python benchmarks/bench_load.py ... --output new.json --compare load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+SCENARIOS = ('chat', 'chat_stream', 'process_file', 'batch')
+
+
+def serve(port: int, config: Dict) -> None:
+    """Child process: run the app with the fake backend installed"""
+    sys.path.insert(0, str(BACKEND_DIR))
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import uvicorn
+
+    import services.app as app_module
+    from fake_gemini import FakeConfig, install
+
+    install(app_module, FakeConfig(**config))
+    uvicorn.run(app_module.app, host='127.0.0.1', port=port, log_level='warning')
+
+
+def make_pdf(pages: int) -> bytes:
+    import fitz
+
+    document = fitz.open()
+    for number in range(pages):
+        page = document.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800),
+                            f"Page {number + 1}. " + "Quarterly revenue grew in every region. " * 40)
+    return document.tobytes()
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_bytes(pid: int) -> Optional[int]:
+    """Peak resident memory of a process (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _request(client, scenario: str, number: int, payloads: Dict, headers: Dict) -> Dict:
+    """Send one request; returns latency, status and (for streams) time to first chunk"""
+    started = time.perf_counter()
+    first_chunk = None
+    if scenario == 'chat':
+        response = await client.post('/api/chat', json={'message': f"Question {number}: what changed?"}, headers=headers)
+        ok = response.status_code == 200 and response.json().get('success')
+    elif scenario == 'chat_stream':
+        async with client.stream('POST', '/api/chat/stream', json={'message': f"Question {number}"},
+                                 headers=headers) as response:
+            ok = response.status_code == 200
+            async for line in response.aiter_lines():
+                if first_chunk is None and line.startswith('data: {"text"'):
+                    first_chunk = time.perf_counter() - started
+                if line.startswith('event: error'):
+                    ok = False
+    elif scenario == 'process_file':
+        response = await client.post('/process_file', files={'file': ('report.pdf', payloads['pdf'], 'application/pdf')},
+                                     data={'prompt': f"Summarise the report ({number})"}, headers=headers)
+        ok = response.status_code == 200
+    else:
+        files = [('files', (f"report{index}.pdf", payloads['pdf'], 'application/pdf'))
+                 for index in range(payloads['batch_files'])]
+        prompts = {f"report{index}.pdf": f"Summarise ({number}/{index})" for index in range(payloads['batch_files'])}
+        response = await client.post('/process-multiple-pdfs', files=files, data={'prompts': json.dumps(prompts)},
+                                     headers=headers)
+        ok = response.status_code == 200 and response.json().get('success')
+    return {'seconds': time.perf_counter() - started, 'ok': bool(ok), 'first_chunk': first_chunk}
+
+
+async def drive(base_url: str, scenario: str, concurrency: int, requests: int, payloads: Dict) -> Dict:
+    import httpx
+
+    samples = []
+    counter = iter(range(requests))
+
+    async def _client_loop(client, index: int):
+        # Each simulated user gets its own admission queue on the server, like extension installs do
+        headers = {'X-Client-ID': f"bench-{index}"}
+        for number in counter:
+            try:
+                samples.append(await _request(client, scenario, number, payloads, headers))
+            except httpx.HTTPError:
+                samples.append({'seconds': None, 'ok': False, 'first_chunk': None})
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=600, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(_client_loop(client, index) for index in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [sample['seconds'] for sample in samples if sample['ok']]
+    first_chunks = [sample['first_chunk'] for sample in samples if sample['first_chunk'] is not None]
+    result = {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if not sample['ok']),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_mean': round(statistics.mean(latencies), 4) if latencies else None,
+    }
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        value = percentile(latencies, fraction)
+        result[f"latency_{name}"] = round(value, 4) if value is not None else None
+    if first_chunks:
+        result['first_chunk_p50'] = round(percentile(first_chunks, 0.5), 4)
+        result['first_chunk_p95'] = round(percentile(first_chunks, 0.95), 4)
+    return result
+
+
+def run_level(args, scenario: str, concurrency: int, payloads: Dict, workdir: str) -> Dict:
+    port = _free_port()
+    config = {
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'error_status': args.error_status,
+        'stream_chunks': args.stream_chunks,
+        'chunk_delay': args.chunk_delay,
+        'seed': args.seed,
+    }
+    env = {
+        **os.environ,
+        'GOOGLE_API_KEY': os.environ.get('GOOGLE_API_KEY', 'benchmark-placeholder-key'),
+        'GEMINI_WARMUP': '0', 'HEALTH_PROBE_INTERVAL': '0', 'LOG_LEVEL': 'ERROR',
+        'RESULT_CACHE_MAX_ENTRIES': '0', 'RESULT_CACHE_PATH': '',
+        'JOBS_PATH': os.path.join(workdir, f"jobs-{port}.sqlite3"),
+        'JOB_DATA_DIR': os.path.join(workdir, f"jobs-{port}"),
+        'GEMINI_RETRY_BASE_DELAY': os.environ.get('GEMINI_RETRY_BASE_DELAY', '0.1'),
+        'GEMINI_HEDGE_ENABLED': '1' if args.hedge else '0',
+    }
+    server = subprocess.Popen(
+        [sys.executable, __file__, '--serve', str(port), '--config', json.dumps(config)],
+        cwd=BACKEND_DIR, env=env,
+    )
+    try:
+        _wait_until_up(port, server)
+        result = asyncio.run(drive(f"http://127.0.0.1:{port}", scenario, concurrency, args.requests, payloads))
+        result['server_peak_rss_bytes'] = peak_rss_bytes(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {'scenario': scenario, 'concurrency': concurrency, **result}
+
+
+def _wait_until_up(port: int, server: subprocess.Popen, timeout: float = 60) -> None:
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with status {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health/live", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("Server did not start")
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline_path: str) -> None:
+    """Print the change of throughput and p95 latency against an earlier run"""
+    with open(baseline_path) as f:
+        baseline = {(row['scenario'], row['concurrency']): row for row in json.load(f)['results']}
+    print(f"\nchange vs {baseline_path}:")
+    for row in results:
+        old = baseline.get((row['scenario'], row['concurrency']))
+        if not old or not old.get('throughput_rps') or not old.get('latency_p95') or not row.get('latency_p95'):
+            continue
+        throughput = 100.0 * (row['throughput_rps'] / old['throughput_rps'] - 1)
+        p95 = 100.0 * (row['latency_p95'] / old['latency_p95'] - 1)
+        print(f"{row['scenario']:<13}{row['concurrency']:>6}  throughput {throughput:+7.1f}%  p95 {p95:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default='chat,process_file,batch',
+                        help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and level')
+    parser.add_argument('--latency', default='lognormal:0.8:0.5', help='fake upstream latency, e.g. constant:0.5')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of failing upstream calls')
+    parser.add_argument('--error-status', type=int, default=429, choices=(429, 500, 503))
+    parser.add_argument('--stream-chunks', type=int, default=8)
+    parser.add_argument('--chunk-delay', type=float, default=0.05)
+    parser.add_argument('--pdf-pages', type=int, default=5, help='pages of the generated PDF upload')
+    parser.add_argument('--batch-files', type=int, default=4, help='PDFs per batch request')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--hedge', action='store_true', help='enable hedged upstream requests in the server')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, json.loads(args.config))
+        return
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+    payloads = {'pdf': make_pdf(args.pdf_pages), 'batch_files': args.batch_files}
+
+    results = []
+    print(f"{'scenario':<13}{'conc':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>8}{'peak MB':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for scenario in scenarios:
+            for concurrency in levels:
+                row = run_level(args, scenario, concurrency, payloads, workdir)
+                results.append(row)
+                peak = row['server_peak_rss_bytes']
+                print(f"{scenario:<13}{concurrency:>6}{row['throughput_rps'] or 0:>9.2f}"
+                      f"{row['latency_p50'] or 0:>9.3f}{row['latency_p95'] or 0:>9.3f}"
+                      f"{row['latency_p99'] or 0:>9.3f}{row['errors']:>8}"
+                      f"{(peak or 0) / 1024 / 1024:>9.1f}")
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key not in ('serve', 'config', 'output', 'compare')}
+        with open(args.output, 'w') as f:
+            json.dump({'revision': _git_revision(), 'settings': settings, 'results': results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Per-request logging cost: the legacy synchronous DEBUG logging vs. structured logging.
+
+Every mode replays the log calls one /process-multiple-pdfs request with a
+single PDF makes and writes to /dev/null. ``caller`` is the time spent on the
+request path; ``total`` also includes draining the queue on the writer thread.
+
+Usage (from the backend directory):
+    python benchmarks/bench_logging.py --requests 2000 --output logging.json
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.structured_logging import configure_logging, log_event, shutdown_logging, start_request
+
+MODES = ('legacy', 'structured', 'structured_unsampled')
+
+HEADERS = {
+    'host': 'localhost:5001', 'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) Chrome/124.0',
+    'accept': '*/*', 'accept-encoding': 'gzip, deflate, br', 'accept-language': 'en-US,en;q=0.9',
+    'content-type': 'multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW',
+    'content-length': '1048921', 'origin': 'chrome-extension://abcdefghijklmnop',
+    'sec-fetch-mode': 'cors', 'sec-fetch-site': 'none', 'connection': 'keep-alive',
+}
+
+
+def _legacy_request(logger, content: bytes, prompt: str, text: str) -> None:
+    """The original log calls, which base64-encoded the whole PDF for the request log"""
+    logger.info(f"=== INCOMING REQUEST ===")
+    logger.info(f"Method: POST")
+    logger.info(f"URL: http://localhost:5001/process-multiple-pdfs")
+    logger.info(f"Headers: {dict(HEADERS)}")
+    logger.info(f"Client Host: 127.0.0.1")
+    logger.info(f"Parsed prompts: {json.dumps({'doc.pdf': prompt}, indent=2)}")
+    logger.info("""
+=== COMPLETE GEMINI API REQUEST ===
+Prompt: {}
+Request Body:
+{}
+""".format(prompt, json.dumps({
+        "contents": [prompt, {"mime_type": "application/pdf",
+                              "data": base64.b64encode(content).decode()[:100] + '...'}]
+    }, indent=2)))
+    logger.info(f"""
+=== FILE PROCESSING RESULT ===
+Response Length: {len(text)}
+First 200 chars: {text[:200]}
+""")
+    response = {"success": True, "results": [{"file_id": "doc.pdf", "success": True,
+                                              "summary": {"text": text, "prompt": prompt}}], "errors": []}
+    logger.info(f"Sending response: {json.dumps(response, indent=2)}")
+    logger.info(f"=== RESPONSE ===")
+    logger.info(f"Status: 200")
+    logger.info(f"Headers: {dict(HEADERS)}")
+
+
+def _structured_request(logger, content: bytes, prompt: str, text: str) -> None:
+    """The log calls the app makes now"""
+    start_request('bench', '/process-multiple-pdfs')
+    log_event(logger, logging.DEBUG, 'request_headers', headers=lambda: dict(HEADERS))
+    log_event(logger, logging.INFO, 'batch_request', files=1, concurrency=4, file_names=lambda: ['doc.pdf'])
+    log_event(logger, logging.INFO, 'pdf_request', file='doc.pdf', size=len(content), prompt=prompt)
+    log_event(logger, logging.INFO, 'pdf_response', file='doc.pdf', seconds=1.2,
+              chars=lambda: len(text), preview=lambda: text[:200])
+    log_event(logger, logging.INFO, 'batch_response', succeeded=1, failed=0)
+    log_event(logger, logging.INFO, 'request', method='POST', path='/process-multiple-pdfs',
+              status=200, duration_ms=1234.5, client='127.0.0.1')
+
+
+def run(mode: str, requests: int, content: bytes, prompt: str, text: str) -> dict:
+    sink = open(os.devnull, 'w')
+    root = logging.getLogger()
+    logger = logging.getLogger('bench')
+    if mode == 'legacy':
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        replay = _legacy_request
+    else:
+        if mode == 'structured_unsampled':
+            from services import structured_logging
+            structured_logging._sample_rates = structured_logging.parse_sample_rates('/process-multiple-pdfs=0')
+        configure_logging(sink, level='INFO', json_output=True)
+        replay = _structured_request
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        replay(logger, content, prompt, text)
+    caller = time.perf_counter() - started
+    if mode == 'legacy':
+        root.removeHandler(handler)
+        handler.flush()
+    else:
+        shutdown_logging()
+    total = time.perf_counter() - started
+    sink.close()
+    return {
+        'mode': mode,
+        'requests': requests,
+        'caller_us_per_request': round(caller / requests * 1e6, 1),
+        'total_us_per_request': round(total / requests * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000, help='simulated requests per mode')
+    parser.add_argument('--pdf-kb', type=int, default=1024, help='size of the simulated PDF')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    content = os.urandom(args.pdf_kb * 1024)
+    prompt = "Summarise the key findings of this document. " * 5
+    text = "The document describes quarterly results. " * 100
+
+    results = [run(mode, args.requests, content, prompt, text) for mode in MODES]
+
+    print(f"{'mode':<24}{'caller us/req':>16}{'total us/req':>16}")
+    for result in results:
+        print(f"{result['mode']:<24}{result['caller_us_per_request']:>16.1f}{result['total_us_per_request']:>16.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Cost of the per-request metrics instrumentation against its 5 µs budget.
+
+Replays what the request middleware and the model client record for one
+request (in-flight gauge, route histogram, request counter, upstream
+histogram) and reports the time per request.
+
+Usage (from the backend directory):
+    python benchmarks/bench_metrics.py --requests 200000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services import metrics
+
+BUDGET_US = 5.0
+ROUTES = ('/process_file', '/process-multiple-pdfs', '/api/chat', '/health')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200000, help='simulated requests')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    for i in range(args.requests):
+        route = ROUTES[i % len(ROUTES)]
+        metrics.http_in_flight.inc()
+        metrics.gemini_request_duration.labels('generate').observe(0.8)
+        metrics.http_in_flight.dec()
+        metrics.http_request_duration.labels(route).observe(0.9)
+        metrics.http_requests.labels(route, 'POST', '200').inc()
+    per_request = (time.perf_counter() - started) / args.requests * 1e6
+
+    render_started = time.perf_counter()
+    size = len(metrics.registry.render())
+    render_ms = (time.perf_counter() - render_started) * 1000
+
+    print(f"instrumentation: {per_request:.2f} us/request (budget {BUDGET_US:.0f} us)")
+    print(f"scrape: {render_ms:.2f} ms for {size} bytes")
+    sys.exit(0 if per_request <= BUDGET_US else 1)
+
+
+if __name__ == '__main__':
+    main()
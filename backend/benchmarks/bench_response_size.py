@@ -0,0 +1,80 @@
+"""Bytes per /process_file response: full vs. compact fields, identity vs. gzip/br.
+
+Runs the app in-process with ``fake_gemini`` installed and analyses the same
+text file once per response mode, so every mode serialises the same
+(cached) analysis. The ``full`` / ``identity`` row is the response as it was
+sent before compact mode and compression. Also reports the time to
+serialise the full body with the standard json encoder and with orjson.
+
+Usage (from the backend directory):
+    python benchmarks/bench_response_size.py --output-tokens 300,2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+MODES = (('full', 'identity'), ('full', 'gzip'), ('compact', 'identity'), ('compact', 'gzip'), ('compact', 'br'))
+
+
+def _encode_time(data, dumps, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        dumps(data)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output-tokens', default='300,2000', help='comma-separated answer lengths, in words')
+    parser.add_argument('--rounds', type=int, default=2000, help='serialisations timed per encoder')
+    args = parser.parse_args()
+
+    os.environ.setdefault('GOOGLE_API_KEY', 'benchmark-placeholder-key')
+    os.environ.update(GEMINI_WARMUP='0', HEALTH_PROBE_INTERVAL='0', LOG_LEVEL='WARNING')
+    from fastapi.testclient import TestClient
+
+    import services.app as app_module
+    from fake_gemini import FakeConfig, install
+    from services import responses
+
+    # One client for every run: leaving it shuts down the app's thread pools
+    with TestClient(app_module.app) as client:
+        for output_tokens in (int(value) for value in args.output_tokens.split(',')):
+            install(app_module, FakeConfig(latency='constant:0', output_tokens=output_tokens, seed=1))
+            # A distinct file per answer length, so the cached analysis matches it
+            upload = f"Answer length {output_tokens}\n".encode() + b'Quarterly figures follow.\n' * 40
+            print(f"answer of {output_tokens} words")
+            for fields, encoding in MODES:
+                if encoding == 'br' and responses.brotli is None:
+                    print(f"  {fields:8} {encoding:8} skipped (brotli not installed)")
+                    continue
+                response = client.post(
+                    '/process_file',
+                    files={'file': ('report.txt', upload, 'text/plain')},
+                    data={'fields': fields},
+                    headers={'Accept-Encoding': encoding},
+                )
+                response.raise_for_status()
+                wire = int(response.headers['content-length'])
+                print(f"  {fields:8} {encoding:8} {wire:8} bytes on the wire ({len(response.content)} decoded)")
+                if (fields, encoding) == ('full', 'identity'):
+                    body = response.json()
+
+            json_us = _encode_time(body, json.dumps, args.rounds)
+            print(f"  serialise full body: json {json_us:.1f} us", end='')
+            if responses.orjson is not None:
+                orjson_us = _encode_time(body, responses.orjson.dumps, args.rounds)
+                print(f", orjson {orjson_us:.1f} us ({json_us / orjson_us:.1f}x)")
+            else:
+                print(" (orjson not installed)")
+
+
+if __name__ == '__main__':
+    main()
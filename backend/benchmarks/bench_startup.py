@@ -0,0 +1,80 @@
+"""Cold start of the backend: import time and time to the first served request.
+
+Every run starts a fresh interpreter, imports ``services.app`` and serves
+``/test-connection`` through the ASGI app (startup events included). No
+network calls are made: a placeholder API key is used and the background
+warm-up is disabled.
+
+Usage (from the backend directory):
+    python benchmarks/bench_startup.py --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Modules that are deliberately not imported at startup
+HEAVY_MODULES = ('google.generativeai', 'pandas', 'numpy', 'pyarrow')
+
+
+def run_child() -> dict:
+    started = time.perf_counter()
+    sys.path.insert(0, str(BACKEND_DIR))
+    import services.app as app_module
+    imported = time.perf_counter()
+
+    from fastapi.testclient import TestClient
+    with TestClient(app_module.app) as client:
+        client.get('/test-connection').raise_for_status()
+        served = time.perf_counter()
+
+    return {
+        'import_seconds': round(imported - started, 3),
+        'first_request_seconds': round(served - started, 3),
+        'heavy_modules_loaded': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child()))
+        return
+
+    env = {**os.environ, 'GOOGLE_API_KEY': os.environ.get('GOOGLE_API_KEY', 'benchmark-placeholder-key'),
+           'GEMINI_WARMUP': '0', 'HEALTH_PROBE_INTERVAL': '0', 'RESULT_CACHE_PATH': '',
+           'LOG_LEVEL': 'WARNING'}
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, __file__, '--child'], check=True,
+                                capture_output=True, text=True, env=env, cwd=BACKEND_DIR).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    result = {
+        'runs': args.runs,
+        'import_seconds_median': statistics.median(run['import_seconds'] for run in runs),
+        'first_request_seconds_median': statistics.median(run['first_request_seconds'] for run in runs),
+        'heavy_modules_loaded': runs[-1]['heavy_modules_loaded'],
+    }
+    print(f"import:        {result['import_seconds_median']:.3f}s (median of {args.runs})")
+    print(f"first request: {result['first_request_seconds_median']:.3f}s")
+    print(f"heavy modules loaded at startup: {', '.join(result['heavy_modules_loaded']) or 'none'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({**result, 'samples': runs}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Peak memory per /process_file upload: legacy temp-file pipeline vs. the current one.
+
+Each pipeline runs in a fresh subprocess so peak RSS (``ru_maxrss``) is not
+polluted by the other run. Both pipelines start from an upload spooled by
+Starlette and stop once the SDK has built and serialised the request, so the
+only difference measured is how the upload is turned into a request part.
+
+Usage (from the backend directory):
+    python benchmarks/bench_upload_memory.py --size-mb 10 --output upload_memory.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+MODES = ('legacy', 'current')
+
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _make_upload(size: int):
+    from fastapi import UploadFile
+    from starlette.datastructures import Headers
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    spooled.write(os.urandom(size))
+    spooled.seek(0)
+    return UploadFile(spooled, size=size, filename='bench.pdf',
+                      headers=Headers({'content-type': 'application/pdf'}))
+
+
+def _serialise(part) -> bytes:
+    """Build and serialise the request the way the SDK does before sending it"""
+    from google.generativeai import protos
+    from google.generativeai.types import content_types
+
+    contents = content_types.to_contents(["Summarise this document.", part])
+    request = protos.GenerateContentRequest(model='models/gemini-2.0-flash', contents=contents)
+    return protos.GenerateContentRequest.serialize(request)
+
+
+async def _legacy(upload) -> int:
+    """The pre-change pipeline: read, temp file write/read, base64 str"""
+    file_content = await upload.read()
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
+        temp_file.write(file_content)
+        temp_file_path = temp_file.name
+    try:
+        with open(temp_file_path, 'rb') as f:
+            file_data = f.read()
+        part = {"mime_type": "application/pdf", "data": base64.b64encode(file_data).decode()}
+        return len(_serialise(part))
+    finally:
+        os.unlink(temp_file_path)
+
+
+async def _current(upload) -> int:
+    from services.uploads import inline_part, read_upload
+
+    file_content = await read_upload(upload)
+    return len(_serialise(inline_part(file_content, "application/pdf")))
+
+
+def run_child(mode: str, size: int) -> dict:
+    upload = _make_upload(size)
+    # Warm up imports so they are not attributed to the pipeline
+    _serialise({"mime_type": "application/pdf", "data": b"warmup"})
+    import services.uploads  # noqa: F401
+
+    rss_before = _peak_rss_bytes()
+    tracemalloc.start()
+    request_size = asyncio.run((_legacy if mode == 'legacy' else _current)(upload))
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'mode': mode,
+        'upload_bytes': size,
+        'request_bytes': request_size,
+        'traced_peak_bytes': traced_peak,
+        'peak_rss_increase_bytes': max(0, _peak_rss_bytes() - rss_before),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=10.0, help='upload size in MB')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+
+    if args.child:
+        print(json.dumps(run_child(args.child, size)))
+        return
+
+    results = []
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', mode, '--size-mb', str(args.size_mb)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'mode':<10}{'upload MB':>12}{'traced peak MB':>16}{'peak RSS +MB':>14}{'x upload':>10}")
+    for result in results:
+        mb = 1024 * 1024
+        print(f"{result['mode']:<10}{result['upload_bytes'] / mb:>12.1f}"
+              f"{result['traced_peak_bytes'] / mb:>16.1f}"
+              f"{result['peak_rss_increase_bytes'] / mb:>14.1f}"
+              f"{result['traced_peak_bytes'] / result['upload_bytes']:>10.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Simulated Gemini backend for load tests.
+
+``install`` swaps the app's model and File API uploader for local fakes, so
+the whole request path (scheduler, caches, PDF/CSV/image stages, streaming)
+runs for real while upstream calls only sleep. Latency follows a
+configurable distribution, a fraction of calls fails with 429/503/500 like
+the real API does, and streamed answers arrive in chunks.
+
+Latency specs look like ``lognormal:0.8:0.5`` (distribution, mean seconds,
+spread); supported distributions are ``constant``, ``uniform`` (mean ±
+spread), ``exponential`` and ``lognormal`` (spread is sigma).
+"""
+import asyncio
+import math
+import random
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+
+@dataclass
+class FakeConfig:
+    latency: str = 'lognormal:0.8:0.5'
+    # Fraction of calls that fail
+    error_rate: float = 0.0
+    # HTTP status of the simulated failures (429 and 503 are retried by the client)
+    error_status: int = 429
+    # Retry delay suggested in throttling errors, in seconds
+    retry_delay: float = 0.5
+    # Chunks per streamed answer and the delay between them
+    stream_chunks: int = 8
+    chunk_delay: float = 0.05
+    output_tokens: int = 300
+    seed: Optional[int] = None
+
+
+def parse_latency(spec: str):
+    """Sampler for a ``distribution:mean[:spread]`` spec"""
+    name, _, rest = spec.partition(':')
+    values = [float(value) for value in rest.split(':') if value] or [0.0]
+    mean = values[0]
+    spread = values[1] if len(values) > 1 else 0.0
+    if name == 'constant':
+        return lambda rng: mean
+    if name == 'uniform':
+        return lambda rng: max(0.0, rng.uniform(mean - spread, mean + spread))
+    if name == 'exponential':
+        return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+    if name == 'lognormal':
+        # Parameterised so the distribution's mean is ``mean``
+        mu = math.log(mean) - spread ** 2 / 2 if mean > 0 else 0.0
+        return lambda rng: rng.lognormvariate(mu, spread) if mean > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution '{name}'")
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+class ServiceUnavailable(Exception):
+    code = 503
+
+
+class InternalServerError(Exception):
+    code = 500
+
+
+ERRORS = {429: ResourceExhausted, 503: ServiceUnavailable, 500: InternalServerError}
+
+
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeCandidate:
+    """Renders like the SDK's candidate proto, which repeats the answer text"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __str__(self) -> str:
+        return (f'content {{\n  parts {{\n    text: {self.text!r}\n  }}\n  role: "model"\n}}\n'
+                'finish_reason: STOP\navg_logprobs: -0.21\n')
+
+
+class FakeResponse:
+    def __init__(self, text: str, usage: Optional[_Usage] = None):
+        self.text = text
+        self.candidates = [FakeCandidate(text)]
+        self.prompt_feedback = None
+        self.usage_metadata = usage
+
+
+# Words of the simulated answers, so their size and compressibility resemble prose
+WORDS = (
+    'the document describes a detailed analysis of results for each section with key findings '
+    'including revenue growth customer retention risks and recommendations data shows that '
+    'quarterly performance improved while costs remained stable across regions teams products '
+    'overall summary notes further review is suggested for several items in the appendix'
+).split()
+
+
+def _prompt_tokens(contents: Any) -> int:
+    if isinstance(contents, str):
+        return len(contents) // 4 + 1
+    if isinstance(contents, (list, tuple)):
+        return sum(_prompt_tokens(part) for part in contents)
+    if isinstance(contents, dict):
+        return _prompt_tokens(contents['parts']) if 'parts' in contents else 258
+    return 258
+
+
+class FakeBackend:
+    """Shared state of the simulated API: RNG, latency sampler and call counts"""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.sample_latency = parse_latency(config.latency)
+        self.calls = 0
+        self.errors = 0
+
+    async def respond(self, contents: Any, stream: bool):
+        self.calls += 1
+        await asyncio.sleep(self.sample_latency(self.rng))
+        if self.rng.random() < self.config.error_rate:
+            self.errors += 1
+            error = ERRORS.get(self.config.error_status, InternalServerError)
+            raise error(f"Simulated {self.config.error_status}. Please retry in {self.config.retry_delay}s.")
+
+        usage = _Usage(_prompt_tokens(contents), self.config.output_tokens)
+        words = [self.rng.choice(WORDS) for _ in range(max(1, self.config.output_tokens))]
+        if not stream:
+            return FakeResponse(' '.join(words), usage)
+        return self._stream(words, usage)
+
+    async def _stream(self, words: List[str], usage: _Usage):
+        chunks = max(1, self.config.stream_chunks)
+        size = -(-len(words) // chunks)
+        for index in range(0, len(words), size):
+            last = index + size >= len(words)
+            yield FakeResponse(' '.join(words[index:index + size]) + ' ', usage if last else None)
+            if not last:
+                await asyncio.sleep(self.config.chunk_delay)
+
+
+class FakeChat:
+    def __init__(self, backend: FakeBackend, history: List):
+        self.backend = backend
+        self.history = history
+
+    async def send_message_async(self, message: Any, stream: bool = False, **kwargs):
+        return await self.backend.respond([*self.history, message], stream)
+
+
+class FakeModel:
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    async def generate_content_async(self, contents: Any, stream: bool = False, **kwargs):
+        return await self.backend.respond(contents, stream)
+
+    def start_chat(self, history: Optional[List] = None):
+        return FakeChat(self.backend, history or [])
+
+
+class FakeFile:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = 'ACTIVE'
+        self.expiration_time = None
+
+
+class FakeUploader:
+    """File API stand-in: reads the file and hands out a handle"""
+
+    def __init__(self):
+        self.uploads = 0
+
+    def upload(self, fileobj, mime_type: str, display_name: str):
+        while fileobj.read(1024 * 1024):
+            pass
+        self.uploads += 1
+        return FakeFile(f"files/fake-{self.uploads}")
+
+    def get(self, name: str):
+        return FakeFile(name)
+
+
+def install(app_module, config: FakeConfig) -> FakeBackend:
+    """Point the app's model client and File API uploads at the simulated backend"""
+    backend = FakeBackend(config)
+    client = app_module.model_client
+    client._model_factory = lambda system_instruction: FakeModel(backend)
+    client._model = None
+    client._instruction_models.clear()
+
+    async def ping():
+        return None
+
+    client.ping = ping
+    app_module.file_store.uploader = FakeUploader()
+    return backend
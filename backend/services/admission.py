@@ -0,0 +1,258 @@
+"""Admission control and backpressure for the expensive endpoints.
+
+Without a bound, a burst of analyses queues up inside ``run_in_executor``
+and the upstream scheduler: latency grows without limit and clients time out
+after the server has already paid for the work. Instead, each admitted route
+has its own queue: up to ``concurrency`` requests run at once and up to
+``ADMISSION_QUEUE_SIZE`` wait, each for at most ``ADMISSION_MAX_WAIT``
+seconds. A request that finds the queue full, whose client already has
+``ADMISSION_CLIENT_QUEUE`` requests waiting, or that waits too long is
+answered ``503`` right away with a ``Retry-After`` estimated from recent
+service times.
+
+Waiting requests are served round-robin across clients (the ``X-Client-ID``
+header sent by the extension, or the peer address), so one client's large
+batch can't starve everybody else.
+
+Admission runs as ASGI middleware before the request body is read, so a
+rejected upload costs almost nothing, and the slot is held until the
+response (streamed or not) is complete. Queues are per worker process.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from starlette.routing import Match
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Requests per route handled at the same time; batch routes use ADMISSION_BATCH_CONCURRENCY
+ADMISSION_CONCURRENCY = max(1, int(os.getenv('ADMISSION_CONCURRENCY', '32')))
+# Batch requests (several files each) handled at the same time per route
+ADMISSION_BATCH_CONCURRENCY = max(1, int(os.getenv('ADMISSION_BATCH_CONCURRENCY', '8')))
+# Requests waiting per route before new ones are rejected with 503
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+# Requests one client may have waiting per route
+ADMISSION_CLIENT_QUEUE = max(1, int(os.getenv('ADMISSION_CLIENT_QUEUE', '8')))
+# Seconds a request may wait for a slot before it is rejected with 503
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '10'))
+
+# Bounds of the Retry-After hint, in seconds
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 120
+# Weight of the latest request in the moving average of service times
+SERVICE_TIME_SMOOTHING = 0.2
+
+# Routes (and their concurrency) that go through admission; everything else is let straight through
+ADMITTED_ROUTES = {
+    '/process_file': ADMISSION_CONCURRENCY,
+    '/api/chat': ADMISSION_CONCURRENCY,
+    '/api/chat/stream': ADMISSION_CONCURRENCY,
+    '/documents': ADMISSION_CONCURRENCY,
+    '/documents/{document_id}/ask': ADMISSION_CONCURRENCY,
+    '/process-files': ADMISSION_BATCH_CONCURRENCY,
+    '/process-multiple-pdfs': ADMISSION_BATCH_CONCURRENCY,
+    '/jobs': ADMISSION_BATCH_CONCURRENCY,
+}
+
+# Rejection reasons
+REJECT_QUEUE_FULL = 'queue_full'
+REJECT_CLIENT_QUEUE_FULL = 'client_queue_full'
+REJECT_TIMEOUT = 'timeout'
+
+admission_active = registry.gauge(
+    'admission_active_requests', 'Admitted requests being handled, by route', ('route',))
+admission_queue_depth = registry.gauge(
+    'admission_queue_depth', 'Requests waiting for admission, by route', ('route',))
+admission_wait = registry.histogram(
+    'admission_wait_seconds', 'Time requests waited for admission, by route', ('route',))
+admission_rejected = registry.counter(
+    'admission_rejected_total', 'Requests rejected with 503, by route and reason', ('route', 'reason'))
+
+
+class AdmissionRejected(Exception):
+    """The request can't be admitted in time; retry after ``retry_after`` seconds"""
+
+    def __init__(self, route: str, reason: str, retry_after: int):
+        self.route = route
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Server busy ({reason.replace('_', ' ')} for {route}), retry in {retry_after}s")
+
+
+class RouteQueue:
+    """Bounded, per-client fair queue in front of one route"""
+
+    def __init__(self, route: str, concurrency: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 client_queue: int = ADMISSION_CLIENT_QUEUE, max_wait: float = ADMISSION_MAX_WAIT):
+        self.route = route
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.client_queue = client_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        # Waiting requests per client, clients in round-robin order
+        self._clients: 'OrderedDict[str, Deque[asyncio.Future]]' = OrderedDict()
+        self.service_time = 1.0
+
+    def retry_after(self) -> int:
+        """Seconds until the requests ahead have likely drained"""
+        estimate = self.service_time * (self.waiting + 1) / self.concurrency
+        return max(RETRY_AFTER_MIN, min(RETRY_AFTER_MAX, math.ceil(estimate)))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        admission_rejected.labels(self.route, reason).inc()
+        return AdmissionRejected(self.route, reason, self.retry_after())
+
+    def _dispatch(self) -> None:
+        while self._clients and self.active < self.concurrency:
+            client, waiters = next(iter(self._clients.items()))
+            future = waiters.popleft()
+            # The client goes to the back of the line, whether or not it has more waiting
+            if waiters:
+                self._clients.move_to_end(client)
+            else:
+                del self._clients[client]
+            if future.done():
+                continue
+            self.active += 1
+            admission_active.labels(self.route).inc()
+            future.set_result(None)
+
+    def _forget(self, client: str, future: asyncio.Future) -> None:
+        waiters = self._clients.get(client)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._clients[client]
+
+    async def acquire(self, client: str) -> None:
+        """Wait for a slot or raise ``AdmissionRejected``; pair every admission with ``release``"""
+        if self.active < self.concurrency and not self._clients:
+            self.active += 1
+            admission_active.labels(self.route).inc()
+            return
+        if self.waiting >= self.queue_size:
+            raise self._reject(REJECT_QUEUE_FULL)
+        if len(self._clients.get(client, ())) >= self.client_queue:
+            raise self._reject(REJECT_CLIENT_QUEUE_FULL)
+
+        future = asyncio.get_event_loop().create_future()
+        self._clients.setdefault(client, deque()).append(future)
+        self.waiting += 1
+        admission_queue_depth.labels(self.route).inc()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self._forget(client, future)
+            raise self._reject(REJECT_TIMEOUT)
+        except asyncio.CancelledError:
+            self._forget(client, future)
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the client went away
+                self.release(0.0)
+            raise
+        finally:
+            self.waiting -= 1
+            admission_queue_depth.labels(self.route).dec()
+            admission_wait.labels(self.route).observe(time.perf_counter() - started)
+
+    def release(self, elapsed: float) -> None:
+        self.active -= 1
+        admission_active.labels(self.route).dec()
+        if elapsed > 0:
+            self.service_time += SERVICE_TIME_SMOOTHING * (elapsed - self.service_time)
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'concurrency': self.concurrency,
+            'waiting': self.waiting,
+            'queue_size': self.queue_size,
+            'waiting_clients': len(self._clients),
+            'rejected': self.rejected,
+            'service_seconds': round(self.service_time, 3),
+        }
+
+
+class AdmissionController:
+    """One ``RouteQueue`` per admitted route template"""
+
+    def __init__(self, routes: Optional[Dict[str, int]] = None, **queue_options):
+        self.queues = {route: RouteQueue(route, concurrency, **queue_options)
+                       for route, concurrency in (routes if routes is not None else ADMITTED_ROUTES).items()}
+
+    def queue_for(self, route: Optional[str]) -> Optional[RouteQueue]:
+        return self.queues.get(route) if route is not None else None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.waiting for queue in self.queues.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {route: queue.stats() for route, queue in self.queues.items()
+                if queue.active or queue.waiting or queue.rejected}
+
+
+def match_route(scope: Dict) -> Optional[str]:
+    """Template of the route that will handle the request, matched before the router runs"""
+    for route in scope['app'].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, 'path', None)
+    return None
+
+
+def client_key(scope: Dict) -> str:
+    """Client a request is queued under: the extension's id, else the peer address"""
+    client_id = Headers(scope=scope).get('x-client-id')
+    if client_id:
+        return client_id[:64]
+    return scope['client'][0] if scope.get('client') else 'unknown'
+
+
+class AdmissionMiddleware:
+    """Admit requests to the expensive routes through the controller, or answer 503"""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        # CORS preflights are answered by the outer middleware and never queued
+        admitted = scope['type'] == 'http' and scope['method'] != 'OPTIONS'
+        queue = self.controller.queue_for(match_route(scope)) if admitted else None
+        if queue is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await queue.acquire(client_key(scope))
+        except AdmissionRejected as e:
+            logger.info(str(e))
+            response = JSONResponse(
+                {'detail': str(e), 'retry_after': e.retry_after},
+                status_code=503,
+                headers={'Retry-After': str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            queue.release(time.perf_counter() - started)
@@ -1,127 +1,210 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import google.generativeai as genai
 import os
 from dotenv import load_dotenv
-import pandas as pd
 import io
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from typing import Optional, Dict, List
+import contextvars
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional, Dict, List, Set, Tuple
 from pathlib import Path
 from pydantic import BaseModel
-import base64
-import tempfile
 import logging
 import sys
 import uuid
 from io import BytesIO
 import json
 import pdb
-import traceback
-
-# Configure logging with more detailed format
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+import time
+
+# Make the services package importable when started as `python services/app.py`
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from services.model_client import ModelClient, MODEL_NAME, GEMINI_MAX_CONCURRENCY, GEMINI_WARMUP, configure_genai
+from services.result_cache import ResultCache, cache_key, content_digest
+from services.file_store import FileStore, FILE_HANDLE_EXPIRY_MARGIN, INLINE_MAX_FILE_SIZE, handle_expires_at
+from services.pdf_text import MODE_HYBRID, PDF_TEXT_MAX_BYTES, extract_pdf
+from services.map_reduce import ANALYSIS_AUTO, map_reduce_pdf, should_map_reduce
+from services.process_pool import shutdown_process_pool
+from services.uploads import detach_upload, get_mime_type, inline_part, read_upload
+from services.csv_profile import CSV_PROFILE_ENABLED, csv_cache_variant, profile_csv, profile_to_text
+from services.image_stage import IMAGE_STAGE_ENABLED, IMAGE_STAGE_MAX_BYTES, image_cache_variant, process_image
+from services.structured_logging import configure_logging, log_event, shutdown_logging, start_request
+from services import metrics
+from services.health import HEALTH_PROBE_INTERVAL, HealthProber, saturation_reasons
+from services.chat_sessions import ChatSession, ChatSessionStore
+from services.documents import Document, DocumentStore
+from services.jobs import JOB_MAX_BYTES, JobQueue
+from services.scheduler import LANE_BATCH, LANE_INTERACTIVE, UpstreamScheduler, set_lane
+from services.shared_state import SharedState
+from services.prefork import WORKERS, serve
+from services.token_budget import TokenBudgetExceeded, check_budget, check_file, estimate_tokens
+from services.usage import begin_usage, ledger, usage_dict
+from services.responses import CompressionMiddleware, DefaultJSONResponse, dumps, select_fields
+from services.admission import AdmissionController, AdmissionMiddleware
+
+# Structured logging; records are written by a background thread
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Get the absolute path to the .env file
 ENV_PATH = Path(__file__).parent.parent / '.env'
 
-# Load environment variables
-if not ENV_PATH.exists():
-    raise ValueError(f"Environment file not found at {ENV_PATH}. Please create a .env file with your GOOGLE_API_KEY.")
-
-load_dotenv(ENV_PATH)
+# Load environment variables; the .env file is optional when the key is set in the environment
+if ENV_PATH.exists():
+    load_dotenv(ENV_PATH)
 
-# Validate required environment variables
+# Validate required environment variables (no network calls at import time)
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 if not GOOGLE_API_KEY:
-    raise ValueError(f"GOOGLE_API_KEY not found in {ENV_PATH}. Please add your Gemini API key to the .env file.")
+    raise ValueError(f"GOOGLE_API_KEY not found in the environment or {ENV_PATH}. Please add your Gemini API key to the .env file.")
 elif GOOGLE_API_KEY == 'your_gemini_api_key_here':
     raise ValueError("Please replace the placeholder API key in the .env file with your actual Gemini API key.")
 
-app = FastAPI()
+# JSON responses are rendered with orjson when it is installed
+app = FastAPI(default_response_class=DefaultJSONResponse)
 
-# Configure CORS
+# Bounded, per-client fair queues in front of the expensive routes; 503 + Retry-After when full
+admission = AdmissionController()
+app.add_middleware(AdmissionMiddleware, controller=admission)
+
+# Configure CORS (outside admission control, so rejections carry CORS headers)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["chrome-extension://*", "http://localhost:5001"],
     allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
     allow_headers=["*"],
     expose_headers=["*"],
     max_age=3600
 )
 
-# Add request logging middleware
+# Compress large JSON responses with br or gzip
+app.add_middleware(CompressionMiddleware)
+
+# Add request logging and metrics middleware
 @app.middleware("http")
 async def log_requests(request, call_next):
-    """Log all incoming requests and responses"""
-    logger.info(f"=== INCOMING REQUEST ===")
-    logger.info(f"Method: {request.method}")
-    logger.info(f"URL: {request.url}")
-    logger.info(f"Headers: {dict(request.headers)}")
-    logger.info(f"Client Host: {request.client.host if request.client else 'Unknown'}")
-    
-    response = await call_next(request)
-    
-    logger.info(f"=== RESPONSE ===")
-    logger.info(f"Status: {response.status_code}")
-    logger.info(f"Headers: {dict(response.headers)}")
-    
+    """Log one line per request and record its metrics; headers are only rendered at DEBUG level"""
+    request_id = request.headers.get('x-request-id') or uuid.uuid4().hex[:12]
+    start_request(request_id, request.url.path)
+    # Upstream calls made while serving the request add their token usage to it
+    begin_usage(scope=request.scope)
+    started = time.perf_counter()
+    log_event(logger, logging.DEBUG, 'request_headers', headers=lambda: dict(request.headers))
+
+    # Without a warm-up, upstream probing starts with the first request rather than at startup
+    start_health_probes()
+    metrics.http_in_flight.inc()
+    try:
+        response = await call_next(request)
+    except Exception as e:
+        metrics.errors.labels(type(e).__name__).inc()
+        raise
+    finally:
+        metrics.http_in_flight.dec()
+        # Label by route template, not raw path, to keep the label set bounded
+        route = request.scope.get('route')
+        route_path = route.path if route is not None else 'unmatched'
+        metrics.http_request_duration.labels(route_path).observe(time.perf_counter() - started)
+
+    metrics.http_requests.labels(route_path, request.method, str(response.status_code)).inc()
+    if response.status_code >= 400:
+        metrics.errors.labels(f"http_{response.status_code}").inc()
+    response.headers['X-Request-ID'] = request_id
+    log_event(
+        logger, logging.INFO, 'request',
+        method=request.method,
+        path=request.url.path,
+        status=response.status_code,
+        duration_ms=round((time.perf_counter() - started) * 1000, 1),
+        client=request.client.host if request.client else None,
+    )
     return response
 
-# Configure Gemini API
-try:
-    logger.info("""
-=== GEMINI API CONFIGURATION ===
-API Key: {} (first 8 chars)
-Model: gemini-2.0-flash
-Base URL: https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent
-""".format(GOOGLE_API_KEY[:8] + '...'))
-    
-    genai.configure(api_key=GOOGLE_API_KEY)
-    # Initialize the model
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    # Test the API key with a simple request
-    logger.info("Testing Gemini API connection...")
-    response = model.generate_content("Test connection")
-    logger.info(f"Gemini API test response: {response.text}")
-    logger.info("Successfully configured Gemini API")
-except Exception as e:
-    logger.error(f"""
-=== GEMINI API CONFIGURATION ERROR ===
-Error Type: {type(e).__name__}
-Error Message: {str(e)}
-Stack Trace: {traceback.format_exc()}
-""")
-    raise ValueError(f"Failed to configure Gemini API: {str(e)}. Please check your API key and try again.")
+# Quota buckets, File API handles, chat sessions and documents shared by the worker processes in multi-worker mode
+shared_state = SharedState() if WORKERS > 1 else None
+
+# Configure Gemini API; the SDK is imported and the model built on first use or by the warm-up
+configure_genai(GOOGLE_API_KEY)
+# Async client used by every endpoint for upstream calls
+model_client = ModelClient(
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    scheduler=UpstreamScheduler(GEMINI_MAX_CONCURRENCY, shared_state=shared_state)
+)
 
 # Constants
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+# Files above INLINE_MAX_FILE_SIZE go through the File API, which accepts up to 2GB
+MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE', str(2 * 1024 * 1024 * 1024)))
 ALLOWED_EXTENSIONS = {'.pdf', '.csv', '.jpg', '.jpeg', '.png', '.gif', '.txt', '.mp3', '.mp4'}
+# Maximum number of files analysed concurrently by the batch endpoint
+BATCH_CONCURRENCY = max(1, int(os.getenv('BATCH_CONCURRENCY', '4')))
+
+# Create a thread pool for CPU-bound tasks (model calls use the async client)
+thread_pool = metrics.InstrumentedThreadPool(max_workers=4)
 
-# Create a thread pool for CPU-bound tasks
-thread_pool = ThreadPoolExecutor(max_workers=4)
+# Cache of analysis results shared by /process_file and /process-multiple-pdfs (and by all workers)
+result_cache = ResultCache(shared=WORKERS > 1)
+
+# File API handles for large uploads, reused by content hash until they expire
+file_store = FileStore(shared_state=shared_state)
+
+# Chat histories, so each turn only carries the new message
+chat_sessions = ChatSessionStore(shared_state=shared_state)
+
+# Prepared payloads of registered documents, for follow-up questions without re-uploading
+document_store = DocumentStore(shared_state=shared_state, resolve_handle=file_store.resolve)
+
+# Persistent queue for batch analyses that outlive a single HTTP request
+job_queue = JobQueue()
+
+# Upstream status for readiness checks, refreshed in the background
+health_prober = HealthProber(model_client.ping)
+
+# Tasks that may outlive the request that started them, referenced until they finish
+background_tasks: Set[asyncio.Task] = set()
+
+def keep_task(coro: Awaitable) -> asyncio.Task:
+    """Run ``coro`` as a task that isn't garbage collected before it finishes"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Saturation gauges, read when /metrics is scraped
+metrics.registry.gauge('thread_pool_queue_depth', 'Work items waiting for a thread pool worker',
+                       callback=lambda: thread_pool.queue_depth)
+metrics.registry.gauge('thread_pool_active_workers', 'Thread pool workers running a work item',
+                       callback=lambda: thread_pool.active)
+metrics.registry.gauge('gemini_requests_in_flight', 'Upstream Gemini calls in flight',
+                       callback=lambda: model_client.in_flight)
 
 # Pydantic models for request/response
 class ChatRequest(BaseModel):
     message: str
     system_prompt: Optional[str] = None
+    # Omit to start a new session; the system prompt is kept by the session
+    session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
     success: bool
     response: str
     error: Optional[str] = None
+    session_id: Optional[str] = None
+    # Tokens spent on this turn
+    usage: Optional[Dict] = None
+
+class DocumentQuestion(BaseModel):
+    question: str
+    # Omit to start a new conversation about the document
+    session_id: Optional[str] = None
 
 def validate_file(file: UploadFile) -> None:
     """Validate file type and size"""
+    # An empty file has nothing to analyse; reject it before hashing or calling the model
+    if file.size == 0:
+        raise HTTPException(status_code=400, detail=f"File {file.filename} is empty")
+
     # Check file size
     if file.size > MAX_FILE_SIZE:
         raise HTTPException(
@@ -137,520 +220,1065 @@ def validate_file(file: UploadFile) -> None:
             detail=f"Unsupported file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
         )
 
-async def analyze_with_gemini(file_content: bytes, file_name: str) -> str:
-    """Analyze file content with Gemini Flash 2.0 API asynchronously"""
-    def _generate():
-        try:
-            # Create a temporary file to store the uploaded content
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file_name).suffix) as temp_file:
-                temp_file.write(file_content)
-                temp_file_path = temp_file.name
-
-            try:
-                # Determine mime type based on file extension
-                extension = Path(file_name).suffix.lower()
-                mime_type = {
-                    '.pdf': 'application/pdf',
-                    '.txt': 'text/plain',
-                    '.csv': 'text/csv',
-                    '.jpg': 'image/jpeg',
-                    '.jpeg': 'image/jpeg',
-                    '.png': 'image/png',
-                    '.gif': 'image/gif',
-                    '.mp3': 'audio/mpeg',
-                    '.mp4': 'video/mp4'
-                }.get(extension, 'application/octet-stream')
-
-                # Create a prompt for analysis
-                prompt = f"""Please analyze this file '{file_name}' and provide a detailed summary:
-
-Please provide:
-1. A brief overview
-2. Key points or findings
-3. Any notable patterns or insights
-4. Recommendations if applicable"""
-
-                # For images and PDFs, read the file and pass directly
-                with open(temp_file_path, 'rb') as f:
-                    file_data = f.read()
-
-                # Generate content using the file data
-                response = model.generate_content([
-                    prompt,
-                    {"mime_type": mime_type, "data": base64.b64encode(file_data).decode()}
-                ])
-                
-                # Extract response properties safely
-                response_dict = {}
-                
-                # Get text content
-                try:
-                    response_dict['text'] = response.text
-                except (AttributeError, TypeError):
-                    response_dict['text'] = None
-                
-                # Get prompt feedback if available
-                try:
-                    response_dict['prompt_feedback'] = str(response.prompt_feedback)
-                except (AttributeError, TypeError):
-                    response_dict['prompt_feedback'] = None
-                
-                # Get candidates if available
-                try:
-                    response_dict['candidates'] = [str(c) for c in response.candidates]
-                except (AttributeError, TypeError):
-                    response_dict['candidates'] = None
-                
-                # Add file info
-                response_dict['file_info'] = {
-                    'name': file_name,
-                    'mime_type': mime_type,
-                    'size': len(file_data),
-                    'state': 'ACTIVE'
-                }
-                
-                return response_dict
-                
-            finally:
-                # Clean up the temporary file
-                os.unlink(temp_file_path)
-                
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error analyzing content with Gemini Flash 2.0: {str(e)}"
-            )
-
-    return await asyncio.get_event_loop().run_in_executor(thread_pool, _generate)
+def response_to_dict(response) -> Dict:
+    """Extract response properties safely"""
+    response_dict = {}
+    
+    # Get text content
+    try:
+        response_dict['text'] = response.text
+    except (AttributeError, TypeError, ValueError):
+        response_dict['text'] = None
+    
+    # Get prompt feedback if available
+    try:
+        response_dict['prompt_feedback'] = str(response.prompt_feedback)
+    except (AttributeError, TypeError):
+        response_dict['prompt_feedback'] = None
+    
+    # Get candidates if available
+    try:
+        response_dict['candidates'] = [str(c) for c in response.candidates]
+    except (AttributeError, TypeError):
+        response_dict['candidates'] = None
+    
+    return response_dict
 
-async def process_single_pdf(file: UploadFile, prompt: str, file_id: str) -> str:
+async def process_single_pdf(file: UploadFile, prompt: str, file_id: str, pages: Optional[str] = None,
+                             analysis_mode: Optional[str] = None) -> Dict:
     try:
         # Validate file
         if not file.filename.lower().endswith('.pdf'):
             raise ValueError("File must be a PDF")
-        
-        # Read file content
-        content = await file.read()
-        if not content:
+        if file.size == 0:
             raise ValueError("File is empty")
         
-        logger.info(f"""
-=== STARTING PDF PROCESSING ===
-File: {file.filename}
-Size: {len(content)} bytes
-Prompt: {prompt}
-""")
-        
-        # Log complete request details
-        logger.info("""
-=== COMPLETE GEMINI API REQUEST ===
-File Details:
-- Name: {}
-- ID: {}
-- Size: {} bytes
-- Content Type: {}
-
-Prompt: {}
-
-API Configuration:
-- Model: gemini-2.0-flash
-- API Key: {} (first 8 chars)
-- Base URL: https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent
-
-Request Body:
-{}
-""".format(
-            file.filename,
-            file_id,
-            len(content),
-            file.content_type,
-            prompt,
-            GOOGLE_API_KEY[:8] + '...',
-            json.dumps({
-                "contents": [
-                    prompt,
-                    {
-                        "mime_type": "application/pdf",
-                        "data": base64.b64encode(content).decode()[:100] + '...'  # Show first 100 chars of base64
-                    }
-                ]
-            }, indent=2)
-        ))
-        
+        # Read file content; the PDF stage needs the bytes to extract the text layer
+        content = await read_upload(file)
+        return await analyze_pdf_bytes(content, file.filename, prompt, file_id, pages, analysis_mode,
+                                       content_type=file.content_type)
+    except Exception as e:
+        log_event(logger, logging.ERROR, 'pdf_failed', exc_info=True, file=file.filename, error=str(e))
+        raise ValueError(f"Error processing file {file.filename}: {str(e)}")
+
+async def analyze_pdf_bytes(content: bytes, file_name: str, prompt: str, file_id: str,
+                            pages: Optional[str] = None, analysis_mode: Optional[str] = None,
+                            content_type: Optional[str] = None) -> Dict:
+    """Analyze one PDF of a batch; shared by /process-multiple-pdfs and batch jobs"""
+    file_size = len(content)
+    if not file_size:
+        raise ValueError("File is empty")
+    metrics.upload_size.labels('application/pdf').observe(file_size)
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, content)
+    
+    log_event(
+        logger, logging.INFO, 'pdf_request',
+        file=file_name, file_id=file_id, size=file_size,
+        content_type=content_type, prompt=prompt,
+    )
+    
+    async def _generate() -> Dict:
         # Generate content with the custom prompt
-        logger.info("Making Gemini API call...")
-        try:
-            response = model.generate_content(
-                contents=[
-                    prompt,
-                    {"mime_type": "application/pdf", "data": base64.b64encode(content).decode()}
-                ]
-            )
-            logger.info("Gemini API call successful")
-        except Exception as api_error:
-            logger.error(f"""
-=== GEMINI API CALL ERROR ===
-Error Type: {type(api_error).__name__}
-Error Message: {str(api_error)}
-Stack Trace: {traceback.format_exc()}
-""")
-            raise
-        
-        # Log complete response details
-        logger.info("""
-=== COMPLETE GEMINI API RESPONSE ===
-File: {}
-Response Type: {}
-Response Properties:
-- Text Length: {}
-- First 200 chars: {}
-- Has Candidates: {}
-- Has Prompt Feedback: {}
-- Response Status: {}
-""".format(
-            file.filename,
-            type(response),
-            len(response.text) if hasattr(response, 'text') else 'N/A',
-            response.text[:200] if hasattr(response, 'text') else 'N/A',
-            hasattr(response, 'candidates'),
-            hasattr(response, 'prompt_feedback'),
-            getattr(response, 'status', 'N/A')
-        ))
-        
+        started = time.perf_counter()
+        response, pdf_info = await run_pdf_analysis(content, file_name, prompt, pages, analysis_mode)
+        log_event(
+            logger, logging.INFO, 'pdf_response',
+            file=file_name,
+            seconds=round(time.perf_counter() - started, 3),
+            chars=lambda: len(response.text),
+            preview=lambda: response.text[:200],
+        )
+    
         return {
             "text": response.text,
             "prompt": prompt,
-            "status": "completed"
+            "status": "completed",
+            "pdf": pdf_info
         }
-    except Exception as e:
-        logger.error("""
-=== GEMINI API ERROR ===
-File: {}
-Error Type: {}
-Error Message: {}
-Stack Trace:
-{}
-""".format(
-            file.filename,
-            type(e).__name__,
-            str(e),
-            traceback.format_exc()
-        ))
-        raise ValueError(f"Error processing file {file.filename}: {str(e)}")
+    
+    # Identical file + prompt pairs are answered from the cache or share one upstream call
+    key = cache_key(None, "application/pdf", prompt, MODEL_NAME, digest=digest,
+                    variant=pdf_cache_variant(pages, analysis_mode))
+    result, cache_status = await result_cache.get_or_compute(key, _generate)
+    log_event(logger, logging.DEBUG, 'result_cache', file=file_name, status=cache_status)
+    return {**result, "cache": cache_status}
 
 @app.options("/process-multiple-pdfs")
 async def options_process_multiple_pdfs():
     """Handle preflight requests for process-multiple-pdfs endpoint"""
-    logger.info("=== PREFLIGHT REQUEST RECEIVED ===")
     return {
         "status": "ok",
         "message": "Preflight request successful"
     }
 
 @app.post("/process-multiple-pdfs")
-async def process_multiple_pdfs(files: List[UploadFile], prompts: str = Form(...)):
-    """Process multiple PDF files with custom prompts"""
+async def process_multiple_pdfs(files: List[UploadFile], prompts: str = Form(...), pages: str = Form(None),
+                                analysis_mode: str = Form(None), fields: str = Form(None)):
+    """Process multiple PDF files with custom prompts.
+
+    `pages` is an optional JSON object mapping file ids to page ranges like "1-5,8".
+    `analysis_mode` is `auto` (default), `single` or `map_reduce`.
+    `fields` is `full` (default), `compact` or a comma-separated list of summary fields to return.
+    """
     try:
-        logger.info("""
-=== PROCESS MULTIPLE PDFS REQUEST RECEIVED ===
-Number of files: {}
-File names: {}
-Raw prompts string: {}
-Headers: {}
-""".format(
-            len(files),
-            [f.filename for f in files],
-            prompts,
-            dict(request.headers)
-        ))
+        log_event(
+            logger, logging.INFO, 'batch_request',
+            files=len(files), concurrency=BATCH_CONCURRENCY,
+            file_names=lambda: [f.filename for f in files],
+        )
         
+        # Bulk work yields upstream slots to interactive requests
+        set_lane(LANE_BATCH)
+
         # Parse prompts from JSON string
         prompts_dict = json.loads(prompts)
-        logger.info(f"Parsed prompts: {json.dumps(prompts_dict, indent=2)}")
+        pages_dict = json.loads(pages) if pages else {}
         
-        results = []
-        errors = []
+        # Bound the number of files analysed at the same time
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
         
-        for file in files:
-            try:
-                file_id = file.filename
-                prompt = prompts_dict.get(file_id, "Give me a summary of this pdf file.")
-                logger.info(f"""
-=== PROCESSING FILE ===
-File ID: {file_id}
-Prompt: {prompt}
-File Size: {file.size if hasattr(file, 'size') else 'Unknown'}
-Content Type: {file.content_type if hasattr(file, 'content_type') else 'Unknown'}
-""")
-                
-                # Read file content first to verify
-                content = await file.read()
-                logger.info(f"File content read successfully. Size: {len(content)} bytes")
-                
-                # Reset file pointer for next read
-                await file.seek(0)
-                
-                # Process the file
-                result = await process_single_pdf(file, prompt, file_id)
-                logger.info(f"""
-=== FILE PROCESSING RESULT ===
-File: {file_id}
-Success: True
-Response Length: {len(result.get('text', '')) if result else 'N/A'}
-First 200 chars: {result.get('text', '')[:200] if result else 'N/A'}
-""")
-                
-                results.append({
-                    "file_id": file_id,
-                    "success": True,
-                    "summary": result
-                })
-                logger.info(f"Successfully processed file: {file_id}")
-                
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"""
-=== ERROR PROCESSING FILE ===
-File ID: {file_id}
-Error Type: {type(e).__name__}
-Error Message: {error_msg}
-Stack Trace: {traceback.format_exc()}
-""")
-                errors.append({
-                    "file_id": file_id,
-                    "error": error_msg
-                })
+        async def _process(file: UploadFile) -> Dict:
+            file_id = file.filename
+            prompt = prompts_dict.get(file_id, "Give me a summary of this pdf file.")
+            # Usage of this file, also added to the usage of the request
+            usage = begin_usage()
+            async with semaphore:
+                try:
+                    # Process the file
+                    result = await process_single_pdf(file, prompt, file_id, pages_dict.get(file_id), analysis_mode)
+                    log_event(logger, logging.DEBUG, 'batch_file_done', file=file_id)
+                    return {
+                        "file_id": file_id,
+                        "success": True,
+                        "summary": select_fields(result, fields),
+                        "usage": usage.as_dict()
+                    }
+                    
+                except Exception as e:
+                    error_msg = str(e)
+                    log_event(logger, logging.WARNING, 'batch_file_failed', exc_info=True, file=file_id, error=error_msg)
+                    return {
+                        "file_id": file_id,
+                        "success": False,
+                        "error": error_msg
+                    }
+        
+        # Fan out all files at once; gather keeps the results in input order
+        outcomes = await asyncio.gather(*(_process(file) for file in files))
+        
+        results = [outcome for outcome in outcomes if outcome["success"]]
+        errors = [
+            {"file_id": outcome["file_id"], "error": outcome["error"]}
+            for outcome in outcomes if not outcome["success"]
+        ]
         
         response_data = {
             "success": len(errors) == 0,
             "results": results,
-            "errors": errors
+            "errors": errors,
+            "usage": usage_dict()
         }
-        logger.info(f"Sending response: {json.dumps(response_data, indent=2)}")
+        log_event(logger, logging.INFO, 'batch_response', succeeded=len(results), failed=len(errors))
         return response_data
         
     except Exception as e:
-        logger.error(f"""
-=== ENDPOINT ERROR ===
-Error Type: {type(e).__name__}
-Error Message: {str(e)}
-Stack Trace: {traceback.format_exc()}
-""")
+        log_event(logger, logging.ERROR, 'batch_failed', exc_info=True, error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/process_file")
-async def process_file(file: UploadFile = File(...), prompt: str = Form(None)):
+async def run_pdf_job_task(task: Dict, content: bytes) -> Dict:
+    """Analyze one file of a queued batch job"""
+    set_lane(LANE_BATCH)
+    usage = begin_usage(route='job:pdf_batch')
+    params = task['params']
+    result = await analyze_pdf_bytes(content, task['file_name'], params['prompt'], task['file_id'],
+                                     params.get('pages'), params.get('analysis_mode'))
+    return {**select_fields(result, params.get('fields')), "usage": usage.as_dict()}
+
+job_queue.register('pdf_batch', run_pdf_job_task)
+
+@app.post("/jobs", status_code=202)
+async def submit_job(files: List[UploadFile], prompts: str = Form(...), pages: str = Form(None),
+                     analysis_mode: str = Form(None), fields: str = Form(None)):
+    """Queue a batch of PDFs for analysis and return a job id right away.
+
+    Takes the same form fields as /process-multiple-pdfs. Poll `GET /jobs/{job_id}`
+    or stream `GET /jobs/{job_id}/events` for per-file progress and results.
+    """
     try:
-        # Validate file
+        prompts_dict = json.loads(prompts)
+        pages_dict = json.loads(pages) if pages else {}
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in form field: {str(e)}")
+
+    for file in files:
         validate_file(file)
-        
-        # Read file content
-        file_content = await file.read()
-        
-        # Use provided prompt or default if none provided
-        custom_prompt = prompt
-        if not custom_prompt:
-            # Default prompt based on file type
-            extension = Path(file.filename).suffix.lower()
-            if extension in ['.pdf', '.docx', '.doc', '.txt']:
-                custom_prompt = f"""Please analyze this file '{file.filename}' and provide a detailed summary:
+        if not file.filename.lower().endswith('.pdf'):
+            raise HTTPException(status_code=400, detail=f"File {file.filename} must be a PDF")
+    # Every file of the job is read into memory and kept on disk until it is analysed
+    total_size = sum(file.size or 0 for file in files)
+    if total_size > JOB_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Job files total {total_size/1024/1024:.1f}MB, above the limit of {JOB_MAX_BYTES/1024/1024}MB"
+        )
+
+    job_files = []
+    for file in files:
+        file_id = file.filename
+        job_files.append({
+            'file_id': file_id,
+            'file_name': file.filename,
+            'content': await read_upload(file),
+            'params': {
+                'prompt': prompts_dict.get(file_id, "Give me a summary of this pdf file."),
+                'pages': pages_dict.get(file_id),
+            },
+        })
+
+    job_id = await job_queue.submit('pdf_batch', job_files, {'analysis_mode': analysis_mode, 'fields': fields})
+    log_event(logger, logging.INFO, 'job_submitted', job_id=job_id, files=len(job_files))
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/jobs/{job_id}/events"
+    }
+
+async def _get_job(job_id: str) -> Dict:
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or past retention")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job status with per-file progress and results"""
+    return await _get_job(job_id)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, http_request: Request):
+    """Stream job progress as Server-Sent Events.
+
+    Emits a `progress` event with the full job state on every change and a
+    `done` event once every file is finished; comments keep idle connections open.
+    """
+    await _get_job(job_id)
+
+    async def _events():
+        async for job in job_queue.watch(job_id):
+            if await http_request.is_disconnected():
+                break
+            if job is None:
+                yield ": keepalive\n\n"
+            elif job["done"] == job["total"]:
+                yield sse_event(job, event="done")
+            else:
+                yield sse_event(job, event="progress")
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel the files of a job that haven't started yet"""
+    if not await job_queue.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Job not found or past retention")
+    return await _get_job(job_id)
+
+def default_prompt(file_name: str) -> str:
+    """Default analysis prompt for a file type"""
+    extension = Path(file_name).suffix.lower()
+    if extension in ['.pdf', '.docx', '.doc', '.txt']:
+        return f"""Please analyze this file '{file_name}' and provide a detailed summary:
 
 Please provide:
 1. A brief overview
 2. Key points or findings
 3. Any notable patterns or insights
 4. Recommendations if applicable"""
-            elif extension in ['.csv', '.xlsx', '.xls']:
-                custom_prompt = f"""Analyze this data file '{file.filename}' and provide key insights:
+    elif extension in ['.csv', '.xlsx', '.xls']:
+        return f"""Analyze this data file '{file_name}' and provide key insights:
                 
 1. Data structure overview
 2. Key statistics and trends
 3. Notable patterns or anomalies
 4. Potential actionable insights"""
-            elif extension in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-                custom_prompt = f"""Describe in detail what you see in this image '{file.filename}':
+    elif extension in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
+        return f"""Describe in detail what you see in this image '{file_name}':
                 
 1. Main subjects or elements
 2. Visual characteristics
 3. Context or setting
 4. Any notable details or unique features"""
-            else:
-                custom_prompt = f"Please analyze this file '{file.filename}' and provide a comprehensive summary."
+    return f"Please analyze this file '{file_name}' and provide a comprehensive summary."
+
+@app.post("/process_file")
+async def process_file(file: UploadFile = File(...), prompt: str = Form(None), pages: str = Form(None),
+                       analysis_mode: str = Form(None), fields: str = Form(None)):
+    """Analyze one file.
+
+    For PDFs, `pages` optionally restricts the analysis to page ranges like 1-5,8
+    and `analysis_mode` is `auto` (default), `single` or `map_reduce`.
+    `fields` is `full` (default), `compact` (without the candidates, prompt
+    feedback and prompt echo) or a comma-separated list of analysis fields.
+    """
+    try:
+        # Validate file
+        validate_file(file)
         
-        # Log the prompt being used
-        logger.info(f"""
-=== PROCESSING FILE WITH PROMPT ===
-File: {file.filename}
-Prompt: {custom_prompt}
-""")
+        # Use provided prompt or default if none provided
+        custom_prompt = prompt or default_prompt(file.filename)
+        
+        log_event(logger, logging.INFO, 'file_request', file=file.filename, size=file.size, prompt=custom_prompt)
         
         # Analyze with Gemini Flash 2.0 using the custom prompt
-        analysis = await analyze_with_gemini_custom_prompt(file_content, file.filename, custom_prompt)
+        analysis = await analyze_upload_custom_prompt(file, custom_prompt, pages, analysis_mode)
 
         return {
             'success': True,
             'fileName': file.filename,
-            'analysis': analysis
+            'analysis': select_fields(analysis, fields),
+            'usage': usage_dict()
         }
 
     except HTTPException as he:
         raise he
     except Exception as e:
-        logger.error(f"Error processing file: {str(e)}\n{traceback.format_exc()}")
+        log_event(logger, logging.ERROR, 'file_failed', exc_info=True, file=file.filename, error=str(e))
         raise HTTPException(
             status_code=500,
             detail=f"Unexpected error processing file: {str(e)}"
         )
 
-async def analyze_with_gemini_custom_prompt(file_content: bytes, file_name: str, prompt: str) -> str:
+def ndjson_line(data: Dict) -> str:
+    """One newline-delimited JSON record"""
+    return dumps(data) + "\n"
+
+@app.post("/process-files")
+async def process_files(files: List[UploadFile], prompts: str = Form(None), file_ids: str = Form(None),
+                        pages: str = Form(None), analysis_mode: str = Form(None), fields: str = Form(None)):
+    """Analyze a batch of files of any supported type, streaming each result as it completes.
+
+    `file_ids` is an optional JSON list naming the files in upload order
+    (defaults to the file names); `prompts` and `pages` are optional JSON
+    objects keyed by file id, and `fields` selects the analysis fields as for
+    /process_file. The response is NDJSON: one line per file in
+    completion order, then a summary line with `"done": true` and the token
+    usage of the whole batch.
+    """
+    try:
+        prompts_dict = json.loads(prompts) if prompts else {}
+        pages_dict = json.loads(pages) if pages else {}
+        ids = json.loads(file_ids) if file_ids else [file.filename for file in files]
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in form field: {str(e)}")
+    if len(ids) != len(files):
+        raise HTTPException(status_code=400, detail="file_ids must name every uploaded file")
+    for file in files:
+        validate_file(file)
+
+    # The form is closed when this handler returns, before the response streams
+    uploads = [detach_upload(file) for file in files]
+    log_event(
+        logger, logging.INFO, 'files_request',
+        files=len(uploads), concurrency=BATCH_CONCURRENCY,
+        file_names=lambda: [upload.filename for upload in uploads],
+    )
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    # Positions of the files whose analysis has started; their upstream work runs to completion either way
+    started = set()
+
+    async def _process(index: int, file_id: str, upload: UploadFile) -> Dict:
+        prompt = prompts_dict.get(file_id) or default_prompt(upload.filename)
+        usage = begin_usage()
+        try:
+            async with semaphore:
+                started.add(index)
+                try:
+                    analysis = await analyze_upload_custom_prompt(
+                        upload, prompt, pages_dict.get(file_id), analysis_mode)
+                    return {"file_id": file_id, "fileName": upload.filename, "success": True,
+                            "analysis": select_fields(analysis, fields), "usage": usage.as_dict()}
+                except Exception as e:
+                    error_msg = e.detail if isinstance(e, HTTPException) else str(e)
+                    log_event(logger, logging.WARNING, 'batch_file_failed', exc_info=True, file=file_id,
+                              error=error_msg)
+                    return {"file_id": file_id, "fileName": upload.filename, "success": False,
+                            "error": error_msg, "usage": usage.as_dict()}
+        finally:
+            # Only closed once nothing reads the spooled file any more
+            await upload.close()
+
+    async def _results():
+        tasks = [keep_task(_process(index, file_id, upload))
+                 for index, (file_id, upload) in enumerate(zip(ids, uploads))]
+        succeeded = 0
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                succeeded += result["success"]
+                yield ndjson_line(result)
+            log_event(logger, logging.INFO, 'files_response', succeeded=succeeded, failed=len(tasks) - succeeded)
+            yield ndjson_line({"done": True, "succeeded": succeeded, "failed": len(tasks) - succeeded,
+                               "usage": usage_dict()})
+        finally:
+            # The client went away: drop the files still waiting for a slot. Analyses
+            # already running can't be stopped (the result cache shields them), so
+            # they finish, are cached, and close their upload when done.
+            for index, task in enumerate(tasks):
+                if index not in started:
+                    task.cancel()
+
+    return StreamingResponse(
+        _results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _analyze_cached(run: Callable[[], Awaitable[Tuple[Any, Dict]]], digest: str,
+                          file_name: str, mime_type: str, file_size: int, prompt: str,
+                          variant: str = '') -> Dict:
+    """Run a cached analysis of one file with a custom prompt.
+
+    `run` makes the upstream call(s) and returns the final response together
+    with details about how the file was sent.
+    """
+    async def _generate() -> Dict:
+        response, part_info = await run()
+        
+        response_dict = response_to_dict(response)
+        
+        # Add file info
+        response_dict['file_info'] = {
+            'name': file_name,
+            'mime_type': mime_type,
+            'size': file_size,
+            'state': 'ACTIVE',
+            **part_info
+        }
+        
+        # Add the prompt that was used
+        response_dict['prompt'] = prompt
+        
+        return response_dict
+
+    try:
+        # Identical file + prompt pairs are answered from the cache or share one upstream call
+        key = cache_key(None, mime_type, prompt, MODEL_NAME, digest=digest, variant=variant)
+        analysis, cache_status = await result_cache.get_or_compute(key, _generate)
+        log_event(logger, logging.DEBUG, 'result_cache', file=file_name, status=cache_status)
+
+        return {
+            **analysis,
+            'file_info': {**analysis['file_info'], 'name': file_name},
+            'cache': cache_status
+        }
+            
+    except HTTPException:
+        raise
+    except TokenBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        log_event(logger, logging.ERROR, 'analysis_failed', exc_info=True, file=file_name, error=str(e))
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error analyzing content with Gemini Flash 2.0: {str(e)}"
+        )
+
+async def analyze_with_gemini_custom_prompt(file_content: bytes, file_name: str, prompt: str) -> Dict:
     """Analyze file content with Gemini Flash 2.0 API asynchronously using a custom prompt"""
-    def _generate():
+    mime_type = get_mime_type(file_name)
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, file_content)
+
+    async def _run():
+        # The upload buffer is handed over as-is, without a temp file or base64 copy
+        response = await model_client.generate([prompt, inline_part(file_content, mime_type)])
+        return response, {'transport': 'inline'}
+
+    return await _analyze_cached(_run, digest, file_name, mime_type, len(file_content), prompt)
+
+async def analyze_large_file_custom_prompt(file: UploadFile, prompt: str) -> Dict:
+    """Analyze a file above the inline limit through the Gemini File API"""
+    mime_type = get_mime_type(file.filename)
+    # Hash the spooled upload in chunks instead of reading it into memory
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, file.file)
+
+    async def _run():
+        # Reject files that can't fit the model's input before uploading them
+        check_file(file.size, mime_type, file.filename)
+        handle, upload_status = await file_store.get_or_upload(digest, file.file, mime_type, file.filename)
+        response = await model_client.generate([prompt, handle])
+        return response, {'transport': 'file_api', 'upload': upload_status, 'state': _file_state(handle)}
+
+    return await _analyze_cached(_run, digest, file.filename, mime_type, file.size, prompt)
+
+async def analyze_csv_custom_prompt(file: UploadFile, prompt: str) -> Dict:
+    """Analyze a CSV from a locally computed profile instead of the raw file"""
+    loop = asyncio.get_event_loop()
+    digest = await loop.run_in_executor(thread_pool, content_digest, file.file)
+
+    async def _run():
         try:
-            # Create a temporary file to store the uploaded content
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file_name).suffix) as temp_file:
-                temp_file.write(file_content)
-                temp_file_path = temp_file.name
+            profile = await loop.run_in_executor(thread_pool, profile_csv, file.file)
+        except ValueError as e:
+            # Malformed CSVs are sent unchanged and left to the model
+            log_event(logger, logging.WARNING, 'csv_profile_failed', file=file.filename, error=str(e))
+            if file.size is not None and file.size > INLINE_MAX_FILE_SIZE:
+                check_file(file.size, 'text/csv', file.filename)
+                handle, upload_status = await file_store.get_or_upload(digest, file.file, 'text/csv', file.filename)
+                response = await model_client.generate([prompt, handle])
+                return response, {'transport': 'file_api', 'upload': upload_status}
+            content = await read_upload(file)
+            response = await model_client.generate([prompt, inline_part(content, 'text/csv')])
+            return response, {'transport': 'inline'}
 
-            try:
-                # Determine mime type based on file extension
-                extension = Path(file_name).suffix.lower()
-                mime_type = {
-                    '.pdf': 'application/pdf',
-                    '.txt': 'text/plain',
-                    '.csv': 'text/csv',
-                    '.jpg': 'image/jpeg',
-                    '.jpeg': 'image/jpeg',
-                    '.png': 'image/png',
-                    '.gif': 'image/gif',
-                    '.mp3': 'audio/mpeg',
-                    '.mp4': 'video/mp4'
-                }.get(extension, 'application/octet-stream')
-
-                # For images and PDFs, read the file and pass directly
-                with open(temp_file_path, 'rb') as f:
-                    file_data = f.read()
-
-                # Generate content using the file data and custom prompt
-                response = model.generate_content([
-                    prompt,
-                    {"mime_type": mime_type, "data": base64.b64encode(file_data).decode()}
-                ])
-                
-                # Extract response properties safely
-                response_dict = {}
-                
-                # Get text content
-                try:
-                    response_dict['text'] = response.text
-                except (AttributeError, TypeError):
-                    response_dict['text'] = None
-                
-                # Get prompt feedback if available
-                try:
-                    response_dict['prompt_feedback'] = str(response.prompt_feedback)
-                except (AttributeError, TypeError):
-                    response_dict['prompt_feedback'] = None
-                
-                # Get candidates if available
-                try:
-                    response_dict['candidates'] = [str(c) for c in response.candidates]
-                except (AttributeError, TypeError):
-                    response_dict['candidates'] = None
-                
-                # Add file info
-                response_dict['file_info'] = {
-                    'name': file_name,
-                    'mime_type': mime_type,
-                    'size': len(file_data),
-                    'state': 'ACTIVE'
-                }
-                
-                # Add the prompt that was used
-                response_dict['prompt'] = prompt
-                
-                return response_dict
-                
-            finally:
-                # Clean up the temporary file
-                os.unlink(temp_file_path)
-                
-        except Exception as e:
-            logger.error(f"Error in analyze_with_gemini_custom_prompt: {str(e)}\n{traceback.format_exc()}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error analyzing content with Gemini Flash 2.0: {str(e)}"
-            )
+        profile_text = profile_to_text(profile, file.filename)
+        response = await model_client.generate([prompt, profile_text])
+        return response, {
+            'transport': 'csv_profile',
+            'rows': profile['rows'],
+            'columns': profile['columns'],
+            'engine': profile['engine'],
+            'profile_seconds': profile['profile_seconds'],
+            'payload_size': len(profile_text.encode('utf-8')),
+        }
+
+    return await _analyze_cached(_run, digest, file.filename, 'text/csv', file.size, prompt,
+                                 variant=csv_cache_variant())
+
+async def analyze_image_custom_prompt(file: UploadFile, prompt: str) -> Dict:
+    """Analyze an image after downscaling and recompressing it"""
+    mime_type = get_mime_type(file.filename)
+    # Cache hits never read the upload into memory
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, file.file)
+
+    async def _run():
+        processed = await process_image(await read_upload(file), mime_type, file.filename)
+        parts = [prompt, *await image_parts(processed, file.filename)]
+
+        started = time.perf_counter()
+        response = await model_client.generate(parts)
+        image_info = {**processed.info(), 'upstream_seconds': round(time.perf_counter() - started, 3)}
+        return response, {'transport': 'image_stage', 'image': image_info}
+
+    return await _analyze_cached(_run, digest, file.filename, mime_type, file.size, prompt,
+                                 variant=image_cache_variant())
+
+async def image_parts(processed: Any, file_name: str) -> List[Any]:
+    """Request parts for the output of the image stage"""
+    parts = []
+    if processed.frames > 1:
+        parts.append(f"The following {processed.frames} images are evenly spaced frames "
+                     f"of the animated image '{file_name}'.")
+    for data, part_mime_type in processed.images:
+        parts.append(await bytes_part(data, part_mime_type, file_name))
+    return parts
+
+async def bytes_part(data: bytes, mime_type: str, file_name: str) -> Any:
+    """Inline part for small payloads, File API handle for ones above the inline limit"""
+    if len(data) <= INLINE_MAX_FILE_SIZE:
+        return inline_part(data, mime_type)
+
+    check_file(len(data), mime_type, file_name)
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, data)
+    handle, _ = await file_store.get_or_upload(digest, BytesIO(data), mime_type, file_name)
+    return handle
+
+async def pdf_bytes_part(pdf_bytes: bytes, file_name: str) -> Any:
+    """Inline part for small PDFs, File API handle for ones above the inline limit"""
+    return await bytes_part(pdf_bytes, 'application/pdf', file_name)
+
+async def run_pdf_analysis(content: bytes, file_name: str, prompt: str, pages: Optional[str] = None,
+                           analysis_mode: Optional[str] = None) -> Tuple[Any, Dict]:
+    """Run the PDF stage, then analyze the document in one call or map-reduce over chunks"""
+    try:
+        extraction = await extract_pdf(content, pages, executor=thread_pool)
+        use_map_reduce = should_map_reduce(extraction, analysis_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if use_map_reduce:
+        response, stats = await map_reduce_pdf(
+            content, extraction, prompt, file_name,
+            generate=model_client.generate, pdf_part=pdf_bytes_part, executor=thread_pool
+        )
+        return response, {**extraction.info(), 'map_reduce': stats}
+
+    response = await model_client.generate([prompt, *await pdf_parts(extraction, file_name)])
+    return response, extraction.info()
+
+async def pdf_parts(extraction: Any, file_name: str) -> List[Any]:
+    """Request parts for the output of the PDF stage: text layer and/or PDF"""
+    parts = []
+    if extraction.text:
+        parts.append(f"Text layer of '{file_name}':\n\n{extraction.text}")
+    if extraction.pdf_bytes is not None:
+        if extraction.mode == MODE_HYBRID:
+            scanned = ', '.join(str(number + 1) for number in extraction.scanned_pages)
+            parts.append(f"The following PDF contains pages {scanned}, which have no text layer.")
+        parts.append(await pdf_bytes_part(extraction.pdf_bytes, file_name))
+    return parts
+
+async def analyze_pdf_custom_prompt(file: UploadFile, prompt: str, pages: Optional[str] = None,
+                                    analysis_mode: Optional[str] = None) -> Dict:
+    """Analyze a PDF, sending its text layer instead of the binary where possible"""
+    # Cache hits never read the upload into memory
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, file.file)
+
+    async def _run():
+        content = await read_upload(file)
+        response, pdf_info = await run_pdf_analysis(content, file.filename, prompt, pages, analysis_mode)
+        return response, {'transport': 'pdf_stage', **pdf_info}
+
+    return await _analyze_cached(_run, digest, file.filename, 'application/pdf', file.size, prompt,
+                                 variant=pdf_cache_variant(pages, analysis_mode))
+
+async def analyze_upload_custom_prompt(file: UploadFile, prompt: str, pages: Optional[str] = None,
+                                       analysis_mode: Optional[str] = None) -> Dict:
+    """Analyze an upload inline, or through the File API when it is too large to send inline"""
+    mime_type = get_mime_type(file.filename)
+    if file.size is not None:
+        metrics.upload_size.labels(mime_type).observe(file.size)
+    if mime_type == 'application/pdf':
+        if fits_local_stage(file, PDF_TEXT_MAX_BYTES):
+            return await analyze_pdf_custom_prompt(file, prompt, pages, analysis_mode)
+        prompt = pdf_pages_prompt(pages) + prompt
+
+    if mime_type == 'text/csv' and CSV_PROFILE_ENABLED:
+        return await analyze_csv_custom_prompt(file, prompt)
+
+    if mime_type.startswith('image/') and IMAGE_STAGE_ENABLED and fits_local_stage(file, IMAGE_STAGE_MAX_BYTES):
+        return await analyze_image_custom_prompt(file, prompt)
+
+    if file.size is not None and file.size > INLINE_MAX_FILE_SIZE:
+        return await analyze_large_file_custom_prompt(file, prompt)
+
+    # Read the spooled upload once; this buffer is shared by hashing and the model request
+    file_content = await read_upload(file)
+    return await analyze_with_gemini_custom_prompt(file_content, file.filename, prompt)
+
+def fits_local_stage(file: UploadFile, max_bytes: int) -> bool:
+    """Whether an upload is small enough for a local stage, which reads it into memory"""
+    if file.size is None or file.size <= max_bytes:
+        return True
+    log_event(logger, logging.INFO, 'local_stage_skipped', file=file.filename, size=file.size, max_bytes=max_bytes)
+    return False
+
+def pdf_pages_prompt(pages: Optional[str]) -> str:
+    """Page selection for a PDF sent as a whole, which can't be cut locally"""
+    return f"Only use pages {pages} of the PDF.\n\n" if pages else ''
 
-    return await asyncio.get_event_loop().run_in_executor(thread_pool, _generate)
+def pdf_cache_variant(pages: Optional[str], analysis_mode: Optional[str]) -> str:
+    """Request options that change the answer for the same PDF and prompt"""
+    return f"pages={pages or ''};mode={analysis_mode or ANALYSIS_AUTO}"
+
+def _file_state(handle) -> str:
+    """Name of the File API processing state of an uploaded file"""
+    state = getattr(handle, 'state', None)
+    return getattr(state, 'name', 'ACTIVE')
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant. Please provide clear and concise responses."
+
+# Detail of the 404 for a chat turn whose session is gone
+SESSION_EXPIRED = "session_expired"
+
+SUMMARY_PROMPT = (
+    "Summarise the following conversation for use as context in later turns. "
+    "Keep facts, names, numbers, decisions and open questions; be concise.\n\n"
+)
+
+async def _summarize_history(text: str) -> str:
+    """Fold compacted chat turns into a running summary"""
+    response = await model_client.generate(SUMMARY_PROMPT + text)
+    return response.text
+
+async def _compact_chat_session(session: ChatSession) -> None:
+    """Keep the session history under its token budget, off the request path"""
+    # Counted on its own: the turn that triggered it has already answered
+    begin_usage(route='chat_compaction')
+    async with session.lock:
+        await chat_sessions.compact(session, _summarize_history)
+
+def schedule_chat_compaction(session: ChatSession) -> None:
+    if session.history_tokens > chat_sessions.token_budget:
+        # Started from an empty context so it inherits nothing from the request
+        contextvars.Context().run(keep_task, _compact_chat_session(session))
+
+def sse_event(data: Dict, event: Optional[str] = None) -> str:
+    """Format a Server-Sent Events message"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {dumps(data)}\n\n"
+
+async def open_chat_session(request: ChatRequest) -> ChatSession:
+    """Continue the session of a chat turn, or start one.
+
+    A turn for an unknown or expired session without a system prompt would be
+    answered without the context the client set up, so it is refused with 404
+    before any upstream call; the client then resends the turn with its context.
+    """
+    if request.session_id and request.system_prompt is None and await chat_sessions.get(request.session_id) is None:
+        raise HTTPException(status_code=404, detail=SESSION_EXPIRED)
+    return await chat_sessions.get_or_create(request.session_id, request.system_prompt)
 
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
+    set_lane(LANE_INTERACTIVE)
+    session = await open_chat_session(request)
     try:
-        # Prepare the prompt
-        prompt = request.system_prompt if request.system_prompt else "You are a helpful AI assistant. Please provide clear and concise responses."
-        full_prompt = f"{prompt}\n\nUser: {request.message}\nAssistant:"
-
-        # Run Gemini API call in thread pool since it's not async
-        def _generate():
+        # Turns of one session run one at a time so the history stays ordered
+        async with session.lock:
             try:
-                response = model.generate_content(full_prompt)
-                return response.text
+                response = await model_client.send_chat(
+                    list(session.history), request.message,
+                    system_instruction=session.system_instruction() or DEFAULT_SYSTEM_PROMPT,
+                )
+                response_text = response.text
+            except TokenBudgetExceeded as e:
+                raise HTTPException(status_code=413, detail=str(e))
             except Exception as e:
                 raise HTTPException(
                     status_code=500,
                     detail=f"Error generating response with Gemini Flash 2.0: {str(e)}"
                 )
+            await chat_sessions.add_exchange(session, request.message, response_text)
+        schedule_chat_compaction(session)
 
-        response_text = await asyncio.get_event_loop().run_in_executor(thread_pool, _generate)
-        
         return ChatResponse(
             success=True,
-            response=response_text
+            response=response_text,
+            session_id=session.id,
+            usage=usage_dict()
         )
 
     except HTTPException as he:
         return ChatResponse(
             success=False,
             response="",
-            error=str(he.detail)
+            error=str(he.detail),
+            session_id=session.id
         )
     except Exception as e:
         return ChatResponse(
             success=False,
             response="",
-            error=f"Unexpected error: {str(e)}"
+            error=f"Unexpected error: {str(e)}",
+            session_id=session.id
         )
 
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Stream the chat answer as Server-Sent Events while it is being generated.
+
+    Emits a `session` event with the session id first, `data: {"text": ...}`
+    for every chunk, then a `done` event, or an `error` event if generation
+    fails. Generation stops as soon as the client disconnects so abandoned
+    answers don't keep using quota; unfinished answers are not added to the
+    session history. A turn for an expired session sent without
+    `system_prompt` is refused with 404 `session_expired`, as on /api/chat.
+    """
+    set_lane(LANE_INTERACTIVE)
+    session = await open_chat_session(request)
+    new_session = session.id != request.session_id
+
+    async def _events():
+        yield sse_event({"session_id": session.id, "new_session": new_session}, event="session")
+        completed = False
+        async with session.lock:
+            stream = model_client.send_chat_stream(
+                list(session.history), request.message,
+                system_instruction=session.system_instruction() or DEFAULT_SYSTEM_PROMPT,
+            )
+            parts = []
+            try:
+                async for chunk in stream:
+                    if await http_request.is_disconnected():
+                        log_event(logger, logging.INFO, 'chat_stream_disconnected')
+                        break
+                    try:
+                        text = chunk.text
+                    except (AttributeError, TypeError, ValueError):
+                        text = ""
+                    if text:
+                        parts.append(text)
+                        yield sse_event({"text": text})
+                else:
+                    await chat_sessions.add_exchange(session, request.message, "".join(parts))
+                    completed = True
+                    yield sse_event({"success": True, **session.info(), "usage": usage_dict()}, event="done")
+            except asyncio.CancelledError:
+                log_event(logger, logging.INFO, 'chat_stream_cancelled')
+                raise
+            except Exception as e:
+                log_event(logger, logging.ERROR, 'chat_stream_failed', exc_info=True, error=str(e))
+                yield sse_event({"error": f"Error generating response with Gemini Flash 2.0: {str(e)}"}, event="error")
+            finally:
+                await stream.aclose()
+        if completed:
+            schedule_chat_compaction(session)
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.delete("/api/chat/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    """Forget a chat session and its history"""
+    if not await chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return {"success": True, "session_id": session_id}
+
+def document_variant(mime_type: str, pages: Optional[str]) -> str:
+    """Options that change the prepared payload for the same content"""
+    if mime_type == 'application/pdf':
+        return f"pages={pages or ''}"
+    if mime_type == 'text/csv':
+        return csv_cache_variant() if CSV_PROFILE_ENABLED else ''
+    if mime_type.startswith('image/'):
+        return image_cache_variant()
+    return ''
+
+async def prepare_document_parts(file: UploadFile, mime_type: str, digest: str,
+                                 pages: Optional[str] = None) -> Tuple[List[Any], Dict]:
+    """Run the upload through the same stages as /process_file and return the request parts"""
+    loop = asyncio.get_event_loop()
+    if mime_type == 'application/pdf' and fits_local_stage(file, PDF_TEXT_MAX_BYTES):
+        content = await read_upload(file)
+        try:
+            extraction = await extract_pdf(content, pages, executor=thread_pool)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return await pdf_parts(extraction, file.filename), {'transport': 'pdf_stage', **extraction.info()}
+
+    if mime_type == 'text/csv' and CSV_PROFILE_ENABLED:
+        try:
+            profile = await loop.run_in_executor(thread_pool, profile_csv, file.file)
+        except ValueError as e:
+            # Malformed CSVs are kept as files and left to the model
+            log_event(logger, logging.WARNING, 'csv_profile_failed', file=file.filename, error=str(e))
+        else:
+            return [profile_to_text(profile, file.filename)], {
+                'transport': 'csv_profile',
+                'rows': profile['rows'],
+                'columns': profile['columns'],
+            }
+
+    if mime_type.startswith('image/') and IMAGE_STAGE_ENABLED and fits_local_stage(file, IMAGE_STAGE_MAX_BYTES):
+        processed = await process_image(await read_upload(file), mime_type, file.filename)
+        return await image_parts(processed, file.filename), {'transport': 'image_stage', 'image': processed.info()}
+
+    # PDFs over the stage limit are sent whole, with the page selection as an instruction
+    selection = [pdf_pages_prompt(pages)] if mime_type == 'application/pdf' and pages else []
+    if file.size is not None and file.size > INLINE_MAX_FILE_SIZE:
+        check_file(file.size, mime_type, file.filename)
+        handle, upload_status = await file_store.get_or_upload(digest, file.file, mime_type, file.filename)
+        return [*selection, handle], {'transport': 'file_api', 'upload': upload_status}
+
+    return [*selection, inline_part(await read_upload(file), mime_type)], {'transport': 'inline'}
+
+def _handles_expire_at(parts: List[Any]) -> Optional[float]:
+    """When the first File API handle among the parts stops being usable"""
+    expiries = [handle_expires_at(part) - FILE_HANDLE_EXPIRY_MARGIN
+                for part in parts if not isinstance(part, (str, dict))]
+    return min(expiries) if expiries else None
+
+def document_history(document: Document) -> List[Dict]:
+    """Opening turns that put the prepared document in front of the conversation"""
+    return [
+        {'role': 'user', 'parts': [f"Answer the following questions about the file '{document.file_name}'.",
+                                   *document.parts]},
+        {'role': 'model', 'parts': [f"I have read '{document.file_name}'. What would you like to know?"]},
+    ]
+
+async def ask_document(document: Document, question: str, session_id: Optional[str] = None) -> Dict:
+    """Answer a question about a prepared document, continuing the conversation if any"""
+    session = await chat_sessions.get_or_create(session_id)
+    started = time.perf_counter()
+    async with session.lock:
+        try:
+            response = await model_client.send_chat(
+                document_history(document) + session.history, question,
+                system_instruction=session.system_instruction(),
+            )
+            answer = response.text
+        except TokenBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'document_question_failed', exc_info=True,
+                      document_id=document.id, error=str(e))
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error generating response with Gemini Flash 2.0: {str(e)}"
+            )
+        await chat_sessions.add_exchange(session, question, answer)
+    schedule_chat_compaction(session)
+    await document_store.add_question(document)
+
+    seconds = round(time.perf_counter() - started, 3)
+    log_event(logger, logging.INFO, 'document_question', document_id=document.id,
+              session_id=session.id, seconds=seconds, question=question)
+    return {
+        'success': True,
+        'document_id': document.id,
+        'session_id': session.id,
+        'text': answer,
+        'seconds': seconds,
+        'usage': usage_dict(),
+    }
+
+@app.post("/documents")
+async def register_document(file: UploadFile = File(...), pages: str = Form(None), prompt: str = Form(None)):
+    """Prepare a file once and return a document id for follow-up questions.
+
+    For PDFs, `pages` optionally restricts the document to page ranges like 1-5,8.
+    An optional `prompt` is answered right away as the first question.
+    """
+    validate_file(file)
+    mime_type = get_mime_type(file.filename)
+    if file.size is not None:
+        metrics.upload_size.labels(mime_type).observe(file.size)
+    digest = await asyncio.get_event_loop().run_in_executor(thread_pool, content_digest, file.file)
+    variant = document_variant(mime_type, pages)
+
+    # Registering the same content again reuses the prepared payload
+    document = await document_store.find(digest, variant)
+    reused = document is not None
+    if document is None:
+        try:
+            parts, info = await prepare_document_parts(file, mime_type, digest, pages)
+            # A document too large for the model could never be asked about
+            check_budget(estimate_tokens(parts), what=f"File '{file.filename}'")
+            document = await document_store.add(file.filename, mime_type, file.size, digest, variant, parts,
+                                                info, expires_at=_handles_expire_at(parts))
+        except HTTPException:
+            raise
+        except TokenBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'document_failed', exc_info=True, file=file.filename, error=str(e))
+            raise HTTPException(status_code=500, detail=f"Error preparing document: {str(e)}")
+    log_event(logger, logging.INFO, 'document_registered', file=file.filename,
+              document_id=document.id, reused=reused)
+
+    result = {'success': True, 'reused': reused, 'document': document.describe()}
+    if prompt:
+        result['answer'] = await ask_document(document, prompt)
+    return result
+
+async def _get_document(document_id: str) -> Document:
+    document = await document_store.get(document_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found or expired; register the file again")
+    return document
+
+@app.post("/documents/{document_id}/ask")
+async def ask_document_question(document_id: str, request: DocumentQuestion):
+    """Ask a question about a registered document; pass `session_id` for follow-ups"""
+    set_lane(LANE_INTERACTIVE)
+    return await ask_document(await _get_document(document_id), request.question, request.session_id)
+
+@app.get("/documents/{document_id}")
+async def get_document(document_id: str):
+    """Details of a registered document and its prepared payload"""
+    return (await _get_document(document_id)).describe()
+
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
+    """Drop a registered document and its prepared payload"""
+    if not await document_store.delete(document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"success": True, "document_id": document_id}
+
+async def _warm_up_then_probe():
+    """Warm the client, then start probing; the probe imports the SDK, so it never runs first"""
+    await model_client.warm_up()
+    start_health_probes()
+
+def start_health_probes():
+    if HEALTH_PROBE_INTERVAL > 0 and not health_prober.started:
+        health_prober.start()
+
+@app.on_event("startup")
+async def startup_event():
+    """Warm the Gemini client in the background and resume queued jobs"""
+    if GEMINI_WARMUP:
+        app.state.warmup_task = asyncio.ensure_future(_warm_up_then_probe())
+    await job_queue.start()
+
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Cleanup thread pool on shutdown"""
+    """Cleanup thread and process pools on shutdown"""
+    await health_prober.stop()
+    await job_queue.stop()
     thread_pool.shutdown(wait=True)
+    shutdown_process_pool()
+    shutdown_logging()
+
+@app.get("/health/live")
+async def liveness_check():
+    """Liveness: the process is up and the event loop responds; never calls upstream"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
 
 @app.get("/health")
-async def health_check():
-    """Health check endpoint"""
-    try:
-        # Test Gemini API connection
-        response = model.generate_content("Test connection")
-        return {
-            "status": "healthy",
-            "gemini_api": "connected",
-            "timestamp": pd.Timestamp.now().isoformat()
-        }
-    except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
-        raise HTTPException(
-            status_code=503,
-            detail=f"Service unhealthy: {str(e)}"
-        )
+@app.get("/health/ready")
+async def readiness_check():
+    """Readiness: cached upstream status plus local saturation; 503 when traffic should go elsewhere"""
+    upstream = health_prober.snapshot()
+    saturation = {
+        "thread_pool_queue_depth": thread_pool.queue_depth,
+        "thread_pool_active_workers": thread_pool.active,
+        "upstream_in_flight": model_client.in_flight,
+        "upstream_max_concurrency": model_client.max_concurrency,
+        "upstream_queued": model_client.scheduler.queue_depth,
+        "admission_queued": admission.queue_depth,
+        "http_requests_in_flight": metrics.http_in_flight.labels().value,
+    }
+    reasons = saturation_reasons(thread_pool.queue_depth, model_client.in_flight, model_client.max_concurrency)
+    if HEALTH_PROBE_INTERVAL > 0 and not health_prober.healthy:
+        reasons["gemini_api"] = upstream["error"] or ("stale status" if upstream["checked_at"] else "not checked yet")
+
+    ready = not reasons
+    body = {
+        "status": "healthy" if ready else "unhealthy",
+        "gemini_api": "connected" if health_prober.healthy else upstream["status"],
+        "upstream": upstream,
+        "saturation": saturation,
+        "reasons": reasons,
+        "model_client": model_client.stats(),
+        "admission": admission.stats(),
+        "chat_sessions": chat_sessions.stats(),
+        "documents": document_store.stats(),
+        "jobs": job_queue.stats(),
+        "worker": {"pid": os.getpid(), "workers": WORKERS},
+        "timestamp": datetime.now().isoformat()
+    }
+    if not ready:
+        log_event(logger, logging.INFO, 'not_ready', reasons=reasons)
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics"""
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/usage")
+async def usage_endpoint():
+    """Token usage per route since this worker started, most expensive first"""
+    return {"pid": os.getpid(), "routes": ledger.top()}
 
 @app.get("/test-connection")
 async def test_connection():
     """Test endpoint to verify connection from extension"""
-    print("\n=== TEST CONNECTION REQUEST RECEIVED ===", flush=True)
-    logger.info("=== TEST CONNECTION REQUEST RECEIVED ===")
+    log_event(logger, logging.INFO, 'test_connection')
     return {"status": "connected", "message": "Backend is reachable"}
 
 if __name__ == '__main__':
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5001) 
\ No newline at end of file
+    # One process, or WORKERS forked processes sharing the port
+    serve(app, host="0.0.0.0", port=5001) 
\ No newline at end of file
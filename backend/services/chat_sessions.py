@@ -0,0 +1,237 @@
+"""Server-side chat sessions for /api/chat.
+
+Each session keeps its system prompt and the turn history in memory, so the
+extension only posts the new message and its session id. Sessions are held
+in an LRU with a TTL. When the history grows past the token budget, the
+oldest turns are either dropped (``truncate``) or folded into a running
+summary by the model (``summarize``); the most recent turns are always kept
+verbatim.
+
+With several worker processes, sessions are also stored in the node's
+``SharedState`` so a follow-up turn finds its history on any worker. Each
+save bumps the session version and only applies to the version it was made
+from; a turn that lost the race to another worker is added after that
+worker's turn instead of overwriting it.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from services.shared_state import SharedState
+from services.token_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Sessions kept (by all workers together); the least recently used one is dropped first
+CHAT_SESSION_MAX = int(os.getenv('CHAT_SESSION_MAX', '1000'))
+# Seconds of inactivity after which a session expires
+CHAT_SESSION_TTL = int(os.getenv('CHAT_SESSION_TTL', '3600'))
+# Estimated tokens of history sent with each turn before old turns are compacted
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', '8000'))
+# `truncate` drops old turns, `summarize` folds them into a summary
+CHAT_HISTORY_POLICY = os.getenv('CHAT_HISTORY_POLICY', 'summarize')
+# Most recent exchanges (user + model turn) that are never compacted
+CHAT_KEEP_RECENT_EXCHANGES = max(1, int(os.getenv('CHAT_KEEP_RECENT_EXCHANGES', '4')))
+
+POLICY_TRUNCATE = 'truncate'
+POLICY_SUMMARIZE = 'summarize'
+
+
+@dataclass
+class ChatSession:
+    """History and settings of one conversation"""
+    id: str
+    system_prompt: Optional[str] = None
+    history: List[Dict] = field(default_factory=list)
+    summary: str = ''
+    turns: int = 0
+    compactions: int = 0
+    last_used: float = field(default_factory=time.time)
+    version: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    @property
+    def history_tokens(self) -> int:
+        return sum(estimate_tokens(part) for turn in self.history for part in turn['parts'])
+
+    def system_instruction(self) -> Optional[str]:
+        """System prompt plus the summary of compacted turns"""
+        if not self.summary:
+            return self.system_prompt
+        summary = f"Summary of the earlier conversation:\n{self.summary}"
+        return f"{self.system_prompt}\n\n{summary}" if self.system_prompt else summary
+
+    def add_exchange(self, message: str, answer: str) -> None:
+        self.history.append({'role': 'user', 'parts': [message]})
+        self.history.append({'role': 'model', 'parts': [answer]})
+        self.turns += 1
+
+    def record(self) -> Dict:
+        """What is stored for the session in ``SharedState``"""
+        return {
+            'system_prompt': self.system_prompt,
+            'history': self.history,
+            'summary': self.summary,
+            'turns': self.turns,
+            'compactions': self.compactions,
+            'last_used': self.last_used,
+            'version': self.version,
+        }
+
+    def load(self, record: Dict) -> None:
+        for name, value in record.items():
+            setattr(self, name, value)
+
+    def info(self) -> Dict:
+        return {
+            'session_id': self.id,
+            'turns': self.turns,
+            'history_messages': len(self.history),
+            'history_tokens': self.history_tokens,
+            'summarized': bool(self.summary),
+            'compactions': self.compactions,
+        }
+
+
+def _format_turns(turns: List[Dict]) -> str:
+    return '\n'.join(f"{turn['role'].capitalize()}: {' '.join(turn['parts'])}" for turn in turns)
+
+
+class ChatSessionStore:
+    """LRU of chat sessions with a TTL and a history token budget, shared by the workers if ``shared_state`` is set"""
+
+    def __init__(self, max_sessions: int = CHAT_SESSION_MAX, ttl: int = CHAT_SESSION_TTL,
+                 token_budget: int = CHAT_HISTORY_TOKEN_BUDGET, policy: str = CHAT_HISTORY_POLICY,
+                 keep_recent: int = CHAT_KEEP_RECENT_EXCHANGES, shared_state: Optional[SharedState] = None):
+        if policy not in (POLICY_TRUNCATE, POLICY_SUMMARIZE):
+            raise ValueError(f"Unknown chat history policy '{policy}'")
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.policy = policy
+        self.keep_recent = keep_recent
+        self.shared_state = shared_state
+        # With shared state, this worker's copies of the sessions (each with its lock)
+        self._sessions: 'OrderedDict[str, ChatSession]' = OrderedDict()
+
+    async def _shared(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def _keep(self, session: ChatSession) -> None:
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    async def _save(self, session: ChatSession) -> bool:
+        """Store the session; False if another worker saved a newer version first"""
+        session.version += 1
+        session.last_used = time.time()
+        if self.shared_state is None:
+            return True
+        if await self._shared(self.shared_state.put_session, session.id, session.record(),
+                              self.max_sessions, self.ttl):
+            return True
+        session.version -= 1
+        return False
+
+    async def _reload(self, session: ChatSession) -> bool:
+        """Replace the session with the version stored by the workers; False if it is gone"""
+        record = await self._shared(self.shared_state.get_session, session.id, self.ttl)
+        if record is None:
+            self._sessions.pop(session.id, None)
+            return False
+        if record['version'] > session.version:
+            session.load(record)
+        return True
+
+    async def get(self, session_id: Optional[str]) -> Optional[ChatSession]:
+        """Return a live session and mark it as recently used"""
+        if not session_id:
+            return None
+        session = self._sessions.get(session_id)
+        if self.shared_state is not None:
+            if session is None:
+                session = ChatSession(id=session_id)
+            if not await self._reload(session):
+                return None
+        elif session is None:
+            return None
+        elif time.time() - session.last_used > self.ttl:
+            del self._sessions[session_id]
+            return None
+        session.last_used = time.time()
+        self._keep(session)
+        return session
+
+    async def get_or_create(self, session_id: Optional[str], system_prompt: Optional[str] = None) -> ChatSession:
+        """Continue a session, or start a new one if the id is unknown or expired.
+
+        A new ``system_prompt`` replaces the stored one; ``None`` keeps it.
+        """
+        session = await self.get(session_id)
+        if session is None:
+            session = ChatSession(id=uuid.uuid4().hex, system_prompt=system_prompt)
+            self._keep(session)
+            await self._save(session)
+        elif system_prompt is not None and system_prompt != session.system_prompt:
+            async with session.lock:
+                session.system_prompt = system_prompt
+                while not await self._save(session) and await self._reload(session):
+                    session.system_prompt = system_prompt
+        return session
+
+    async def add_exchange(self, session: ChatSession, message: str, answer: str) -> None:
+        """Add a turn to the session and store it (call with ``session.lock`` held)"""
+        session.add_exchange(message, answer)
+        # Another worker answered a turn of this session meanwhile: add this one after it
+        while not await self._save(session) and await self._reload(session):
+            session.add_exchange(message, answer)
+
+    async def delete(self, session_id: str) -> bool:
+        deleted = self._sessions.pop(session_id, None) is not None
+        if self.shared_state is not None:
+            deleted = await self._shared(self.shared_state.delete_session, session_id)
+        return deleted
+
+    async def compact(self, session: ChatSession,
+                      summarize: Optional[Callable[[str], Awaitable[str]]] = None) -> None:
+        """Bring the history back under the token budget (call with ``session.lock`` held)"""
+        keep = 2 * self.keep_recent
+        if session.history_tokens <= self.token_budget or len(session.history) <= keep:
+            return
+
+        # Compact everything but the most recent exchanges, keeping user/model pairs together
+        old, recent = session.history[:-keep], session.history[-keep:]
+        if self.policy == POLICY_SUMMARIZE and summarize is not None:
+            earlier = f"Previous summary:\n{session.summary}\n\n" if session.summary else ''
+            try:
+                session.summary = await summarize(
+                    f"{earlier}Conversation:\n{_format_turns(old)}"
+                )
+            except Exception as e:
+                # Dropping the turns still keeps the next request within budget
+                logger.warning(f"Could not summarise chat session {session.id}, truncating: {e}")
+        session.history = recent
+        session.compactions += 1
+        if not await self._save(session):
+            # A turn on another worker came first; the next turn compacts again if needed
+            await self._reload(session)
+            logger.info(f"Dropped the compaction of chat session {session.id} for a newer turn")
+            return
+        logger.info(f"Compacted chat session {session.id}: {session.info()}")
+
+    def stats(self) -> Dict:
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'ttl': self.ttl,
+            'token_budget': self.token_budget,
+            'policy': self.policy,
+            'shared': self.shared_state is not None,
+        }
@@ -0,0 +1,245 @@
+"""Local profiling fast path for CSV uploads.
+
+Instead of shipping a raw CSV upstream, the file is read locally in chunks and
+reduced to a compact profile: schema and dtypes, null counts, descriptive
+statistics, top-k categories and a small stratified sample. Only the profile
+(a few KB) goes to Gemini, so CSVs of any size can be analysed.
+
+The pyarrow streaming reader is used when pyarrow is installed; otherwise
+pandas' C parser reads the file in chunks. pandas, numpy and pyarrow are
+imported on the first profile so they don't slow down app startup.
+"""
+import json
+import logging
+import math
+import os
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, List, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to send CSV files upstream unchanged
+CSV_PROFILE_ENABLED = os.getenv('CSV_PROFILE_ENABLED', '1') == '1'
+# Rows per chunk when reading with pandas
+CSV_PROFILE_CHUNK_ROWS = int(os.getenv('CSV_PROFILE_CHUNK_ROWS', '100000'))
+# Most frequent values reported per categorical column
+CSV_PROFILE_TOP_K = int(os.getenv('CSV_PROFILE_TOP_K', '5'))
+# Rows included in the stratified sample
+CSV_PROFILE_SAMPLE_ROWS = int(os.getenv('CSV_PROFILE_SAMPLE_ROWS', '20'))
+
+# Rows kept in the uniform reservoir used for quantiles and the sample
+RESERVOIR_ROWS = 10000
+# Distinct values tracked per column before counts become approximate
+MAX_TRACKED_VALUES = 10000
+# Columns with at most this many distinct values can stratify the sample
+MAX_STRATA = 20
+# Longest string value kept in the profile
+MAX_VALUE_LENGTH = 80
+
+
+class _ColumnStats:
+    """Running statistics for one column, merged chunk by chunk"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.dtype: Optional[str] = None
+        self.mixed_dtypes = False
+        self.nulls = 0
+        # Numeric moments (Chan et al. parallel variance)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min: Any = None
+        self.max: Any = None
+        # Value counts for categorical columns
+        self.values: Counter = Counter()
+        self.values_approximate = False
+
+    @property
+    def numeric(self) -> bool:
+        return self.dtype is not None and (self.dtype.startswith(('int', 'float', 'uint', 'Int', 'Float')))
+
+    def update(self, series: 'pd.Series') -> None:
+        import pandas as pd
+
+        dtype = str(series.dtype)
+        if self.dtype is None:
+            self.dtype = dtype
+        elif dtype != self.dtype and not series.isna().all():
+            if self.numeric and pd.api.types.is_numeric_dtype(series):
+                # int chunks and float chunks (e.g. with nulls) are the same column
+                if 'float' in dtype.lower():
+                    self.dtype = dtype
+            else:
+                self.mixed_dtypes = True
+
+        self.nulls += int(series.isna().sum())
+        values = series.dropna()
+        if values.empty:
+            return
+
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.astype('float64')
+            n_b = len(values)
+            mean_b = float(values.mean())
+            m2_b = float(((values - mean_b) ** 2).sum())
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            self.mean += delta * n_b / n
+            self.m2 += m2_b + delta ** 2 * self.count * n_b / n
+            self.count = n
+            low, high = float(values.min()), float(values.max())
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+        else:
+            self.values.update(values.astype(str).str.slice(0, MAX_VALUE_LENGTH).value_counts().to_dict())
+            if len(self.values) > MAX_TRACKED_VALUES:
+                # Keep the heavy hitters only; counts of rare values become lower bounds
+                self.values = Counter(dict(self.values.most_common(MAX_TRACKED_VALUES // 2)))
+                self.values_approximate = True
+
+    def summary(self, rows: int, reservoir: 'pd.DataFrame') -> Dict:
+        import pandas as pd
+
+        summary: Dict[str, Any] = {
+            'name': self.name,
+            'dtype': self.dtype if not self.mixed_dtypes else f"mixed ({self.dtype})",
+            'nulls': self.nulls,
+            'null_pct': round(100.0 * self.nulls / rows, 2) if rows else 0.0,
+        }
+        if self.count:
+            summary.update({
+                'mean': _round(self.mean),
+                'std': _round(math.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else 0.0,
+                'min': _round(self.min),
+                'max': _round(self.max),
+            })
+            sample = pd.to_numeric(reservoir[self.name], errors='coerce').dropna()
+            if not sample.empty:
+                for label, value in zip(('p25', 'p50', 'p75'), sample.quantile([0.25, 0.5, 0.75])):
+                    summary[label] = _round(value)
+        elif self.values:
+            distinct = len(self.values)
+            summary['distinct'] = f">{distinct}" if self.values_approximate else distinct
+            summary['top'] = [[value, count] for value, count in self.values.most_common(CSV_PROFILE_TOP_K)]
+        return summary
+
+
+def _round(value: Any) -> Any:
+    if isinstance(value, float):
+        return float(f"{value:.6g}") if math.isfinite(value) else str(value)
+    return value
+
+
+def _pyarrow_csv():
+    try:
+        import pyarrow.csv as pa_csv
+    except ImportError:  # pyarrow is optional
+        return None
+    return pa_csv
+
+
+def _iter_chunks(fileobj: BinaryIO, chunk_rows: int):
+    """Yield DataFrame chunks, using pyarrow's streaming reader when available"""
+    import pandas as pd
+
+    fileobj.seek(0)
+    pa_csv = _pyarrow_csv()
+    if pa_csv is not None:
+        reader = pa_csv.open_csv(fileobj)
+        for batch in reader:
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(fileobj, chunksize=chunk_rows, low_memory=False)
+
+
+def _update_reservoir(reservoir: Optional['pd.DataFrame'], chunk: 'pd.DataFrame',
+                      rng: 'np.random.Generator') -> 'pd.DataFrame':
+    """Keep a uniform random sample of rows by retaining the smallest random keys"""
+    import pandas as pd
+
+    chunk = chunk.assign(_reservoir_key=rng.random(len(chunk)))
+    combined = chunk if reservoir is None else pd.concat([reservoir, chunk], ignore_index=True)
+    return combined.nsmallest(RESERVOIR_ROWS, '_reservoir_key')
+
+
+def _stratified_sample(reservoir: 'pd.DataFrame', columns: List[_ColumnStats],
+                       sample_rows: int, rng: 'np.random.Generator') -> Dict:
+    """Pick sample rows proportionally to the strata of the lowest-cardinality column"""
+    import pandas as pd
+
+    candidates = [c for c in columns if c.values and not c.values_approximate and 2 <= len(c.values) <= MAX_STRATA]
+    strata_column = min(candidates, key=lambda c: len(c.values)).name if candidates else None
+
+    if reservoir.empty:
+        sample = reservoir
+    elif strata_column is None:
+        sample = reservoir.head(sample_rows)
+    else:
+        groups = reservoir.groupby(reservoir[strata_column].astype(str), dropna=False)
+        picked = []
+        for _, group in groups:
+            share = max(1, round(sample_rows * len(group) / len(reservoir)))
+            picked.append(group.sample(n=min(share, len(group)), random_state=rng.integers(1 << 31)))
+        sample = pd.concat(picked).head(max(sample_rows, len(picked)))
+
+    sample = sample.drop(columns='_reservoir_key', errors='ignore')
+    records = json.loads(sample.to_json(orient='records', date_format='iso', default_handler=str))
+    for record in records:
+        for key, value in record.items():
+            if isinstance(value, str) and len(value) > MAX_VALUE_LENGTH:
+                record[key] = value[:MAX_VALUE_LENGTH] + '...'
+    return {'stratified_by': strata_column, 'rows': records}
+
+
+def profile_csv(fileobj: BinaryIO, chunk_rows: int = CSV_PROFILE_CHUNK_ROWS,
+                sample_rows: int = CSV_PROFILE_SAMPLE_ROWS, seed: int = 0) -> Dict:
+    """Profile a CSV file in a single streaming pass (blocking; run in an executor)"""
+    import numpy as np
+    import pandas as pd
+
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    columns: Dict[str, _ColumnStats] = {}
+    reservoir: Optional[pd.DataFrame] = None
+    rows = 0
+
+    for chunk in _iter_chunks(fileobj, chunk_rows):
+        rows += len(chunk)
+        for name in chunk.columns:
+            columns.setdefault(name, _ColumnStats(str(name))).update(chunk[name])
+        reservoir = _update_reservoir(reservoir, chunk, rng)
+    fileobj.seek(0)
+
+    if reservoir is None:
+        reservoir = pd.DataFrame()
+    stats = list(columns.values())
+    return {
+        'rows': rows,
+        'columns': len(stats),
+        'engine': 'pyarrow' if _pyarrow_csv() is not None else 'pandas',
+        'schema': [column.summary(rows, reservoir) for column in stats],
+        'sample': _stratified_sample(reservoir, stats, sample_rows, rng),
+        'profile_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def csv_cache_variant() -> str:
+    """Profile settings that change what the model sees for the same CSV"""
+    return (f"csv_profile={CSV_PROFILE_SAMPLE_ROWS}:{CSV_PROFILE_TOP_K}:"
+            f"{MAX_VALUE_LENGTH}:{MAX_STRATA}:{RESERVOIR_ROWS}")
+
+
+def profile_to_text(profile: Dict, file_name: str) -> str:
+    """Render a profile as the compact text sent upstream"""
+    return (
+        f"The CSV file '{file_name}' was profiled locally instead of being uploaded. "
+        f"It has {profile['rows']} rows and {profile['columns']} columns. "
+        f"Per-column statistics and a stratified sample of rows follow as JSON.\n\n"
+        f"{json.dumps(profile, separators=(',', ':'), default=str)}"
+    )
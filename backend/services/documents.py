@@ -0,0 +1,250 @@
+"""Document sessions: prepare an upload once, then ask it several questions.
+
+Registering a file runs the same stages as ``/process_file`` (PDF text
+layer, CSV profile, image downscaling, File API upload for big files) and
+keeps the resulting request parts under a document id. Follow-up questions
+only send the question together with the prepared parts, so they cost about
+as much as a plain chat turn. Prepared payloads are held in an LRU bounded
+by total size and document count, and expire after a TTL that stays below
+the lifetime of File API handles.
+
+With several worker processes, documents are also stored in the node's
+``SharedState`` (File API handles by name) so a question can be asked on any
+worker; each worker keeps the documents it used recently in memory.
+"""
+import asyncio
+import base64
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from services.shared_state import SharedState
+
+logger = logging.getLogger(__name__)
+
+# Total size of the prepared payloads kept in memory, in bytes
+DOCUMENT_STORE_MAX_BYTES = int(os.getenv('DOCUMENT_STORE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Documents kept at most, whatever their size
+DOCUMENT_STORE_MAX_DOCUMENTS = int(os.getenv('DOCUMENT_STORE_MAX_DOCUMENTS', '500'))
+# Seconds of inactivity after which a document is dropped
+DOCUMENT_TTL = int(os.getenv('DOCUMENT_TTL', str(12 * 60 * 60)))
+
+
+def part_size(part: Any) -> int:
+    """Bytes a request part holds in memory (File API handles only hold a reference)"""
+    if isinstance(part, str):
+        return len(part.encode('utf-8'))
+    if isinstance(part, dict):
+        return len(part.get('data') or b'')
+    return 0
+
+
+def encode_part(part: Any) -> Dict:
+    """JSON form of a request part; File API handles are stored by name"""
+    if isinstance(part, str):
+        return {'text': part}
+    if isinstance(part, dict):
+        return {'mime_type': part['mime_type'], 'data': base64.b64encode(part['data']).decode('ascii')}
+    return {'file': part.name}
+
+
+@dataclass
+class Document:
+    """A registered upload and the request parts prepared for it"""
+    id: str
+    file_name: str
+    mime_type: str
+    size: int
+    digest: str
+    variant: str
+    parts: List[Any]
+    info: Dict = field(default_factory=dict)
+    expires_at: Optional[float] = None
+    questions: int = 0
+    created: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+
+    @property
+    def payload_size(self) -> int:
+        return sum(part_size(part) for part in self.parts)
+
+    def describe(self) -> Dict:
+        return {
+            'document_id': self.id,
+            'file_name': self.file_name,
+            'mime_type': self.mime_type,
+            'size': self.size,
+            'payload_size': self.payload_size,
+            'questions': self.questions,
+            **self.info,
+        }
+
+    def record(self) -> Dict:
+        """What is stored for the document in ``SharedState``"""
+        return {
+            'file_name': self.file_name,
+            'mime_type': self.mime_type,
+            'size': self.size,
+            'digest': self.digest,
+            'variant': self.variant,
+            'parts': [encode_part(part) for part in self.parts],
+            'info': self.info,
+            'expires_at': self.expires_at,
+            'created': self.created,
+        }
+
+
+class DocumentStore:
+    """LRU of prepared documents bounded by payload bytes and count, shared by the workers if ``shared_state`` is set
+
+    ``resolve_handle`` turns the name of a File API handle stored by another
+    worker back into a handle.
+    """
+
+    def __init__(self, max_bytes: int = DOCUMENT_STORE_MAX_BYTES,
+                 max_documents: int = DOCUMENT_STORE_MAX_DOCUMENTS, ttl: int = DOCUMENT_TTL,
+                 shared_state: Optional[SharedState] = None,
+                 resolve_handle: Optional[Callable[[str], Awaitable[Any]]] = None):
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.ttl = ttl
+        self.shared_state = shared_state
+        self.resolve_handle = resolve_handle
+        self.bytes = 0
+        self.evictions = 0
+        # With shared state, this worker's copies of the documents
+        self._documents: 'OrderedDict[str, Document]' = OrderedDict()
+        # The same content registered with the same options maps to one document
+        self._by_content: Dict[str, str] = {}
+
+    async def _shared(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def _expired(self, document: Document, now: float) -> bool:
+        if now - document.last_used > self.ttl:
+            return True
+        return document.expires_at is not None and now >= document.expires_at
+
+    async def _decode(self, document_id: str, record: Dict) -> Document:
+        parts = []
+        for part in record['parts']:
+            if 'text' in part:
+                parts.append(part['text'])
+            elif 'file' in part:
+                parts.append(await self.resolve_handle(part['file']))
+            else:
+                parts.append({'mime_type': part['mime_type'], 'data': base64.b64decode(part['data'])})
+        return Document(document_id, record['file_name'], record['mime_type'], record['size'],
+                        record['digest'], record['variant'], parts, record['info'],
+                        record['expires_at'], created=record['created'])
+
+    async def _get_shared(self, document_id: str) -> Optional[Document]:
+        document = self._documents.get(document_id)
+        record = await self._shared(self.shared_state.get_document, document_id, self.ttl, document is None)
+        if record is None:
+            self._remove(document_id)
+            return None
+        if document is None:
+            try:
+                document = await self._decode(document_id, record['data'])
+            except Exception as e:
+                logger.warning(f"Shared document {document_id} is not usable: {e}")
+                return None
+            self._keep(document)
+        document.questions = record['questions']
+        return document
+
+    async def get(self, document_id: str) -> Optional[Document]:
+        """Return a live document and mark it as recently used"""
+        if self.shared_state is not None:
+            # Expiry is checked against the use by every worker
+            document = await self._get_shared(document_id)
+        else:
+            document = self._documents.get(document_id)
+            if document is not None and self._expired(document, time.time()):
+                self._remove(document_id)
+                return None
+        if document is None:
+            return None
+        document.last_used = time.time()
+        self._documents.move_to_end(document_id)
+        return document
+
+    async def find(self, digest: str, variant: str) -> Optional[Document]:
+        """Document already prepared from the same content and options"""
+        if self.shared_state is not None:
+            document_id = await self._shared(self.shared_state.find_document, f"{digest}:{variant}")
+        else:
+            document_id = self._by_content.get(f"{digest}:{variant}")
+        return await self.get(document_id) if document_id else None
+
+    async def add(self, file_name: str, mime_type: str, size: int, digest: str, variant: str,
+                  parts: List[Any], info: Optional[Dict] = None,
+                  expires_at: Optional[float] = None) -> Document:
+        document = Document(uuid.uuid4().hex, file_name, mime_type, size, digest, variant, parts,
+                            info or {}, expires_at)
+        payload_size = document.payload_size
+        if payload_size > self.max_bytes:
+            raise ValueError(f"Prepared payload of {payload_size} bytes exceeds the document store "
+                             f"limit of {self.max_bytes} bytes")
+
+        if self.shared_state is not None:
+            self.evictions += await self._shared(
+                self.shared_state.put_document, document.id, f"{digest}:{variant}", document.record(),
+                payload_size, expires_at, self.max_bytes, self.max_documents, self.ttl
+            )
+        self._keep(document)
+        return document
+
+    def _keep(self, document: Document) -> None:
+        """Hold the document in memory, dropping the least recently used ones over the limits"""
+        previous = self._by_content.get(f"{document.digest}:{document.variant}")
+        if previous is not None:
+            self._remove(previous)
+        self._documents[document.id] = document
+        self._by_content[f"{document.digest}:{document.variant}"] = document.id
+        self.bytes += document.payload_size
+
+        while self.bytes > self.max_bytes or len(self._documents) > self.max_documents:
+            oldest = next(iter(self._documents))
+            self._remove(oldest)
+            if self.shared_state is None:
+                self.evictions += 1
+                logger.info(f"Evicted document {oldest} from the document store")
+
+    def _remove(self, document_id: str) -> Optional[Document]:
+        document = self._documents.pop(document_id, None)
+        if document is not None:
+            self.bytes -= document.payload_size
+            key = f"{document.digest}:{document.variant}"
+            if self._by_content.get(key) == document_id:
+                del self._by_content[key]
+        return document
+
+    async def add_question(self, document: Document) -> None:
+        """Count a question asked about the document"""
+        document.questions += 1
+        if self.shared_state is not None:
+            questions = await self._shared(self.shared_state.add_question, document.id)
+            if questions is not None:
+                document.questions = questions
+
+    async def delete(self, document_id: str) -> bool:
+        deleted = self._remove(document_id) is not None
+        if self.shared_state is not None:
+            deleted = await self._shared(self.shared_state.delete_document, document_id)
+        return deleted
+
+    def stats(self) -> Dict:
+        return {
+            'documents': len(self._documents),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'max_documents': self.max_documents,
+            'evictions': self.evictions,
+            'shared': self.shared_state is not None,
+        }
@@ -0,0 +1,179 @@
+"""Large-file mode: upload files through the Gemini File API and reuse the handles.
+
+Inline requests are limited in size, so files above ``INLINE_MAX_FILE_SIZE``
+are uploaded with the resumable File API instead and referenced by handle in
+the model request. Handles are cached by content hash until shortly before
+they expire, so re-analysing the same file with a new prompt skips the upload.
+With several worker processes, handles are also indexed in the node's
+``SharedState`` so a file uploaded by one worker is reused by the others.
+
+The uploader is injectable; tests and benchmarks pass a local stand-in that
+implements ``upload`` and ``get``.
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+from services.model_client import get_genai
+from services.shared_state import SharedState
+
+logger = logging.getLogger(__name__)
+
+# Files larger than this are sent through the File API instead of inline
+INLINE_MAX_FILE_SIZE = int(os.getenv('INLINE_MAX_FILE_SIZE', str(10 * 1024 * 1024)))
+# Seconds before the upstream expiry at which a cached handle is no longer used
+FILE_HANDLE_EXPIRY_MARGIN = int(os.getenv('FILE_HANDLE_EXPIRY_MARGIN', '600'))
+# Seconds to wait for an uploaded file (e.g. a video) to finish processing
+FILE_PROCESSING_TIMEOUT = int(os.getenv('FILE_PROCESSING_TIMEOUT', '300'))
+
+# Handles are kept for 48 hours upstream when no expiry is reported
+DEFAULT_HANDLE_LIFETIME = 48 * 60 * 60
+
+# Upload statuses reported to callers
+HANDLE_CACHED = 'cached'
+HANDLE_COALESCED = 'coalesced'
+HANDLE_UPLOADED = 'uploaded'
+
+
+class GeminiFileUploader:
+    """Uploads files with the Gemini File API (resumable protocol)"""
+
+    def upload(self, fileobj: BinaryIO, mime_type: str, display_name: str) -> Any:
+        if not isinstance(fileobj, io.IOBase):
+            # SpooledTemporaryFile only subclasses IOBase from Python 3.11 on
+            fileobj = getattr(fileobj, '_file', fileobj)
+        return get_genai().upload_file(fileobj, mime_type=mime_type, display_name=display_name, resumable=True)
+
+    def get(self, name: str) -> Any:
+        return get_genai().get_file(name)
+
+
+def _state_name(handle: Any) -> str:
+    state = getattr(handle, 'state', None)
+    return getattr(state, 'name', str(state or 'ACTIVE'))
+
+
+def handle_expires_at(handle: Any) -> float:
+    """Time at which an uploaded file is deleted upstream"""
+    expiration = getattr(handle, 'expiration_time', None)
+    if isinstance(expiration, datetime):
+        return expiration.timestamp()
+    return time.time() + DEFAULT_HANDLE_LIFETIME
+
+
+class FileStore:
+    """Content-addressed cache of uploaded file handles"""
+
+    def __init__(self, uploader: Optional[Any] = None, executor=None,
+                 expiry_margin: int = FILE_HANDLE_EXPIRY_MARGIN,
+                 processing_timeout: int = FILE_PROCESSING_TIMEOUT,
+                 poll_interval: float = 2.0, shared_state: Optional[SharedState] = None):
+        self.uploader = uploader if uploader is not None else GeminiFileUploader()
+        self.executor = executor
+        self.expiry_margin = expiry_margin
+        self.processing_timeout = processing_timeout
+        self.poll_interval = poll_interval
+        self.shared_state = shared_state
+        self._handles: Dict[str, Tuple[float, Any]] = {}
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    def _cached(self, key: str) -> Optional[Any]:
+        entry = self._handles.get(key)
+        if entry is None:
+            return None
+        expires_at, handle = entry
+        if time.time() >= expires_at - self.expiry_margin:
+            del self._handles[key]
+            return None
+        return handle
+
+    async def _shared_handle(self, key: str) -> Optional[Any]:
+        """Handle uploaded by another worker process, if it is still usable"""
+        entry = self.shared_state.get_handle(key)
+        if entry is None:
+            return None
+        name, expires_at = entry
+        if time.time() >= expires_at - self.expiry_margin:
+            return None
+        try:
+            handle = await asyncio.get_event_loop().run_in_executor(self.executor, self.uploader.get, name)
+        except Exception as e:
+            logger.warning(f"Shared file handle {name} is not usable: {e}")
+            return None
+        if _state_name(handle) != 'ACTIVE':
+            return None
+        self._handles[key] = (expires_at, handle)
+        return handle
+
+    async def resolve(self, name: str) -> Any:
+        """Handle of a file uploaded earlier, by its File API name"""
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.uploader.get, name)
+
+    async def _upload(self, fileobj: BinaryIO, mime_type: str, display_name: str) -> Any:
+        loop = asyncio.get_event_loop()
+
+        def _upload_from_start():
+            fileobj.seek(0)
+            return self.uploader.upload(fileobj, mime_type, display_name)
+
+        started = time.perf_counter()
+        handle = await loop.run_in_executor(self.executor, _upload_from_start)
+        logger.info(f"Uploaded {display_name} to the File API as {handle.name} "
+                    f"in {time.perf_counter() - started:.2f}s")
+
+        # Audio and video need server-side processing before they can be used
+        deadline = time.monotonic() + self.processing_timeout
+        while _state_name(handle) == 'PROCESSING':
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"File {handle.name} was still processing after {self.processing_timeout}s")
+            await asyncio.sleep(self.poll_interval)
+            handle = await loop.run_in_executor(self.executor, self.uploader.get, handle.name)
+
+        if _state_name(handle) == 'FAILED':
+            raise ValueError(f"File API failed to process {display_name}")
+        return handle
+
+    async def get_or_upload(self, digest: str, fileobj: BinaryIO, mime_type: str,
+                            display_name: str) -> Tuple[Any, str]:
+        """Return a usable handle for the content, uploading it only if needed"""
+        key = f"{digest}:{mime_type}"
+        handle = self._cached(key)
+        if handle is not None:
+            logger.info(f"File handle cache hit for {display_name}: {handle.name}")
+            return handle, HANDLE_CACHED
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            handle, _ = await asyncio.shield(task)
+            return handle, HANDLE_COALESCED
+
+        async def _upload_and_store() -> Tuple[Any, str]:
+            if self.shared_state is not None:
+                shared = await self._shared_handle(key)
+                if shared is not None:
+                    logger.info(f"Shared file handle hit for {display_name}: {shared.name}")
+                    return shared, HANDLE_CACHED
+            uploaded = await self._upload(fileobj, mime_type, display_name)
+            expires_at = handle_expires_at(uploaded)
+            self._handles[key] = (expires_at, uploaded)
+            if self.shared_state is not None:
+                self.shared_state.put_handle(key, uploaded.name, expires_at)
+            return uploaded, HANDLE_UPLOADED
+
+        task = asyncio.ensure_future(_upload_and_store())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        """Current handle cache usage, for logging and monitoring"""
+        return {
+            'cached_handles': len(self._handles),
+            'uploads_in_flight': len(self._in_flight),
+            'inline_max_file_size': INLINE_MAX_FILE_SIZE,
+            'shared_handles': self.shared_state is not None,
+        }
@@ -0,0 +1,127 @@
+"""Cached upstream health probing for liveness and readiness checks.
+
+A background task probes the Gemini API on an interval and keeps the last
+result, so health endpoints answer from memory instead of calling upstream
+on every load balancer probe. Readiness also takes local saturation into
+account so the balancer can shed load before latency spikes.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds between upstream probes
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', '30'))
+# Seconds before a probe counts as failed
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', '10'))
+# Readiness fails when the last successful probe is older than this
+HEALTH_MAX_STALENESS = float(os.getenv('HEALTH_MAX_STALENESS', '120'))
+# Readiness fails when more work items than this wait for the thread pool
+READINESS_MAX_QUEUE_DEPTH = int(os.getenv('READINESS_MAX_QUEUE_DEPTH', '16'))
+# Readiness fails when this fraction of the upstream concurrency limit is in use
+READINESS_MAX_UPSTREAM_UTILIZATION = float(os.getenv('READINESS_MAX_UPSTREAM_UTILIZATION', '0.9'))
+
+# Upstream statuses
+UPSTREAM_UNKNOWN = 'unknown'
+UPSTREAM_UP = 'up'
+UPSTREAM_DOWN = 'down'
+
+
+class HealthProber:
+    """Probes upstream in the background and serves the cached result"""
+
+    def __init__(self, probe: Callable[[], Awaitable[Any]],
+                 interval: float = HEALTH_PROBE_INTERVAL,
+                 timeout: float = HEALTH_PROBE_TIMEOUT,
+                 max_staleness: float = HEALTH_MAX_STALENESS):
+        self.probe = probe
+        self.interval = interval
+        self.timeout = timeout
+        self.max_staleness = max_staleness
+        self.status = UPSTREAM_UNKNOWN
+        self.error: Optional[str] = None
+        self.latency: Optional[float] = None
+        self.checked_at: Optional[float] = None
+        self.last_success_at: Optional[float] = None
+        self.consecutive_failures = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def check(self) -> None:
+        """Run one probe and record the result"""
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.probe(), self.timeout)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            if self.status != UPSTREAM_DOWN:
+                logger.warning(f"Upstream health probe failed: {error}")
+            self.status = UPSTREAM_DOWN
+            self.error = error
+            self.consecutive_failures += 1
+        else:
+            if self.status == UPSTREAM_DOWN:
+                logger.info("Upstream health probe recovered")
+            self.status = UPSTREAM_UP
+            self.error = None
+            self.consecutive_failures = 0
+            self.last_success_at = time.time()
+        self.latency = time.perf_counter() - started
+        self.checked_at = time.time()
+
+    async def _run(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """Start probing in the background (the first probe runs immediately)"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> Dict:
+        """Cached upstream status with its age"""
+        now = time.time()
+        stale = self.last_success_at is None or now - self.last_success_at > self.max_staleness
+        return {
+            'status': self.status,
+            'checked_at': datetime.fromtimestamp(self.checked_at).isoformat() if self.checked_at else None,
+            'staleness_seconds': round(now - self.checked_at, 1) if self.checked_at else None,
+            'stale': stale,
+            'latency_seconds': round(self.latency, 3) if self.latency is not None else None,
+            'consecutive_failures': self.consecutive_failures,
+            'error': self.error,
+        }
+
+    @property
+    def healthy(self) -> bool:
+        """Upstream answered within the staleness window"""
+        return self.status == UPSTREAM_UP and not self.snapshot()['stale']
+
+
+def saturation_reasons(queue_depth: int, upstream_in_flight: int, upstream_limit: int,
+                       max_queue_depth: int = READINESS_MAX_QUEUE_DEPTH,
+                       max_utilization: float = READINESS_MAX_UPSTREAM_UTILIZATION) -> Dict[str, str]:
+    """Local saturation signals that should take the instance out of rotation"""
+    reasons = {}
+    if queue_depth > max_queue_depth:
+        reasons['thread_pool'] = f"{queue_depth} queued work items (limit {max_queue_depth})"
+    if upstream_limit and upstream_in_flight / upstream_limit >= max_utilization:
+        reasons['upstream'] = f"{upstream_in_flight}/{upstream_limit} upstream slots in use"
+    return reasons
@@ -0,0 +1,104 @@
+"""Hedged upstream requests.
+
+When hedging is enabled, a non-streamed call that hasn't answered after the
+``GEMINI_HEDGE_PERCENTILE`` of recent upstream latency gets a duplicate; the
+first answer wins and the other call is cancelled. Latency is measured from
+when a call gets its scheduler slot, and so is the hedge delay: time spent
+queueing for a slot never triggers a hedge. Hedges go through the
+scheduler like any call, and a budget caps them at ``GEMINI_HEDGE_MAX_RATIO``
+of requests so a slow upstream doesn't turn into twice the load. Streamed
+calls are not hedged: their first chunk is already on its way to the client.
+"""
+import math
+import os
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from services.metrics import registry
+
+# Set to 1 to send a duplicate of slow calls
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', '0') == '1'
+# Percentile of recent latency after which a call is hedged
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', '95'))
+# Hedges allowed per request, e.g. 0.05 for at most 5% extra calls
+GEMINI_HEDGE_MAX_RATIO = float(os.getenv('GEMINI_HEDGE_MAX_RATIO', '0.05'))
+# Never hedge sooner than this many seconds
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '1'))
+
+# Latency samples kept per call kind, and needed before hedging starts
+WINDOW = 500
+MIN_SAMPLES = 20
+
+hedges = registry.counter(
+    'gemini_hedges_total', 'Hedges by kind and outcome: won, lost, failed (both calls failed) or denied (over budget)',
+    ('kind', 'outcome'))
+
+
+class LatencyTracker:
+    """Recent successful upstream latencies per call kind"""
+
+    def __init__(self, window: int = WINDOW, min_samples: int = MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, kind: str, seconds: float) -> None:
+        samples = self._samples.get(kind)
+        if samples is None:
+            samples = self._samples[kind] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, kind: str, percentile: float) -> Optional[float]:
+        """Latency percentile, or None until enough samples were seen"""
+        samples = self._samples.get(kind)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class HedgeBudget:
+    """Earns ``ratio`` of a hedge per request; a hedge spends a whole one"""
+
+    def __init__(self, ratio: float = GEMINI_HEDGE_MAX_RATIO, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = max(1.0, burst)
+        self.credit = 0.0
+
+    def earn(self) -> None:
+        self.credit = min(self.burst, self.credit + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.credit < 1.0:
+            return False
+        self.credit -= 1.0
+        return True
+
+
+class Hedger:
+    """Decides when a call is hedged"""
+
+    def __init__(self, enabled: bool = GEMINI_HEDGE_ENABLED, percentile: float = GEMINI_HEDGE_PERCENTILE,
+                 max_ratio: float = GEMINI_HEDGE_MAX_RATIO, min_delay: float = GEMINI_HEDGE_MIN_DELAY,
+                 tracker: Optional[LatencyTracker] = None):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.tracker = tracker or LatencyTracker()
+        self.budget = HedgeBudget(max_ratio)
+
+    def delay(self, kind: str) -> Optional[float]:
+        """Seconds to wait before hedging a call of this kind, or None to not hedge"""
+        if not self.enabled:
+            return None
+        self.budget.earn()
+        threshold = self.tracker.percentile(kind, self.percentile)
+        return None if threshold is None else max(self.min_delay, threshold)
+
+    def stats(self) -> Dict:
+        return {
+            'hedging': self.enabled,
+            'hedge_percentile': self.percentile,
+            'hedge_credit': round(self.budget.credit, 2),
+        }
@@ -0,0 +1,151 @@
+"""Image pre-processing: downscale and recompress images before upload.
+
+Gemini downsamples large images anyway, so sending full-resolution photos
+and screenshots only costs upload time and tokens. Images are capped at
+``IMAGE_MAX_DIMENSION``, have their metadata stripped and are recompressed
+(JPEG, or PNG when they have transparency). Animated GIFs are reduced to a
+few evenly spaced frames. The work runs in the shared process pool.
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from services.process_pool import get_process_pool
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to send images unchanged
+IMAGE_STAGE_ENABLED = os.getenv('IMAGE_STAGE_ENABLED', '1') == '1'
+# Longest side, in pixels, of the image sent upstream
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '1536'))
+# JPEG quality used for recompression
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+# Lower the quality until each image fits this many bytes (0 disables)
+IMAGE_TARGET_BYTES = int(os.getenv('IMAGE_TARGET_BYTES', '0'))
+# Frames kept from an animated GIF
+IMAGE_GIF_MAX_FRAMES = max(1, int(os.getenv('IMAGE_GIF_MAX_FRAMES', '4')))
+# Larger images skip the stage (which needs them in memory) and are uploaded as they are
+IMAGE_STAGE_MAX_BYTES = int(os.getenv('IMAGE_STAGE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Quality is never lowered below this when chasing the target size
+MIN_JPEG_QUALITY = 40
+QUALITY_STEP = 10
+
+
+@dataclass
+class ProcessedImage:
+    """What the image stage decided to send upstream for one upload"""
+    images: List[Tuple[bytes, str]]
+    original_size: int
+    original_dimensions: Tuple[int, int] = (0, 0)
+    dimensions: Tuple[int, int] = (0, 0)
+    frames: int = 1
+    total_frames: int = 1
+    quality: Optional[int] = None
+    seconds: float = 0.0
+    unchanged: bool = False
+
+    @property
+    def payload_size(self) -> int:
+        return sum(len(data) for data, _ in self.images)
+
+    def info(self) -> Dict:
+        """Summary of the stage for responses and logs"""
+        saved = self.original_size - self.payload_size
+        return {
+            'original_size': self.original_size,
+            'payload_size': self.payload_size,
+            'saved_bytes': saved,
+            'saved_pct': round(100.0 * saved / self.original_size, 1) if self.original_size else 0.0,
+            'original_dimensions': list(self.original_dimensions),
+            'dimensions': list(self.dimensions),
+            'frames': self.frames,
+            'total_frames': self.total_frames,
+            'quality': self.quality,
+            'unchanged': self.unchanged,
+            'stage_seconds': round(self.seconds, 3),
+        }
+
+
+def _frame_indexes(total: int, wanted: int) -> List[int]:
+    """Evenly spaced frame numbers, always including the first frame"""
+    if total <= wanted:
+        return list(range(total))
+    return sorted({round(i * (total - 1) / (wanted - 1)) for i in range(wanted)}) if wanted > 1 else [0]
+
+
+def _encode(image: Image.Image, quality: int, target_bytes: int) -> Tuple[bytes, str, Optional[int]]:
+    """Recompress one frame, lowering the JPEG quality until it fits the target"""
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha:
+        buffer = io.BytesIO()
+        image.convert('RGBA').save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue(), 'image/png', None
+
+    image = image.convert('RGB')
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        data = buffer.getvalue()
+        if target_bytes <= 0 or len(data) <= target_bytes or quality <= MIN_JPEG_QUALITY:
+            return data, 'image/jpeg', quality
+        quality = max(MIN_JPEG_QUALITY, quality - QUALITY_STEP)
+
+
+def preprocess_image(data: bytes, mime_type: str, max_dimension: int = IMAGE_MAX_DIMENSION,
+                     quality: int = IMAGE_JPEG_QUALITY, target_bytes: int = IMAGE_TARGET_BYTES,
+                     max_frames: int = IMAGE_GIF_MAX_FRAMES) -> ProcessedImage:
+    """Downscale, strip and recompress an image (blocking; runs in worker processes)"""
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as source:
+        original_dimensions = source.size
+        total_frames = getattr(source, 'n_frames', 1)
+        images = []
+        used_quality = None
+        dimensions = original_dimensions
+        for index in _frame_indexes(total_frames, max_frames):
+            source.seek(index)
+            # Apply the EXIF rotation before the metadata is dropped
+            frame = ImageOps.exif_transpose(source.copy())
+            frame.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            dimensions = frame.size
+            encoded, encoded_mime, used_quality = _encode(frame, quality, target_bytes)
+            images.append((encoded, encoded_mime))
+
+    result = ProcessedImage(
+        images, len(data), original_dimensions, dimensions,
+        frames=len(images), total_frames=total_frames, quality=used_quality,
+    )
+    if total_frames == 1 and dimensions == original_dimensions and result.payload_size >= len(data):
+        # Already small enough; recompressing would only cost quality
+        result = ProcessedImage([(data, mime_type)], len(data), original_dimensions, original_dimensions,
+                                unchanged=True)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+async def process_image(data: bytes, mime_type: str, file_name: str) -> ProcessedImage:
+    """Run the image stage in the process pool; images Pillow can't read are sent unchanged"""
+    loop = asyncio.get_event_loop()
+    try:
+        result = await loop.run_in_executor(get_process_pool(), preprocess_image, data, mime_type)
+    except Exception as e:
+        logger.warning(f"Image stage could not process {file_name}, sending it unchanged: {e}")
+        return ProcessedImage([(data, mime_type)], len(data), unchanged=True)
+
+    logger.info(f"Image stage for {file_name}: {result.info()}")
+    return result
+
+
+def image_cache_variant() -> str:
+    """Stage settings that change what the model sees for the same image"""
+    if not IMAGE_STAGE_ENABLED:
+        return ''
+    return (f"image={IMAGE_MAX_DIMENSION}:{IMAGE_JPEG_QUALITY}:"
+            f"{IMAGE_TARGET_BYTES}:{IMAGE_GIF_MAX_FRAMES}")
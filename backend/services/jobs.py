@@ -0,0 +1,414 @@
+"""Persistent job queue for long-running analyses.
+
+Submitting a job stores its files under ``JOB_DATA_DIR`` and one row per
+file in SQLite, and returns a job id right away. A pool of asyncio workers
+processes the queued tasks with bounded parallelism, recording per-file
+status and results as they finish; listeners are woken on every change so
+progress can be streamed. Tasks that were queued or running when the server
+stopped are picked up again on the next start. Finished jobs and their files
+are deleted after ``JOB_RETENTION`` seconds.
+
+Several worker processes can share one queue file: claiming a task is a
+single conditional UPDATE, running tasks record the pid of their worker so a
+starting worker only requeues tasks whose worker is gone, and watchers poll
+the database so they also see progress made by other workers.
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tasks processed at the same time
+JOB_WORKERS = max(1, int(os.getenv('JOB_WORKERS', '4')))
+# Seconds finished jobs and their results are kept
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', str(24 * 60 * 60)))
+# Total bytes of the files of one job; they are read into memory and written to JOB_DATA_DIR
+JOB_MAX_BYTES = int(os.getenv('JOB_MAX_BYTES', str(256 * 1024 * 1024)))
+# SQLite file with the job and task state
+JOBS_PATH = os.getenv(
+    'JOBS_PATH',
+    str(Path(__file__).resolve().parent.parent / '.cache' / 'jobs.sqlite3')
+)
+# Directory holding the uploaded files of queued jobs
+JOB_DATA_DIR = os.getenv(
+    'JOB_DATA_DIR',
+    str(Path(__file__).resolve().parent.parent / '.cache' / 'jobs')
+)
+
+# Seconds between retention sweeps
+CLEANUP_INTERVAL = 600
+# Seconds between database reads of a watcher, for changes made by other worker processes
+WATCH_POLL_INTERVAL = 1.0
+
+# Job and task statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (COMPLETED, FAILED, CANCELLED)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    ' id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, params TEXT NOT NULL,'
+    ' created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL)',
+    'CREATE TABLE IF NOT EXISTS tasks ('
+    ' job_id TEXT NOT NULL, idx INTEGER NOT NULL, file_id TEXT NOT NULL, file_name TEXT NOT NULL,'
+    ' path TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, result TEXT, error TEXT,'
+    ' started_at REAL, finished_at REAL, owner INTEGER, PRIMARY KEY (job_id, idx))',
+    'CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (status, finished_at)',
+)
+
+# A task handler gets the task row and the file bytes and returns a JSON-serialisable result
+TaskHandler = Callable[[Dict, bytes], Awaitable[Dict]]
+
+
+def _job_status(statuses: List[str]) -> str:
+    """Overall job status from the statuses of its tasks"""
+    if any(status in (QUEUED, RUNNING) for status in statuses):
+        return RUNNING if any(status != QUEUED for status in statuses) else QUEUED
+    if statuses and all(status == CANCELLED for status in statuses):
+        return CANCELLED
+    return COMPLETED if any(status == COMPLETED for status in statuses) else FAILED
+
+
+def _process_alive(pid: Optional[int]) -> bool:
+    if not pid or pid == os.getpid():
+        # Tasks recorded under our own pid are left over from an earlier run
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """SQLite-backed queue of file analysis jobs with an asyncio worker pool"""
+
+    def __init__(self, path: str = JOBS_PATH, data_dir: str = JOB_DATA_DIR,
+                 workers: int = JOB_WORKERS, retention: int = JOB_RETENTION):
+        self.path = path
+        self.data_dir = Path(data_dir)
+        self.workers = workers
+        self.retention = retention
+        self._handlers: Dict[str, TaskHandler] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._changed: Optional[asyncio.Condition] = None
+        # Bumped on every change so watchers don't miss one between two reads
+        self._version = 0
+        self.running = 0
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            columns = [row['name'] for row in conn.execute('PRAGMA table_info(tasks)')]
+            if 'owner' not in columns:
+                conn.execute('ALTER TABLE tasks ADD COLUMN owner INTEGER')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    async def _db(self, fn: Callable, *args) -> Any:
+        # SQLite calls are blocking, so they run in the default executor
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def register(self, kind: str, handler: TaskHandler) -> None:
+        """Set the coroutine that processes the tasks of one job kind"""
+        self._handlers[kind] = handler
+
+    # Lifecycle
+
+    def _recover(self) -> List[Tuple[str, int]]:
+        """Requeue tasks whose worker process is gone and list everything still queued"""
+        with self._connect() as conn:
+            orphaned = [(row['job_id'], row['idx']) for row in conn.execute(
+                'SELECT job_id, idx, owner FROM tasks WHERE status = ?', (RUNNING,)
+            ) if not _process_alive(row['owner'])]
+            interrupted = 0
+            for job_id, index in orphaned:
+                interrupted += conn.execute(
+                    'UPDATE tasks SET status = ?, started_at = NULL, owner = NULL '
+                    'WHERE job_id = ? AND idx = ? AND status = ?', (QUEUED, job_id, index, RUNNING)
+                ).rowcount
+            rows = conn.execute(
+                'SELECT tasks.job_id, tasks.idx FROM tasks JOIN jobs ON jobs.id = tasks.job_id '
+                'WHERE tasks.status = ? ORDER BY jobs.created_at, tasks.idx', (QUEUED,)
+            ).fetchall()
+        if interrupted:
+            logger.info(f"Requeued {interrupted} job tasks interrupted by a restart")
+        return [(row['job_id'], row['idx']) for row in rows]
+
+    async def start(self) -> None:
+        """Recover persisted work and start the workers and the retention sweep"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._changed = asyncio.Condition()
+        for item in await self._db(self._recover):
+            self._queue.put_nowait(item)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._cleanup_loop()))
+        logger.info(f"Job queue started with {self.workers} workers and {self._queue.qsize()} queued tasks")
+
+    async def stop(self) -> None:
+        """Stop the workers; unfinished tasks are picked up again on the next start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Submitting
+
+    def _insert(self, job_id: str, kind: str, params: Dict, files: List[Dict]) -> None:
+        now = time.time()
+        job_dir = self.data_dir / job_id
+        job_dir.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, status, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, kind, QUEUED, json.dumps(params), now, now)
+            )
+            for index, file in enumerate(files):
+                path = job_dir / str(index)
+                path.write_bytes(file['content'])
+                conn.execute(
+                    'INSERT INTO tasks (job_id, idx, file_id, file_name, path, params, status) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, index, file['file_id'], file['file_name'], str(path),
+                     json.dumps(file.get('params') or {}), QUEUED)
+                )
+
+    async def submit(self, kind: str, files: List[Dict], params: Optional[Dict] = None) -> str:
+        """Persist a job and queue its tasks.
+
+        Each file is a dict with ``file_id``, ``file_name``, ``content`` and
+        optional per-file ``params``.
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'")
+        job_id = uuid.uuid4().hex
+        await self._db(self._insert, job_id, kind, params or {}, files)
+        for index in range(len(files)):
+            self._queue.put_nowait((job_id, index))
+        logger.info(f"Queued job {job_id} ({kind}) with {len(files)} tasks")
+        return job_id
+
+    # Processing
+
+    def _claim(self, job_id: str, index: int) -> Optional[Dict]:
+        """Mark a queued task as running and return it with its job kind"""
+        now = time.time()
+        with self._connect() as conn:
+            claimed = conn.execute(
+                'UPDATE tasks SET status = ?, started_at = ?, owner = ? WHERE job_id = ? AND idx = ? AND status = ?',
+                (RUNNING, now, os.getpid(), job_id, index, QUEUED)
+            ).rowcount
+            if not claimed:
+                return None
+            conn.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?', (RUNNING, now, job_id))
+            row = conn.execute(
+                'SELECT tasks.*, jobs.kind, jobs.params AS job_params FROM tasks '
+                'JOIN jobs ON jobs.id = tasks.job_id WHERE tasks.job_id = ? AND tasks.idx = ?',
+                (job_id, index)
+            ).fetchone()
+        task = dict(row)
+        task['params'] = {**json.loads(task.pop('job_params')), **json.loads(task['params'])}
+        return task
+
+    def _finish(self, job_id: str, index: int, status: str, result: Optional[Dict],
+                error: Optional[str]) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE tasks SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ? AND idx = ?',
+                (status, json.dumps(result) if result is not None else None, error, now, job_id, index)
+            )
+            self._update_job(conn, job_id, now)
+
+    def _update_job(self, conn: sqlite3.Connection, job_id: str, now: float) -> None:
+        statuses = [row['status'] for row in conn.execute('SELECT status FROM tasks WHERE job_id = ?', (job_id,))]
+        status = _job_status(statuses)
+        finished_at = now if status in FINISHED_STATUSES else None
+        conn.execute('UPDATE jobs SET status = ?, updated_at = ?, finished_at = ? WHERE id = ?',
+                     (status, now, finished_at, job_id))
+        if finished_at is not None:
+            # Inputs are no longer needed once every task is done
+            shutil.rmtree(self.data_dir / job_id, ignore_errors=True)
+
+    async def _notify(self) -> None:
+        self._version += 1
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _worker(self) -> None:
+        while True:
+            job_id, index = await self._queue.get()
+            try:
+                await self._run_task(job_id, index)
+            except Exception as e:
+                logger.error(f"Job worker failed on {job_id}/{index}: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _run_task(self, job_id: str, index: int) -> None:
+        task = await self._db(self._claim, job_id, index)
+        if task is None:
+            # Cancelled or deleted while it was queued
+            return
+        await self._notify()
+        self.running += 1
+        try:
+            content = await self._db(Path(task['path']).read_bytes)
+            result = await self._handlers[task['kind']](task, content)
+        except asyncio.CancelledError:
+            # Shutting down: the task stays running in the database and is requeued on restart
+            raise
+        except Exception as e:
+            logger.warning(f"Job task {job_id}/{index} ({task['file_name']}) failed: {e}")
+            await self._db(self._finish, job_id, index, FAILED, None, str(e))
+        else:
+            await self._db(self._finish, job_id, index, COMPLETED, result, None)
+        finally:
+            self.running -= 1
+        await self._notify()
+
+    # Reading
+
+    def _load(self, job_id: str) -> Optional[Dict]:
+        with self._connect() as conn:
+            job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            tasks = conn.execute('SELECT * FROM tasks WHERE job_id = ? ORDER BY idx', (job_id,)).fetchall()
+
+        progress = {status: 0 for status in (QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED)}
+        files = []
+        for task in tasks:
+            progress[task['status']] += 1
+            files.append({
+                'file_id': task['file_id'],
+                'file_name': task['file_name'],
+                'status': task['status'],
+                'result': json.loads(task['result']) if task['result'] else None,
+                'error': task['error'],
+                'started_at': task['started_at'],
+                'finished_at': task['finished_at'],
+            })
+        return {
+            'job_id': job['id'],
+            'kind': job['kind'],
+            'status': job['status'],
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at'],
+            'finished_at': job['finished_at'],
+            'total': len(files),
+            'done': len(files) - progress[QUEUED] - progress[RUNNING],
+            'progress': progress,
+            'files': files,
+        }
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """Job status with per-file progress and results"""
+        return await self._db(self._load, job_id)
+
+    async def watch(self, job_id: str, keepalive: float = 15.0) -> AsyncIterator[Optional[Dict]]:
+        """Yield the job whenever it changes, until it finishes.
+
+        ``None`` is yielded when nothing changed for ``keepalive`` seconds.
+        Changes made in this process wake the watcher right away; the database
+        is also polled for changes made by other worker processes.
+        """
+        last = None
+        idle_since = time.monotonic()
+        while True:
+            version = self._version
+            job = await self.get(job_id)
+            if job is None:
+                return
+            if job['updated_at'] != last:
+                last = job['updated_at']
+                idle_since = time.monotonic()
+                yield job
+            if job['status'] in FINISHED_STATUSES:
+                return
+            if self._version != version:
+                continue
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait_for(lambda: self._version != version),
+                                           min(keepalive, WATCH_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+            if time.monotonic() - idle_since >= keepalive:
+                idle_since = time.monotonic()
+                yield None
+
+    def _cancel(self, job_id: str) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            if conn.execute('SELECT 1 FROM jobs WHERE id = ?', (job_id,)).fetchone() is None:
+                return False
+            conn.execute('UPDATE tasks SET status = ?, finished_at = ? WHERE job_id = ? AND status = ?',
+                         (CANCELLED, now, job_id, QUEUED))
+            self._update_job(conn, job_id, now)
+        return True
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel the tasks that haven't started yet; running ones finish normally"""
+        found = await self._db(self._cancel, job_id)
+        if found:
+            await self._notify()
+        return found
+
+    # Retention
+
+    def _purge(self, now: float) -> int:
+        with self._connect() as conn:
+            expired = [row['id'] for row in conn.execute(
+                'SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (now - self.retention,)
+            )]
+            for job_id in expired:
+                conn.execute('DELETE FROM tasks WHERE job_id = ?', (job_id,))
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                shutil.rmtree(self.data_dir / job_id, ignore_errors=True)
+        return len(expired)
+
+    async def purge(self) -> int:
+        """Delete finished jobs older than the retention period"""
+        purged = await self._db(self._purge, time.time())
+        if purged:
+            logger.info(f"Deleted {purged} finished jobs past retention")
+        return purged
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.warning(f"Job retention sweep failed: {e}")
+            await asyncio.sleep(CLEANUP_INTERVAL)
+
+    def stats(self) -> Dict[str, Any]:
+        """Current queue usage, for logging and monitoring"""
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'running': self.running,
+            'retention': self.retention,
+        }
@@ -0,0 +1,187 @@
+"""Map-reduce analysis for very long PDFs.
+
+A single request over a huge document is slow, can exceed the context window
+and only uses one upstream slot. In map-reduce mode the selected pages are
+split into chunks (by page count or by an estimated token budget), every chunk
+is analysed concurrently, and the partial answers are merged by a reduce step:
+either one call over all partials (``single``) or a tree of reduce calls
+(``tree``) for documents with many chunks.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from services.pdf_text import PdfExtraction, format_pages, subset_pdf
+from services.token_budget import PDF_PAGE_TOKENS, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# `auto` switches to map-reduce for documents with at least this many selected pages
+MAP_REDUCE_MIN_PAGES = int(os.getenv('MAP_REDUCE_MIN_PAGES', '60'))
+# Maximum pages per chunk
+MAP_REDUCE_CHUNK_PAGES = max(1, int(os.getenv('MAP_REDUCE_CHUNK_PAGES', '20')))
+# Maximum estimated tokens per chunk (0 splits by page count only)
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv('MAP_REDUCE_CHUNK_TOKENS', '0'))
+# Number of chunks analysed at the same time per document
+MAP_REDUCE_CONCURRENCY = max(1, int(os.getenv('MAP_REDUCE_CONCURRENCY', '8')))
+# How partial answers are merged: `single` or `tree`
+MAP_REDUCE_STRATEGY = os.getenv('MAP_REDUCE_STRATEGY', 'single')
+# Partial answers merged per reduce call in the `tree` strategy
+MAP_REDUCE_FAN_IN = max(2, int(os.getenv('MAP_REDUCE_FAN_IN', '8')))
+
+# Analysis modes accepted by the endpoints
+ANALYSIS_AUTO = 'auto'
+ANALYSIS_SINGLE = 'single'
+ANALYSIS_MAP_REDUCE = 'map_reduce'
+ANALYSIS_MODES = (ANALYSIS_AUTO, ANALYSIS_SINGLE, ANALYSIS_MAP_REDUCE)
+
+REDUCE_SINGLE = 'single'
+REDUCE_TREE = 'tree'
+
+
+def should_map_reduce(extraction: PdfExtraction, analysis_mode: Optional[str]) -> bool:
+    """Decide whether a document is analysed in chunks"""
+    mode = analysis_mode or ANALYSIS_AUTO
+    if mode not in ANALYSIS_MODES:
+        raise ValueError(f"Unknown analysis mode '{mode}'. Allowed modes: {', '.join(ANALYSIS_MODES)}")
+    if len(extraction.pages) < 2:
+        return False
+    if mode == ANALYSIS_MAP_REDUCE:
+        return True
+    return mode == ANALYSIS_AUTO and len(extraction.pages) >= MAP_REDUCE_MIN_PAGES
+
+
+def estimate_page_tokens(extraction: PdfExtraction) -> Dict[int, int]:
+    """Estimate the tokens every selected page costs upstream"""
+    return {
+        # Pages without a text layer are sent as PDF
+        number: (estimate_tokens(extraction.page_texts[number])
+                 if number in extraction.page_texts else PDF_PAGE_TOKENS)
+        for number in extraction.pages
+    }
+
+
+def plan_chunks(pages: List[int], page_tokens: Dict[int, int],
+                chunk_pages: int = MAP_REDUCE_CHUNK_PAGES,
+                chunk_tokens: int = MAP_REDUCE_CHUNK_TOKENS) -> List[List[int]]:
+    """Split pages into consecutive chunks bounded by page count and token budget"""
+    chunks: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for number in pages:
+        tokens = page_tokens.get(number, PDF_PAGE_TOKENS)
+        over_budget = chunk_tokens > 0 and current and current_tokens + tokens > chunk_tokens
+        if len(current) >= chunk_pages or over_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(number)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _page_label(first: int, last: int) -> str:
+    return f"pages {first + 1}-{last + 1}" if last > first else f"page {first + 1}"
+
+
+async def map_reduce_pdf(
+    data: bytes,
+    extraction: PdfExtraction,
+    prompt: str,
+    file_name: str,
+    generate: Callable[[List[Any]], Awaitable[Any]],
+    pdf_part: Callable[[bytes, str], Awaitable[Any]],
+    executor=None,
+    chunk_pages: int = MAP_REDUCE_CHUNK_PAGES,
+    chunk_tokens: int = MAP_REDUCE_CHUNK_TOKENS,
+    concurrency: int = MAP_REDUCE_CONCURRENCY,
+    strategy: str = MAP_REDUCE_STRATEGY,
+    fan_in: int = MAP_REDUCE_FAN_IN,
+) -> Tuple[Any, Dict]:
+    """Analyse chunks of a PDF concurrently and merge the partial answers.
+
+    ``generate`` sends a list of request parts upstream and ``pdf_part`` turns
+    PDF bytes into a request part. Returns the final model response together
+    with statistics about the run.
+    """
+    if strategy not in (REDUCE_SINGLE, REDUCE_TREE):
+        raise ValueError(f"Unknown reduce strategy '{strategy}'")
+
+    started = time.perf_counter()
+    loop = asyncio.get_event_loop()
+    chunks = plan_chunks(extraction.pages, estimate_page_tokens(extraction), chunk_pages, chunk_tokens)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _map(index: int, pages: List[int]) -> str:
+        async with semaphore:
+            text_pages = {number: extraction.page_texts[number] for number in pages
+                          if number in extraction.page_texts}
+            scanned = [number for number in pages if number not in text_pages]
+            parts: List[Any] = [
+                f"{prompt}\n\nYou are looking at part {index + 1} of {len(chunks)} "
+                f"({_page_label(pages[0], pages[-1])}) of '{file_name}'. Analyse only this part; "
+                f"your notes will be merged with the notes on the other parts."
+            ]
+            if text_pages:
+                parts.append(format_pages(text_pages))
+            if scanned:
+                chunk_pdf = await loop.run_in_executor(executor, subset_pdf, data, scanned)
+                parts.append(await pdf_part(chunk_pdf, file_name))
+            response = await generate(parts)
+            return response.text
+
+    partials = await asyncio.gather(*(_map(index, pages) for index, pages in enumerate(chunks)))
+    map_seconds = time.perf_counter() - started
+
+    def _reduce_parts(texts: List[str], ranges: List[Tuple[int, int]], final: bool) -> List[Any]:
+        instruction = (
+            f"{prompt}\n\nBelow are analyses of consecutive parts of '{file_name}'. "
+            f"Merge them into one coherent answer to the request above, "
+            f"removing repetition and keeping page references where useful."
+            if final else
+            f"Below are analyses of consecutive parts of '{file_name}', written for this request: "
+            f"{prompt}\n\nCondense them into one set of notes, keeping every important detail."
+        )
+        sections = '\n\n'.join(
+            f"=== {_page_label(first, last)} ===\n{text}" for (first, last), text in zip(ranges, texts)
+        )
+        return [instruction, sections]
+
+    ranges = [(pages[0], pages[-1]) for pages in chunks]
+    texts = list(partials)
+    reduce_calls = 0
+    levels = 0
+
+    async def _reduce_group(group_texts: List[str], group_ranges: List[Tuple[int, int]]) -> str:
+        async with semaphore:
+            response = await generate(_reduce_parts(group_texts, group_ranges, final=False))
+            return response.text
+
+    if strategy == REDUCE_TREE:
+        while len(texts) > fan_in:
+            groups = [(texts[i:i + fan_in], ranges[i:i + fan_in]) for i in range(0, len(texts), fan_in)]
+            texts = list(await asyncio.gather(*(_reduce_group(t, r) for t, r in groups)))
+            ranges = [(group_ranges[0][0], group_ranges[-1][1]) for _, group_ranges in groups]
+            reduce_calls += len(groups)
+            levels += 1
+
+    final_response = await generate(_reduce_parts(texts, ranges, final=True))
+    reduce_calls += 1
+    levels += 1
+
+    stats = {
+        'chunks': len(chunks),
+        'chunk_pages': chunk_pages,
+        'chunk_tokens': chunk_tokens,
+        'concurrency': concurrency,
+        'strategy': strategy,
+        'reduce_calls': reduce_calls,
+        'reduce_levels': levels,
+        'map_seconds': round(map_seconds, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+    }
+    logger.info(f"Map-reduce analysis of {file_name}: {stats}")
+    return final_response, stats
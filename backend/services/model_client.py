@@ -0,0 +1,339 @@
+"""Async client layer for the Gemini API.
+
+All upstream model calls go through a single ``ModelClient`` instance. It uses
+the SDK's native asyncio API (``generate_content_async``) instead of running the
+blocking SDK in a thread pool, so one process can keep many requests open
+without a thread for each. Slots, quotas, priorities and retries of 429/503
+responses are handled by the ``UpstreamScheduler``, and slow non-streamed
+calls can be hedged with a duplicate (see ``services.hedging``). Requests
+are checked against the input token budget before they are sent, and the
+usage reported by each call is added to the current request's usage (see
+``services.token_budget`` and ``services.usage``).
+
+Importing the SDK takes about a second, so it is imported and configured on
+first use, and the model is built in a thread on first use or by
+``warm_up`` once the server is accepting traffic. The SDK's gRPC channels
+don't survive a fork, so a forked worker drops the configured SDK and built
+models and sets them up again on first use.
+"""
+import asyncio
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from services.hedging import Hedger, hedges
+from services.metrics import gemini_errors, gemini_request_duration, observe_usage
+from services.scheduler import (
+    GEMINI_MAX_RETRIES, UpstreamScheduler, backoff_delay, error_status, is_retryable, retries, retry_hint,
+)
+from services.token_budget import MAX_INPUT_TOKENS, check_budget, estimate_tokens, fit_to_budget
+from services.usage import record_response
+
+logger = logging.getLogger(__name__)
+
+# Model used for every request (see .cursor/rules: use gemini-2.0-flash only)
+MODEL_NAME = 'gemini-2.0-flash'
+
+# Maximum number of upstream requests in flight per process
+GEMINI_MAX_CONCURRENCY = max(1, int(os.getenv('GEMINI_MAX_CONCURRENCY', '64')))
+# Set to 0 to skip building the model and checking the API key after startup
+GEMINI_WARMUP = os.getenv('GEMINI_WARMUP', '1') == '1'
+
+# Models built with a system instruction (e.g. per chat session) kept for reuse
+MAX_INSTRUCTION_MODELS = 32
+
+_genai = None
+_api_key: Optional[str] = None
+# Clients whose built models are dropped in a forked child
+_clients: 'weakref.WeakSet' = weakref.WeakSet()
+
+
+def configure_genai(api_key: str) -> None:
+    """Remember the API key; the SDK is configured when it is first imported"""
+    global _api_key
+    _api_key = api_key
+    if _genai is not None:
+        _genai.configure(api_key=api_key)
+
+
+def get_genai():
+    """Import and configure the Gemini SDK on first use"""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        if _api_key:
+            genai.configure(api_key=_api_key)
+        _genai = genai
+    return _genai
+
+
+def _reset_after_fork() -> None:
+    global _genai
+    _genai = None
+    for client in list(_clients):
+        client._model = None
+        client._instruction_models.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _prompt_tokens(response: Any) -> Optional[int]:
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'prompt_token_count', None) if usage is not None else None
+
+
+class ModelClient:
+    """Async wrapper around a ``genai.GenerativeModel`` with scheduled, retried calls"""
+
+    def __init__(self, model: Optional[Any] = None, model_name: str = MODEL_NAME,
+                 max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+                 model_factory: Optional[Callable[[Optional[str]], Any]] = None,
+                 scheduler: Optional[UpstreamScheduler] = None,
+                 max_retries: int = GEMINI_MAX_RETRIES,
+                 hedger: Optional[Hedger] = None,
+                 max_input_tokens: int = MAX_INPUT_TOKENS):
+        self.model_name = model_name
+        self._model = model
+        self._model_factory = model_factory
+        self._instruction_models: 'OrderedDict[str, Any]' = OrderedDict()
+        self.max_concurrency = max_concurrency
+        self.scheduler = scheduler or UpstreamScheduler(max_concurrency)
+        self.max_retries = max_retries
+        self.hedger = hedger or Hedger()
+        self.max_input_tokens = max_input_tokens
+        _clients.add(self)
+
+    @property
+    def in_flight(self) -> int:
+        return self.scheduler.in_flight
+
+    def _new_model(self, system_instruction: Optional[str]) -> Any:
+        if self._model_factory is not None:
+            return self._model_factory(system_instruction)
+        if system_instruction is None:
+            return get_genai().GenerativeModel(self.model_name)
+        return get_genai().GenerativeModel(self.model_name, system_instruction=system_instruction)
+
+    def _build_model(self, system_instruction: Optional[str] = None) -> Any:
+        if system_instruction is None:
+            if self._model is None:
+                self._model = self._new_model(None)
+            return self._model
+        model = self._instruction_models.get(system_instruction)
+        if model is None:
+            model = self._instruction_models[system_instruction] = self._new_model(system_instruction)
+            while len(self._instruction_models) > MAX_INSTRUCTION_MODELS:
+                self._instruction_models.popitem(last=False)
+        return model
+
+    async def get_model(self, system_instruction: Optional[str] = None) -> Any:
+        """The model, built in a thread on first use so the SDK import doesn't block the loop.
+
+        Models with a system instruction are kept in a small LRU keyed by the instruction.
+        """
+        if system_instruction is None and self._model is not None:
+            return self._model
+        model = self._instruction_models.get(system_instruction) if system_instruction is not None else None
+        if model is not None:
+            self._instruction_models.move_to_end(system_instruction)
+            return model
+        return await asyncio.get_event_loop().run_in_executor(None, self._build_model, system_instruction)
+
+    async def ping(self) -> None:
+        """Check that the API answers for this key and model; raises on failure.
+
+        Uses models.get, which is not billed, and imports the SDK in a thread.
+        """
+        await asyncio.get_event_loop().run_in_executor(
+            None, lambda: get_genai().get_model(f"models/{self.model_name}")
+        )
+
+    async def check_upstream(self) -> None:
+        """Build the model and ping the API"""
+        await self.get_model()
+        await self.ping()
+
+    async def warm_up(self) -> None:
+        """Run ``check_upstream`` once, logging instead of raising"""
+        started = time.perf_counter()
+        try:
+            await self.check_upstream()
+            logger.info(f"Gemini client warmed up in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"Gemini client warm-up failed: {e}")
+
+    async def _backoff(self, kind: str, error: Exception, attempt: int) -> None:
+        """Wait before retrying a call rejected with 429/503, or re-raise when out of retries"""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            raise error
+        delay = backoff_delay(attempt, retry_hint(error))
+        retries.labels(str(error_status(error) or type(error).__name__)).inc()
+        logger.warning(f"Gemini {kind} call throttled ({type(error).__name__}), "
+                       f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def _call(self, kind: str, call: Callable[[], Awaitable[Any]], tokens: int = 0,
+                    sent: Optional[asyncio.Event] = None) -> Any:
+        """Make one upstream call in a scheduler slot, retrying throttled attempts.
+
+        ``sent`` is set once the call got its slot and went upstream.
+        """
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(tokens)
+            if sent is not None:
+                sent.set()
+            started = time.perf_counter()
+            try:
+                response = await call()
+            except Exception as e:
+                gemini_errors.labels(type(e).__name__).inc()
+                error = e
+            else:
+                error = None
+            finally:
+                # The slot is given back while backing off
+                self.scheduler.release()
+                elapsed = time.perf_counter() - started
+                gemini_request_duration.labels(kind).observe(elapsed)
+            if error is None:
+                self.hedger.tracker.record(kind, elapsed)
+                observe_usage(response)
+                record_response(response, tokens)
+                self.scheduler.record_usage(tokens, _prompt_tokens(response))
+                return response
+            await self._backoff(kind, error, attempt)
+            attempt += 1
+
+    async def _hedged(self, kind: str, call: Callable[[], Awaitable[Any]], tokens: int = 0) -> Any:
+        """``_call``, duplicated when it runs past the hedging delay; the first answer wins"""
+        delay = self.hedger.delay(kind)
+        if delay is None:
+            return await self._call(kind, call, tokens)
+
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(self._call(kind, call, tokens, sent))
+        queued = asyncio.ensure_future(sent.wait())
+        hedge = None
+        try:
+            # The delay is compared with upstream latencies, so it only runs once the primary has its slot
+            await asyncio.wait({primary, queued}, return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+            if not self.hedger.budget.try_spend():
+                hedges.labels(kind, 'denied').inc()
+                return await primary
+            hedge = asyncio.ensure_future(self._call(kind, call, tokens))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    winner = primary if primary in succeeded else hedge
+                    hedges.labels(kind, 'won' if winner is hedge else 'lost').inc()
+                    return winner.result()
+            hedges.labels(kind, 'failed').inc()
+            return primary.result()
+        finally:
+            for task in (primary, queued, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def _stream(self, kind: str, call: Callable[[], Awaitable[Any]], tokens: int = 0) -> AsyncIterator[Any]:
+        """Yield the chunks of one streamed upstream call inside a scheduler slot.
+
+        The slot is held until the stream is exhausted or the consumer stops
+        iterating; closing the generator cancels the upstream call. Throttled
+        attempts are retried only until the first chunk has been yielded.
+        """
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(tokens)
+            started = time.perf_counter()
+            chunk = None
+            error = None
+            try:
+                response = await call()
+                async for chunk in response:
+                    yield chunk
+            except Exception as e:
+                gemini_errors.labels(type(e).__name__).inc()
+                if chunk is not None:
+                    raise
+                error = e
+            finally:
+                self.scheduler.release()
+                gemini_request_duration.labels(kind).observe(time.perf_counter() - started)
+            if error is None:
+                # The last chunk carries the usage of the whole answer
+                observe_usage(chunk)
+                record_response(chunk, tokens)
+                self.scheduler.record_usage(tokens, _prompt_tokens(chunk))
+                return
+            await self._backoff(kind, error, attempt)
+            attempt += 1
+
+    async def _relay(self, stream: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        # Close the inner generator right away when the consumer stops, releasing the slot
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def generate(self, contents: Any, system_instruction: Optional[str] = None, **kwargs) -> Any:
+        """Generate content without blocking the event loop; oversized text is trimmed to the budget"""
+        contents = fit_to_budget(contents, self.max_input_tokens)
+        model = await self.get_model(system_instruction)
+        return await self._hedged('generate', lambda: model.generate_content_async(contents, **kwargs),
+                                estimate_tokens(contents))
+
+    async def generate_stream(self, contents: Any, system_instruction: Optional[str] = None,
+                              **kwargs) -> AsyncIterator[Any]:
+        """Yield response chunks as the model produces them"""
+        contents = fit_to_budget(contents, self.max_input_tokens)
+        model = await self.get_model(system_instruction)
+        async for chunk in self._relay(self._stream(
+            'stream', lambda: model.generate_content_async(contents, stream=True, **kwargs),
+            estimate_tokens(contents)
+        )):
+            yield chunk
+
+    async def send_chat(self, history: List[Dict], message: str,
+                        system_instruction: Optional[str] = None, **kwargs) -> Any:
+        """Send one chat turn on top of ``history`` using the SDK chat session API"""
+        tokens = estimate_tokens(history) + estimate_tokens(message)
+        check_budget(tokens, self.max_input_tokens, 'Conversation')
+        model = await self.get_model(system_instruction)
+        # A fresh chat per attempt, so a failed attempt leaves no trace in the history
+        return await self._hedged(
+            'chat', lambda: model.start_chat(history=history).send_message_async(message, **kwargs), tokens
+        )
+
+    async def send_chat_stream(self, history: List[Dict], message: str,
+                               system_instruction: Optional[str] = None, **kwargs) -> AsyncIterator[Any]:
+        """Stream the answer to one chat turn"""
+        tokens = estimate_tokens(history) + estimate_tokens(message)
+        check_budget(tokens, self.max_input_tokens, 'Conversation')
+        model = await self.get_model(system_instruction)
+        async for chunk in self._relay(self._stream(
+            'chat_stream', lambda: model.start_chat(history=history).send_message_async(message, stream=True, **kwargs),
+            tokens
+        )):
+            yield chunk
+
+    def stats(self) -> dict:
+        """Current concurrency usage, for logging and monitoring"""
+        return {
+            'model': self.model_name,
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight,
+            **self.scheduler.stats(),
+            **self.hedger.stats(),
+            'model_ready': self._model is not None,
+        }
@@ -0,0 +1,191 @@
+"""PDF pre-processing: extract the text layer locally before going upstream.
+
+Text PDFs are sent to Gemini as compact page-tagged text instead of the full
+binary. Pages without a usable text layer (scans) are cut out into a smaller
+PDF and sent alongside the text; documents that are mostly scanned fall back
+to the binary. Big documents are extracted in a process pool, a few pages per
+worker. Callers can restrict the analysis to page ranges such as ``"1-5,8"``.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+
+import fitz  # PyMuPDF
+
+from services.process_pool import PROCESS_POOL_WORKERS, get_process_pool
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to always send PDFs as binaries
+PDF_TEXT_ENABLED = os.getenv('PDF_TEXT_ENABLED', '1') == '1'
+# A page counts as text when its text layer has at least this many characters
+PDF_TEXT_MIN_CHARS_PER_PAGE = int(os.getenv('PDF_TEXT_MIN_CHARS_PER_PAGE', '100'))
+# Fraction of text pages below which the whole (selected) PDF is sent as a binary
+PDF_TEXT_MIN_COVERAGE = float(os.getenv('PDF_TEXT_MIN_COVERAGE', '0.5'))
+# Documents with at least this many selected pages are extracted in the process pool
+PDF_TEXT_PARALLEL_MIN_PAGES = int(os.getenv('PDF_TEXT_PARALLEL_MIN_PAGES', '32'))
+# Larger PDFs skip the stage (which needs them in memory) and are uploaded as they are
+PDF_TEXT_MAX_BYTES = int(os.getenv('PDF_TEXT_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Payload modes
+MODE_TEXT = 'text'
+MODE_HYBRID = 'hybrid'
+MODE_BINARY = 'binary'
+
+class PageRangeError(ValueError):
+    """The requested page ranges don't fit the document"""
+
+
+@dataclass
+class PdfExtraction:
+    """What the PDF stage decided to send upstream for one document"""
+    mode: str
+    page_count: int
+    pages: List[int]
+    original_size: int
+    text: str = ''
+    pdf_bytes: Optional[bytes] = None
+    text_pages: List[int] = field(default_factory=list)
+    page_texts: Dict[int, str] = field(default_factory=dict)
+
+    @property
+    def scanned_pages(self) -> List[int]:
+        """Selected pages that are sent as PDF rather than text"""
+        text_pages = set(self.text_pages)
+        return [number for number in self.pages if number not in text_pages]
+
+    @property
+    def payload_size(self) -> int:
+        return len(self.text.encode('utf-8')) + (len(self.pdf_bytes) if self.pdf_bytes else 0)
+
+    def info(self) -> Dict:
+        """Summary of the stage for responses and logs"""
+        return {
+            'pdf_mode': self.mode,
+            'page_count': self.page_count,
+            'pages_analyzed': len(self.pages),
+            'text_pages': len(self.text_pages),
+            'original_size': self.original_size,
+            'payload_size': self.payload_size,
+        }
+
+
+def parse_page_ranges(spec: Optional[str], page_count: int) -> List[int]:
+    """Turn a 1-based spec like "1-3,7" into sorted 0-based page numbers"""
+    if not spec or not spec.strip():
+        return list(range(page_count))
+
+    pages = set()
+    for chunk in spec.split(','):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        start, _, end = chunk.partition('-')
+        try:
+            first = int(start)
+            last = int(end) if end else first
+        except ValueError:
+            raise PageRangeError(f"Invalid page range '{chunk}'")
+        if first < 1 or last < first or last > page_count:
+            raise PageRangeError(f"Page range '{chunk}' is outside 1-{page_count}")
+        pages.update(range(first - 1, last))
+    return sorted(pages)
+
+
+def format_pages(page_texts: Dict[int, str]) -> str:
+    """Join page texts with 1-based page markers"""
+    return '\n\n'.join(f"--- Page {number + 1} ---\n{text}" for number, text in sorted(page_texts.items()))
+
+
+def subset_pdf(data: bytes, page_numbers: List[int]) -> bytes:
+    """Build a smaller PDF that only contains the given pages"""
+    with fitz.open(stream=data, filetype='pdf') as doc:
+        doc.select(page_numbers)
+        return doc.tobytes(garbage=3, deflate=True)
+
+
+def _extract_pages(source: Union[bytes, str], page_numbers: List[int]) -> List[str]:
+    """Extract the text layer of some pages of a PDF given as bytes or a file path (runs in worker processes)"""
+    if isinstance(source, bytes):
+        doc = fitz.open(stream=source, filetype='pdf')
+    else:
+        doc = fitz.open(source, filetype='pdf')
+    with doc:
+        return [doc[number].get_text('text') for number in page_numbers]
+
+
+def _write_temp_pdf(data: bytes) -> str:
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def _page_count(data: bytes) -> int:
+    with fitz.open(stream=data, filetype='pdf') as doc:
+        return doc.page_count
+
+
+async def extract_pdf(data: bytes, pages: Optional[str] = None, executor=None) -> PdfExtraction:
+    """Decide how to send a PDF upstream: text, text plus scanned pages, or binary.
+
+    Small documents are handled in ``executor`` (a thread pool); big ones are
+    split over the process pool.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        page_count = await loop.run_in_executor(executor, _page_count, data)
+    except Exception as e:
+        # Let the model have a go at documents PyMuPDF can't parse
+        logger.warning(f"PDF stage could not open the document, sending it unchanged: {e}")
+        return PdfExtraction(MODE_BINARY, 0, [], len(data), pdf_bytes=data)
+    selected = parse_page_ranges(pages, page_count)
+    whole_document = len(selected) == page_count
+
+    if not PDF_TEXT_ENABLED:
+        pdf_bytes = data if whole_document else await loop.run_in_executor(executor, subset_pdf, data, selected)
+        return PdfExtraction(MODE_BINARY, page_count, selected, len(data), pdf_bytes=pdf_bytes)
+
+    if len(selected) >= PDF_TEXT_PARALLEL_MIN_PAGES:
+        pool = get_process_pool()
+        size = -(-len(selected) // PROCESS_POOL_WORKERS)
+        batches = [selected[i:i + size] for i in range(0, len(selected), size)]
+        # Workers open the document from a temp file: only page numbers are sent per batch
+        path = await loop.run_in_executor(executor, _write_temp_pdf, data)
+        try:
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, _extract_pages, path, batch) for batch in batches
+            ))
+        finally:
+            os.unlink(path)
+        texts = [text for batch_texts in results for text in batch_texts]
+    else:
+        texts = await loop.run_in_executor(executor, _extract_pages, data, selected)
+
+    text_pages = [
+        number for number, text in zip(selected, texts)
+        if len(text.strip()) >= PDF_TEXT_MIN_CHARS_PER_PAGE
+    ]
+    text_page_set = set(text_pages)
+    scanned_pages = [number for number in selected if number not in text_page_set]
+    coverage = len(text_pages) / len(selected) if selected else 0.0
+
+    if coverage < PDF_TEXT_MIN_COVERAGE:
+        pdf_bytes = data if whole_document else await loop.run_in_executor(executor, subset_pdf, data, selected)
+        extraction = PdfExtraction(MODE_BINARY, page_count, selected, len(data), pdf_bytes=pdf_bytes)
+    else:
+        page_texts = {number: text.strip() for number, text in zip(selected, texts) if number in text_page_set}
+        text = format_pages(page_texts)
+        pdf_bytes = None
+        if scanned_pages:
+            pdf_bytes = await loop.run_in_executor(executor, subset_pdf, data, scanned_pages)
+        extraction = PdfExtraction(
+            MODE_HYBRID if scanned_pages else MODE_TEXT, page_count, selected, len(data),
+            text=text, pdf_bytes=pdf_bytes, text_pages=text_pages, page_texts=page_texts
+        )
+
+    logger.info(f"PDF stage: {extraction.info()}")
+    return extraction
@@ -0,0 +1,120 @@
+"""Pre-fork launcher for running the server on every core.
+
+The parent imports the app once, binds the listening socket and forks
+``WORKERS`` children that each run their own uvicorn server and event loop
+on the shared socket; the kernel spreads connections between them. The
+parent only supervises: a worker that dies is replaced, and SIGINT/SIGTERM
+are forwarded so every worker shuts down gracefully.
+
+Nothing that holds threads, sockets or gRPC channels is created at import
+time (the model client, thread pools and logging writer are set up lazily or
+re-created after a fork), so importing before forking is safe and the
+children share the imported modules' memory copy-on-write. State that must
+be the same in every worker lives in SQLite: the result cache, the job
+queue and the ``SharedState`` quota buckets, File API handles, chat sessions
+and documents.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Any, Dict
+
+from services.structured_logging import shutdown_logging
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_count(value: str) -> int:
+    if value.strip().lower() in ('0', 'auto'):
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+
+# Worker processes; 0 or auto uses one per CPU core
+WORKERS = _worker_count(os.getenv('WORKERS', '1'))
+
+# Seconds to wait before replacing a worker that keeps dying at startup
+RESPAWN_DELAY = 1.0
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app: Any, sock: socket.socket, options: Dict) -> None:
+    import uvicorn
+
+    config = uvicorn.Config(app, **options)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def serve(app: Any, host: str = '0.0.0.0', port: int = 5001, workers: int = WORKERS, **options) -> None:
+    """Run ``app`` in ``workers`` forked processes sharing one listening socket"""
+    if workers <= 1 or not hasattr(os, 'fork'):
+        import uvicorn
+        uvicorn.run(app, host=host, port=port, **options)
+        return
+
+    sock = _bind(host, port)
+    children: Dict[int, float] = {}
+    stopping = False
+
+    def _spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            # Child: the parent's signal handlers must not run here
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                _run_worker(app, sock, options)
+            except Exception:
+                logger.exception("Worker crashed")
+                status = 1
+            finally:
+                shutdown_logging()
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    def _stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    for _ in range(workers):
+        _spawn()
+    logger.info(f"Started {workers} workers on {host}:{port} (pids {', '.join(map(str, children))})")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, starting a new one")
+        if time.monotonic() - started < RESPAWN_DELAY:
+            time.sleep(RESPAWN_DELAY)
+        _spawn()
+
+    sock.close()
+    logger.info("All workers stopped")
+    sys.exit(0)
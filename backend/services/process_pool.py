@@ -0,0 +1,29 @@
+"""Process pool shared by the CPU-heavy pre-processing stages.
+
+The pool is created on first use so importing the app stays cheap and no
+worker processes are started unless a stage actually needs them.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+# Number of worker processes for pre-processing (PDF text, images, ...)
+PROCESS_POOL_WORKERS = max(1, int(os.getenv('PROCESS_POOL_WORKERS', str(min(4, os.cpu_count() or 1)))))
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Return the shared process pool, creating it on first use"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS)
+    return _process_pool
+
+
+def shutdown_process_pool() -> None:
+    """Stop the worker processes, if they were started"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
@@ -0,0 +1,159 @@
+"""Response shaping, serialisation and compression.
+
+Analyses carry more than most clients read: ``candidates`` repeats the whole
+answer as the ``str()`` of each candidate proto, and ``prompt`` echoes the
+request. ``select_fields`` trims an analysis to a ``compact`` set or to an
+explicit list of fields chosen by the client.
+
+JSON bodies are rendered with orjson when it is installed, which is several
+times faster than the standard encoder on large answers, and
+``CompressionMiddleware`` compresses bodies above ``COMPRESS_MIN_SIZE`` with
+brotli (when installed) or gzip, as negotiated with ``Accept-Encoding``.
+Streamed responses (NDJSON batches, Server-Sent Events) are passed through
+unchanged so every line still reaches the client as soon as it is written.
+"""
+import gzip
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultJSONResponse
+except ImportError:  # orjson is optional
+    orjson = None
+    DefaultJSONResponse = JSONResponse
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is used instead
+    brotli = None
+
+# Set to 0 to send responses uncompressed
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', '1') == '1'
+# Response bodies smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+
+# Fast settings: most of the size reduction for a fraction of the CPU of the maximum levels
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+# Only text formats are worth compressing
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain')
+
+# Analysis fields left out of compact responses: candidates repeat the answer, prompt echoes the request
+VERBOSE_FIELDS = ('candidates', 'prompt_feedback', 'prompt')
+FIELDS_FULL = 'full'
+FIELDS_COMPACT = 'compact'
+
+response_bytes = registry.counter(
+    'http_response_bytes_total', 'Response body bytes before and after compression, by encoding',
+    ('encoding', 'stage'))
+
+
+def dumps(data: Any) -> str:
+    """Serialise ``data`` to a JSON string, with orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data)
+
+
+def select_fields(analysis: Dict, fields: Optional[str]) -> Dict:
+    """Keep the fields of an analysis a client asked for.
+
+    ``fields`` is ``full`` (or empty) for everything, ``compact`` to drop the
+    verbose fields, or a comma-separated list of field names to keep.
+    """
+    if not fields or fields == FIELDS_FULL:
+        return analysis
+    if fields == FIELDS_COMPACT:
+        return {key: value for key, value in analysis.items() if key not in VERBOSE_FIELDS}
+    wanted = {name.strip() for name in fields.split(',')}
+    return {key: value for key, value in analysis.items() if key in wanted}
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Best supported encoding accepted by the client: br, then gzip"""
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in (('br',) if brotli is not None else ()) + ('gzip',):
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """Compress complete response bodies above ``minimum_size`` with br or gzip.
+
+    Only responses sent in one body message are compressed; streamed
+    responses are forwarded as they are.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE, enabled: bool = RESPONSE_COMPRESSION):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict] = None
+
+        async def _send(message: Dict) -> None:
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                # Held back until the body shows whether it is worth compressing
+                start = message
+                return
+            if message['type'] != 'http.response.body' or start is None:
+                await send(message)
+                return
+
+            pending, start = start, None
+            body = message.get('body', b'')
+            headers = MutableHeaders(raw=pending['headers'])
+            content_type = headers.get('content-type', '').split(';')[0].strip()
+            if (message.get('more_body') or len(body) < self.minimum_size
+                    or 'content-encoding' in headers or content_type not in COMPRESSIBLE_TYPES):
+                await send(pending)
+                await send(message)
+                return
+
+            compressed = compress(body, encoding)
+            response_bytes.labels(encoding, 'uncompressed').inc(len(body))
+            response_bytes.labels(encoding, 'compressed').inc(len(compressed))
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(compressed))
+            headers.add_vary_header('Accept-Encoding')
+            await send(pending)
+            await send({'type': 'http.response.body', 'body': compressed})
+
+        await self.app(scope, receive, _send)
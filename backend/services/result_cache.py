@@ -0,0 +1,246 @@
+"""Content-addressed cache for file analysis results.
+
+Results are keyed by a hash of the file bytes, mime type, prompt and model
+name. Lookups go through a small in-memory LRU first and an on-disk SQLite
+store with a TTL second. Concurrent requests for the same key are coalesced
+so only one of them pays for the upstream call. With several worker
+processes (``shared``), the SQLite tier is in WAL mode and a short-lived
+claim row coalesces misses across workers too: the worker holding the claim
+computes the result, the others poll the disk tier until it appears.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Number of results kept in memory (0 disables the memory tier)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '256'))
+# Seconds a result stays valid in the SQLite tier
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', str(24 * 60 * 60)))
+# Location of the SQLite tier (empty string disables it)
+RESULT_CACHE_PATH = os.getenv(
+    'RESULT_CACHE_PATH',
+    str(Path(__file__).resolve().parent.parent / '.cache' / 'results.sqlite3')
+)
+
+# Seconds a worker's claim on a missing key holds off the other workers
+RESULT_CACHE_CLAIM_TIMEOUT = 300
+
+# Cache statuses reported to callers
+MEMORY_HIT = 'memory_hit'
+DISK_HIT = 'disk_hit'
+COALESCED = 'coalesced'
+MISS = 'miss'
+
+
+def content_digest(data: Union[bytes, BinaryIO], chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of in-memory bytes or of a seekable file, read in chunks"""
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        digest.update(data)
+    else:
+        data.seek(0)
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            digest.update(chunk)
+        data.seek(0)
+    return digest.hexdigest()
+
+
+def cache_key(data: Union[bytes, BinaryIO, None], mime_type: str, prompt: str, model_name: str,
+              digest: Optional[str] = None, variant: str = '') -> str:
+    """Hash the file content together with everything that affects the answer.
+
+    ``variant`` carries request options that change the answer for the same
+    file and prompt, such as a PDF page selection.
+    """
+    key = hashlib.sha256((digest or content_digest(data)).encode('ascii'))
+    for part in (mime_type, prompt, model_name, variant):
+        key.update(b'\0')
+        key.update(part.encode('utf-8'))
+    return key.hexdigest()
+
+
+class ResultCache:
+    """Two-tier (memory LRU + SQLite) result cache with request coalescing"""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+                 ttl: int = RESULT_CACHE_TTL, path: Optional[str] = RESULT_CACHE_PATH,
+                 shared: bool = False, claim_timeout: float = RESULT_CACHE_CLAIM_TIMEOUT,
+                 poll_interval: float = 0.25):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path or None
+        self.shared = shared and self.path is not None
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self._memory: 'OrderedDict[str, Tuple[float, Dict]]' = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        if self.path:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS results '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)'
+                )
+                conn.execute('CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+                # Readers don't block the writer of another process
+                conn.execute('PRAGMA journal_mode=WAL')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    # Memory tier
+
+    def _memory_get(self, key: str) -> Optional[Dict]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if time.time() - created_at > self.ttl:
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_put(self, key: str, value: Dict, created_at: float) -> None:
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # Disk tier (blocking, run in an executor)
+
+    def _disk_get(self, key: str) -> Optional[Tuple[float, Dict]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT value, created_at FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if time.time() - created_at > self.ttl:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                return None
+        return created_at, json.loads(value)
+
+    def _disk_put(self, key: str, value: Dict, created_at: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), created_at)
+            )
+            conn.execute('DELETE FROM results WHERE created_at < ?', (created_at - self.ttl,))
+
+    def _claim(self, key: str) -> bool:
+        """Claim a missing key for this worker, unless another worker holds a live claim"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM claims WHERE expires_at < ?', (now,))
+            return conn.execute(
+                'INSERT OR IGNORE INTO claims (key, expires_at) VALUES (?, ?)', (key, now + self.claim_timeout)
+            ).rowcount == 1
+
+    def _release(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM claims WHERE key = ?', (key,))
+
+    async def _wait_for_other_worker(self, key: str) -> Optional[Dict]:
+        """Claim the key, or wait until the worker holding the claim has stored the result.
+
+        Returns None once this worker holds the claim and has to compute the value.
+        """
+        loop = asyncio.get_event_loop()
+        while not await loop.run_in_executor(None, self._claim, key):
+            await asyncio.sleep(self.poll_interval)
+            entry = await loop.run_in_executor(None, self._disk_get, key)
+            if entry is not None:
+                created_at, value = entry
+                self._memory_put(key, value, created_at)
+                return value
+        # Another worker may have stored the result and dropped its claim since the lookup
+        entry = await loop.run_in_executor(None, self._disk_get, key)
+        if entry is not None:
+            await loop.run_in_executor(None, self._release, key)
+            created_at, value = entry
+            self._memory_put(key, value, created_at)
+            return value
+        return None
+
+    async def get(self, key: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """Look a key up in both tiers, returning (value, status)"""
+        value = self._memory_get(key)
+        if value is not None:
+            return value, MEMORY_HIT
+        if self.path:
+            entry = await asyncio.get_event_loop().run_in_executor(None, self._disk_get, key)
+            if entry is not None:
+                created_at, value = entry
+                self._memory_put(key, value, created_at)
+                return value, DISK_HIT
+        return None, None
+
+    async def put(self, key: str, value: Dict) -> None:
+        """Store a value in both tiers"""
+        created_at = time.time()
+        self._memory_put(key, value, created_at)
+        if self.path:
+            await asyncio.get_event_loop().run_in_executor(None, self._disk_put, key, value, created_at)
+
+    async def get_or_compute(self, key: str,
+                             compute: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, str]:
+        """Return a cached value or compute it once, sharing the work between concurrent callers"""
+        # Nothing is awaited until the key is in flight, so concurrent misses can't both compute
+        value = self._memory_get(key)
+        if value is not None:
+            logger.info(f"Result cache {MEMORY_HIT}: {key[:16]}")
+            return value, MEMORY_HIT
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            logger.info(f"Result cache {COALESCED}: {key[:16]}")
+            value, _ = await asyncio.shield(task)
+            return value, COALESCED
+
+        async def _compute_and_store() -> Tuple[Dict, str]:
+            value, status = await self.get(key)
+            if value is not None:
+                return value, status
+            if self.shared:
+                value = await self._wait_for_other_worker(key)
+                if value is not None:
+                    return value, COALESCED
+            try:
+                result = await compute()
+                await self.put(key, result)
+            finally:
+                if self.shared:
+                    await asyncio.get_event_loop().run_in_executor(None, self._release, key)
+            return result, MISS
+
+        task = asyncio.ensure_future(_compute_and_store())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        value, status = await asyncio.shield(task)
+        logger.info(f"Result cache {status}: {key[:16]}")
+        return value, status
+
+    def stats(self) -> Dict[str, Any]:
+        """Current cache usage, for logging and monitoring"""
+        return {
+            'memory_entries': len(self._memory),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'disk_path': self.path,
+            'in_flight': len(self._in_flight),
+            'shared': self.shared,
+        }
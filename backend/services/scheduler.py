@@ -0,0 +1,246 @@
+"""Upstream scheduler: concurrency, quota and priority for Gemini calls.
+
+Every upstream call asks the scheduler for a slot. A slot is granted when a
+concurrency slot is free and the request and token buckets (sized to the
+per-minute quotas) hold enough for the call; waiting calls are served by
+lane (interactive before standard before batch) and in arrival order within
+a lane, so bulk analyses can't starve chat. Calls rejected with 429 or 503
+are retried with exponential backoff and full jitter, honouring the retry
+delay the API suggests.
+
+The lane of a call is taken from a context variable set by the endpoint
+(``set_lane``), so it follows the request through helpers and tasks.
+
+With several worker processes, the per-minute buckets live in the node's
+``SharedState`` so all workers draw from one quota; concurrency slots stay
+per process.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import re
+import time
+from typing import Any, Dict, Optional
+
+from services.metrics import registry
+from services.shared_state import SharedState, SharedTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute allowed upstream (0 disables the limit)
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', '0'))
+# Input tokens per minute allowed upstream (0 disables the limit)
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', '0'))
+# Retries of a call rejected with 429 or 503
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '4'))
+# First backoff delay, doubled on every retry, in seconds
+GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '1'))
+# Longest backoff delay, in seconds
+GEMINI_RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', '60'))
+
+# Lanes, served in this order
+LANE_INTERACTIVE = 'interactive'
+LANE_STANDARD = 'standard'
+LANE_BATCH = 'batch'
+LANES = (LANE_INTERACTIVE, LANE_STANDARD, LANE_BATCH)
+
+# HTTP statuses worth retrying: quota exhausted and temporarily unavailable
+RETRYABLE_STATUSES = (429, 503)
+RETRYABLE_ERRORS = ('ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable')
+
+_lane: contextvars.ContextVar[str] = contextvars.ContextVar('upstream_lane', default=LANE_STANDARD)
+
+queue_depth = registry.gauge(
+    'upstream_queue_depth', 'Upstream calls waiting for a slot, by lane', ('lane',))
+queue_wait = registry.histogram(
+    'upstream_queue_wait_seconds', 'Time upstream calls waited for a slot, by lane', ('lane',))
+retries = registry.counter(
+    'gemini_retries_total', 'Upstream calls retried after a 429 or 503, by status', ('status',))
+
+
+def set_lane(lane: str) -> None:
+    """Schedule the upstream calls of the current request in ``lane``"""
+    _lane.set(lane)
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """HTTP status of an upstream error, if it carries one"""
+    code = getattr(error, 'code', None)
+    try:
+        return int(code)
+    except (TypeError, ValueError):
+        pass
+    name = type(error).__name__
+    if name in ('ResourceExhausted', 'TooManyRequests'):
+        return 429
+    if name == 'ServiceUnavailable':
+        return 503
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    return error_status(error) in RETRYABLE_STATUSES or type(error).__name__ in RETRYABLE_ERRORS
+
+
+_RETRY_PATTERNS = (
+    re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE),
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)'),
+    re.compile(r'"retryDelay":\s*"([\d.]+)s"'),
+)
+
+
+def retry_hint(error: BaseException) -> Optional[float]:
+    """Seconds the API asked us to wait before retrying, if it said"""
+    for detail in getattr(error, 'details', None) or ():
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None and hasattr(delay, 'seconds'):
+            return delay.seconds + getattr(delay, 'nanos', 0) / 1e9
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is not None and headers.get('retry-after'):
+        try:
+            return float(headers.get('retry-after'))
+        except ValueError:
+            pass
+    message = str(error)
+    for pattern in _RETRY_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt: int, hint: Optional[float] = None,
+                  base: float = GEMINI_RETRY_BASE_DELAY, cap: float = GEMINI_RETRY_MAX_DELAY) -> float:
+    """Exponential backoff with full jitter, never shorter than the API's hint"""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if hint is not None:
+        delay = max(delay, min(hint, cap) + random.uniform(0, base))
+    return delay
+
+
+class TokenBucket:
+    """Per-minute quota refilled continuously; a limit of 0 means unlimited"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float) -> float:
+        """Take ``amount`` and return 0, or the seconds until it is available (large
+        requests only wait for a full bucket)"""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        wanted = min(amount, self.capacity)
+        if self.tokens >= wanted:
+            self.tokens -= wanted
+            return 0.0
+        return (wanted - self.tokens) / self.rate
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund) the difference between the estimate and the actual usage"""
+        if self.capacity:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class UpstreamScheduler:
+    """Grants upstream slots by lane within the concurrency and per-minute limits"""
+
+    def __init__(self, max_concurrency: int, rpm: int = GEMINI_RPM, tpm: int = GEMINI_TPM,
+                 shared_state: Optional[SharedState] = None):
+        self.max_concurrency = max_concurrency
+        if shared_state is not None:
+            self.requests = SharedTokenBucket(shared_state, 'gemini_rpm', rpm)
+            self.tokens = SharedTokenBucket(shared_state, 'gemini_tpm', tpm)
+        else:
+            self.requests = TokenBucket(rpm)
+            self.tokens = TokenBucket(tpm)
+        self.shared = shared_state is not None
+        self.in_flight = 0
+        self._waiters: list = []
+        self._order = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.waiting = {lane: 0 for lane in LANES}
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and self.in_flight < self.max_concurrency:
+            _, _, future, tokens = self._waiters[0]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            wait = self.requests.try_take(1)
+            if not wait:
+                wait = self.tokens.try_take(tokens)
+                if wait:
+                    # Hand the request back until the tokens are there too
+                    self.requests.adjust(-1)
+            if wait > 0:
+                self._timer = asyncio.get_event_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, tokens: int = 0, lane: Optional[str] = None) -> None:
+        """Wait for a slot; pair every successful call with ``release``"""
+        lane = lane or current_lane()
+        priority = LANES.index(lane) if lane in LANES else LANES.index(LANE_STANDARD)
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future, tokens))
+        self.waiting[lane] = self.waiting.get(lane, 0) + 1
+        queue_depth.labels(lane).inc()
+        started = time.perf_counter()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the caller gave up
+                self.release()
+            raise
+        finally:
+            self.waiting[lane] -= 1
+            queue_depth.labels(lane).dec()
+            queue_wait.labels(lane).observe(time.perf_counter() - started)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def record_usage(self, estimated: int, actual: Optional[int]) -> None:
+        """Correct the token bucket once the real prompt size is known"""
+        if actual:
+            self.tokens.adjust(actual - estimated)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self.waiting.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued': dict(self.waiting),
+            'rpm_limit': int(self.requests.capacity),
+            'tpm_limit': int(self.tokens.capacity),
+            'shared_quota': self.shared,
+        }
@@ -0,0 +1,309 @@
+"""Node-local state shared by the worker processes of a multi-worker server.
+
+When the server runs several worker processes (``WORKERS``), each has its own
+memory, so per-process quota buckets would each allow the full per-minute
+quota, every worker would upload the same large file to the File API, and a
+follow-up question would only find its chat session or document on the
+worker that happened to create it. This module keeps that state in one
+SQLite file in WAL mode instead:
+
+- a bucket is refilled, checked and drawn from in one ``BEGIN IMMEDIATE``
+  transaction, so two workers can't both spend the last tokens;
+- File API handles are indexed by content hash so a file uploaded by one
+  worker is reused by all of them;
+- chat sessions and registered documents are stored as records that every
+  worker reads, with the same LRU and TTL limits as in a single process.
+
+Connections are opened per process (and reopened after a fork). Buckets and
+handles are used from the event loop thread, so they wait at most
+``BUSY_TIMEOUT`` for another worker's lock: a bucket that is busy is retried
+shortly like an empty one, and a handle that can't be read or written is
+simply not shared. Session and document records must not be lost, so they
+go through a second connection that waits up to ``RECORD_TIMEOUT`` and is
+only used from executor threads. Start-up statements wait longest.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# SQLite file with the state shared by the worker processes of one node
+SHARED_STATE_PATH = os.getenv(
+    'SHARED_STATE_PATH',
+    str(Path(__file__).resolve().parent.parent / '.cache' / 'shared.sqlite3')
+)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS file_handles ('
+    ' key TEXT PRIMARY KEY, name TEXT NOT NULL, expires_at REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS chat_sessions ('
+    ' id TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL, last_used REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS documents ('
+    ' id TEXT PRIMARY KEY, content_key TEXT NOT NULL, data TEXT NOT NULL, size INTEGER NOT NULL,'
+    ' questions INTEGER NOT NULL DEFAULT 0, last_used REAL NOT NULL, expires_at REAL)',
+    'CREATE INDEX IF NOT EXISTS documents_by_content ON documents (content_key)',
+)
+
+# Seconds the event loop may block waiting for another worker's lock
+BUSY_TIMEOUT = 0.05
+# Seconds session and document records wait for another worker's lock (off the event loop)
+RECORD_TIMEOUT = 5
+# Seconds start-up statements wait for the other workers
+SETUP_TIMEOUT = 30
+# Seconds before a bucket that was locked by another worker is tried again
+LOCKED_RETRY = 0.01
+
+
+def connect(path: str, timeout: float = BUSY_TIMEOUT) -> sqlite3.Connection:
+    """Connection tuned for small transactions from several processes"""
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class SharedState:
+    """Quota buckets, File API handles, chat sessions and documents in a SQLite file shared across processes"""
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._records_conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._records_lock = threading.Lock()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        for statement in SCHEMA:
+            self._setup(statement)
+
+    def _forked(self) -> None:
+        # A connection must not be carried across a fork
+        if self._pid != os.getpid():
+            self._conn = self._records_conn = None
+            self._pid = os.getpid()
+
+    def _connection(self) -> sqlite3.Connection:
+        self._forked()
+        if self._conn is None:
+            self._conn = connect(self.path)
+        return self._conn
+
+    @contextmanager
+    def _records(self) -> Iterator[sqlite3.Connection]:
+        """Record connection inside one write transaction"""
+        with self._records_lock:
+            self._forked()
+            if self._records_conn is None:
+                self._records_conn = connect(self.path, RECORD_TIMEOUT)
+            conn = self._records_conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _setup(self, sql: str, params: Tuple = ()) -> None:
+        """Run a start-up statement, waiting as long as the other workers need"""
+        conn = connect(self.path, SETUP_TIMEOUT)
+        try:
+            conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    def _execute(self, sql: str, params: Tuple = ()) -> Optional[Tuple]:
+        """Run one statement and return its first row"""
+        with self._lock:
+            return self._connection().execute(sql, params).fetchone()
+
+    # Token buckets
+
+    def init_bucket(self, name: str, capacity: float) -> None:
+        """Create a full bucket unless another worker already did"""
+        self._setup('INSERT OR IGNORE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                    (name, capacity, time.time()))
+
+    def bucket_try_take(self, name: str, amount: float, rate: float, capacity: float) -> float:
+        """Refill a bucket and take ``amount`` from it in one transaction.
+
+        Returns 0 once taken, or the seconds until ``amount`` is available;
+        nothing is written unless tokens are taken.
+        """
+        with self._lock:
+            conn = self._connection()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                # Another worker holds the lock: try again shortly, like an empty bucket
+                return LOCKED_RETRY
+            try:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+                now = time.time()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                if tokens < amount:
+                    conn.execute('ROLLBACK')
+                    return (amount - tokens) / rate
+                conn.execute('UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?',
+                             (tokens - amount, now, name))
+                conn.execute('COMMIT')
+                return 0.0
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+
+    def bucket_add(self, name: str, amount: float, rate: float, capacity: float) -> None:
+        """Refill a bucket and add ``amount`` (negative to take)"""
+        try:
+            self._execute(
+                'UPDATE buckets SET tokens = MIN(?1, MIN(?1, tokens + MAX(0, ?2 - updated) * ?3) + ?4), '
+                'updated = ?2 WHERE name = ?5',
+                (capacity, time.time(), rate, amount, name)
+            )
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Shared bucket {name} not adjusted by {amount}: {e}")
+
+    # File API handles
+
+    def get_handle(self, key: str) -> Optional[Tuple[str, float]]:
+        """Name and expiry of a handle uploaded by any worker"""
+        try:
+            row = self._execute('SELECT name, expires_at FROM file_handles WHERE key = ?', (key,))
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Shared file handle lookup failed: {e}")
+            return None
+        return (row[0], row[1]) if row is not None else None
+
+    def put_handle(self, key: str, name: str, expires_at: float) -> None:
+        try:
+            self._execute('INSERT OR REPLACE INTO file_handles (key, name, expires_at) VALUES (?, ?, ?)',
+                          (key, name, expires_at))
+            self._execute('DELETE FROM file_handles WHERE expires_at < ?', (time.time(),))
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Shared file handle not saved: {e}")
+
+    # Chat sessions (called from executor threads)
+
+    def get_session(self, session_id: str, ttl: float) -> Optional[Dict]:
+        """Data of a session used within the last ``ttl`` seconds"""
+        with self._records() as conn:
+            row = conn.execute('SELECT data FROM chat_sessions WHERE id = ? AND last_used >= ?',
+                               (session_id, time.time() - ttl)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_session(self, session_id: str, data: Dict, max_sessions: int, ttl: float) -> bool:
+        """Store version ``data['version']`` of a session if the stored one is the version before.
+
+        Returns False when another worker saved the session meanwhile (or it was
+        dropped). Expired sessions and the least recently used ones beyond
+        ``max_sessions`` are dropped.
+        """
+        version, last_used = data['version'], data['last_used']
+        with self._records() as conn:
+            if version == 1:
+                stored = conn.execute('INSERT OR IGNORE INTO chat_sessions (id, data, version, last_used) '
+                                      'VALUES (?, ?, ?, ?)',
+                                      (session_id, json.dumps(data), version, last_used)).rowcount == 1
+            else:
+                stored = conn.execute('UPDATE chat_sessions SET data = ?, version = ?, last_used = ? '
+                                      'WHERE id = ? AND version = ?',
+                                      (json.dumps(data), version, last_used, session_id, version - 1)).rowcount == 1
+            conn.execute('DELETE FROM chat_sessions WHERE last_used < ?', (time.time() - ttl,))
+            conn.execute('DELETE FROM chat_sessions WHERE id NOT IN '
+                         '(SELECT id FROM chat_sessions ORDER BY last_used DESC LIMIT ?)', (max_sessions,))
+        return stored
+
+    def delete_session(self, session_id: str) -> bool:
+        with self._records() as conn:
+            return conn.execute('DELETE FROM chat_sessions WHERE id = ?', (session_id,)).rowcount == 1
+
+    # Documents (called from executor threads)
+
+    def get_document(self, document_id: str, ttl: float, with_data: bool = True) -> Optional[Dict[str, Any]]:
+        """Record of a live document; ``data`` (the prepared payload) is only read when asked for"""
+        now = time.time()
+        columns = 'questions' + (', data' if with_data else '')
+        with self._records() as conn:
+            row = conn.execute(f'SELECT {columns} FROM documents WHERE id = ? AND last_used >= ? '
+                               'AND (expires_at IS NULL OR expires_at > ?)',
+                               (document_id, now - ttl, now)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE documents SET last_used = ? WHERE id = ?', (now, document_id))
+        if row is None:
+            return None
+        record = {'questions': row[0]}
+        if with_data:
+            record['data'] = json.loads(row[1])
+        return record
+
+    def find_document(self, content_key: str) -> Optional[str]:
+        """Id of the document stored for ``content_key``, live or not"""
+        with self._records() as conn:
+            row = conn.execute('SELECT id FROM documents WHERE content_key = ?', (content_key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_document(self, document_id: str, content_key: str, data: Dict, size: int,
+                     expires_at: Optional[float], max_bytes: int, max_documents: int, ttl: float) -> int:
+        """Store a document in place of any other with the same content key; returns the evictions"""
+        now = time.time()
+        evicted = 0
+        with self._records() as conn:
+            conn.execute('DELETE FROM documents WHERE content_key = ?', (content_key,))
+            conn.execute('INSERT INTO documents (id, content_key, data, size, last_used, expires_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (document_id, content_key, json.dumps(data), size, now, expires_at))
+            conn.execute('DELETE FROM documents WHERE last_used < ? OR expires_at <= ?', (now - ttl, now))
+            while True:
+                count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents').fetchone()
+                if count <= max_documents and total <= max_bytes:
+                    return evicted
+                conn.execute('DELETE FROM documents WHERE id = '
+                             '(SELECT id FROM documents ORDER BY last_used LIMIT 1)')
+                evicted += 1
+
+    def add_question(self, document_id: str) -> Optional[int]:
+        """Count a question about a document; returns the new count"""
+        with self._records() as conn:
+            conn.execute('UPDATE documents SET questions = questions + 1 WHERE id = ?', (document_id,))
+            row = conn.execute('SELECT questions FROM documents WHERE id = ?', (document_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete_document(self, document_id: str) -> bool:
+        with self._records() as conn:
+            return conn.execute('DELETE FROM documents WHERE id = ?', (document_id,)).rowcount == 1
+
+    def stats(self) -> Dict:
+        return {'shared_state_path': self.path}
+
+
+class SharedTokenBucket:
+    """``TokenBucket`` kept in ``SharedState`` so every worker draws from one quota"""
+
+    def __init__(self, state: SharedState, name: str, per_minute: int):
+        self.state = state
+        self.name = name
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        if self.capacity:
+            state.init_bucket(name, self.capacity)
+
+    def try_take(self, amount: float) -> float:
+        """Take ``amount`` and return 0, or the seconds until it is available (large
+        requests only wait for a full bucket)"""
+        if not self.capacity:
+            return 0.0
+        return self.state.bucket_try_take(self.name, min(amount, self.capacity), self.rate, self.capacity)
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund) the difference between the estimate and the actual usage"""
+        if self.capacity:
+            self.state.bucket_add(self.name, -amount, self.rate, self.capacity)
@@ -0,0 +1,219 @@
+"""Structured, low-overhead logging.
+
+Request handlers only put a record on an in-memory queue; formatting and
+writing happen on a listener thread. Events carry keyword fields that may be
+zero-argument callables, which are only evaluated when the record is
+actually written, so expensive values (previews, header dumps) cost nothing
+when the level is disabled or the request is not sampled. Fields that can
+hold user content or secrets are redacted before they are written.
+
+Usage:
+    log_event(logger, logging.INFO, 'pdf_analyzed', file=name, chars=lambda: len(text))
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from typing import Any, Dict, Optional
+
+# Level of the application loggers
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# `json` (one object per line) or `text`
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# Records buffered for the writer thread; further records are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Fraction of requests whose INFO/DEBUG records are kept, per path prefix,
+# e.g. "/health=0.01,/process_file=1" (warnings and errors are always kept)
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '/health=0.01,/metrics=0.01,/test-connection=0.1')
+# Set to 0 to write prompts, model output and other payload fields in full
+LOG_REDACT = os.getenv('LOG_REDACT', '1') == '1'
+
+# Fields that may contain user content, model output or credentials
+REDACTED_FIELDS = frozenset({
+    'prompt', 'system_prompt', 'message', 'text', 'preview', 'data', 'content',
+    'authorization', 'cookie', 'x-goog-api-key', 'api_key',
+})
+
+# Per-request context, set by the request middleware
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('request_id', default=None)
+_route: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('route', default=None)
+_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar('sampled', default=True)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional['NonBlockingQueueHandler'] = None
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """Parse "prefix=rate,..." into a mapping, ignoring malformed entries"""
+    rates = {}
+    for item in spec.split(','):
+        prefix, _, rate = item.strip().partition('=')
+        try:
+            rates[prefix.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+_sample_rates = parse_sample_rates(LOG_SAMPLE_RATES)
+
+
+def sample_rate(path: str) -> float:
+    """Sample rate of the longest configured prefix matching the path"""
+    matches = [prefix for prefix in _sample_rates if prefix and path.startswith(prefix)]
+    return _sample_rates[max(matches, key=len)] if matches else 1.0
+
+
+def start_request(request_id: str, path: str) -> bool:
+    """Bind the request context and decide whether its routine records are kept"""
+    rate = sample_rate(path)
+    sampled = rate >= 1.0 or random.random() < rate
+    _request_id.set(request_id)
+    _route.set(path)
+    _sampled.set(sampled)
+    return sampled
+
+
+def redact(key: str, value: Any) -> Any:
+    """Replace payload values with a short description"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if LOG_REDACT and key.lower() in REDACTED_FIELDS and value is not None:
+        return f"<redacted {len(str(value))} chars>"
+    return value
+
+
+def resolve_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Evaluate lazy fields and redact payloads (called only when a record is written)"""
+    resolved = {}
+    for key, value in fields.items():
+        if callable(value):
+            try:
+                value = value()
+            except Exception as e:
+                value = f"<error: {type(e).__name__}>"
+        if isinstance(value, dict) and key.lower() not in REDACTED_FIELDS:
+            value = {k: redact(str(k), v) for k, v in value.items()}
+        resolved[key] = redact(key, value)
+    return resolved
+
+
+def log_event(logger: logging.Logger, level: int, event: str, exc_info: bool = False,
+              **fields: Any) -> None:
+    """Log an event with structured fields; nothing is computed if the level is off"""
+    if not logger.isEnabledFor(level) or (level < logging.WARNING and not _sampled.get()):
+        return
+    logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+
+class SamplingFilter(logging.Filter):
+    """Drop INFO/DEBUG records of requests that were not sampled"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or _sampled.get()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks or formats on the calling thread"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting (and lazy fields) is left to the listener thread
+        record.request_id = _request_id.get()
+        record.route = _route.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """Render records as JSON lines or as `key=value` text"""
+
+    def __init__(self, json_output: bool = True):
+        super().__init__()
+        self.json_output = json_output
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        entry.update(resolve_fields(getattr(record, 'fields', None) or {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        if self.json_output:
+            return json.dumps(entry, default=str)
+        exc = entry.pop('exc', None)
+        head = f"{entry.pop('ts')} {entry.pop('level')} {entry.pop('logger')} - {entry.pop('event')}"
+        tail = ' '.join(f"{key}={value}" for key, value in entry.items())
+        line = f"{head} {tail}" if tail else head
+        return f"{line}\n{exc}" if exc else line
+
+
+def configure_logging(stream=None, level: str = LOG_LEVEL, json_output: Optional[bool] = None) -> None:
+    """Route all logging through the queue handler and start the writer thread"""
+    global _listener, _queue_handler
+    shutdown_logging()
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(StructuredFormatter(LOG_FORMAT == 'json' if json_output is None else json_output))
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, writer, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the writer thread"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+
+
+def _restart_after_fork() -> None:
+    """Give a forked worker its own queue and writer thread; the parent's thread doesn't survive a fork"""
+    global _listener
+    if _listener is None:
+        return
+    _queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, *_listener.handlers,
+                                               respect_handler_level=True)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def dropped_records() -> int:
+    """Records dropped because the queue was full"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
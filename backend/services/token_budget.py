@@ -0,0 +1,149 @@
+"""Pre-flight token budgeting for model requests.
+
+Every request is estimated locally before it goes upstream, using the
+per-content-type rates Gemini bills by: about 4 characters per token for
+text, a flat 258 tokens per image and per PDF page, 32 tokens per second of
+audio and 263 per second of video (derived from the byte size at typical
+bitrates). A request above ``MAX_INPUT_TOKENS`` would only fail upstream
+after a full round trip, so text parts are trimmed to fit and anything that
+still doesn't fit is rejected with ``TokenBudgetExceeded``; files headed for
+the File API are checked by size before they are uploaded.
+
+Estimates are deliberately cheap (no tokenizer, no decoding of media) and
+are corrected by the scheduler once the reported usage comes back.
+"""
+import logging
+import os
+from typing import Any, List, Optional
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Input tokens accepted per request (gemini-2.0-flash takes 1,048,576); lower it to cap cost
+MAX_INPUT_TOKENS = int(os.getenv('MAX_INPUT_TOKENS', str(1024 * 1024)))
+
+# Estimation rates
+CHARS_PER_TOKEN = 4
+BYTES_PER_TEXT_TOKEN = 4
+IMAGE_TOKENS = 258
+PDF_PAGE_TOKENS = 258
+# PDFs whose page count isn't known: roughly 25 KB per page
+BYTES_PER_PDF_PAGE = 25 * 1024
+# 32 tokens per second of audio at 128 kbit/s
+BYTES_PER_AUDIO_TOKEN = 500
+# 263 tokens per second of video at about 1 Mbit/s
+BYTES_PER_VIDEO_TOKEN = 475
+# Anything else
+BYTES_PER_DOCUMENT_TOKEN = 100
+
+TRUNCATION_NOTE = "\n\n[Truncated: the rest of this input exceeded the model's token limit]"
+
+budget_outcomes = registry.counter(
+    'token_budget_total', 'Requests over the input token budget, by outcome (trimmed, rejected)', ('outcome',))
+
+
+class TokenBudgetExceeded(ValueError):
+    """The estimated input doesn't fit the model's token limit"""
+
+    def __init__(self, estimated: int, limit: int, what: str = 'Request'):
+        self.estimated = estimated
+        self.limit = limit
+        super().__init__(f"{what} is about {estimated:,} tokens, above the limit of {limit:,} input tokens")
+
+
+def estimate_bytes_tokens(size: int, mime_type: str, pages: Optional[int] = None) -> int:
+    """Estimated tokens of a file of ``size`` bytes sent as a blob or File API handle"""
+    if mime_type.startswith('text/'):
+        return size // BYTES_PER_TEXT_TOKEN + 1
+    if mime_type.startswith('image/'):
+        return IMAGE_TOKENS
+    if mime_type == 'application/pdf':
+        return PDF_PAGE_TOKENS * (pages or max(1, size // BYTES_PER_PDF_PAGE))
+    if mime_type.startswith('audio/'):
+        return size // BYTES_PER_AUDIO_TOKEN + 1
+    if mime_type.startswith('video/'):
+        return size // BYTES_PER_VIDEO_TOKEN + 1
+    return max(IMAGE_TOKENS, size // BYTES_PER_DOCUMENT_TOKEN)
+
+
+def estimate_tokens(contents: Any) -> int:
+    """Approximate input tokens of a request, its parts or chat turns"""
+    if isinstance(contents, str):
+        return len(contents) // CHARS_PER_TOKEN + 1
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_tokens(part) for part in contents)
+    if isinstance(contents, dict):
+        if 'parts' in contents:
+            return estimate_tokens(contents['parts'])
+        data = contents.get('data') or b''
+        return estimate_bytes_tokens(len(data), str(contents.get('mime_type', '')))
+    # File API handles carry their size and type
+    size = getattr(contents, 'size_bytes', None)
+    mime_type = getattr(contents, 'mime_type', None)
+    if isinstance(size, int) and isinstance(mime_type, str):
+        return estimate_bytes_tokens(size, mime_type)
+    return IMAGE_TOKENS
+
+
+def check_file(size: Optional[int], mime_type: str, file_name: str, limit: int = MAX_INPUT_TOKENS) -> int:
+    """Reject a file before it is uploaded if it can't fit the budget; returns the estimate"""
+    estimated = estimate_bytes_tokens(size or 0, mime_type)
+    if estimated > limit:
+        budget_outcomes.labels('rejected').inc()
+        raise TokenBudgetExceeded(estimated, limit, f"File '{file_name}'")
+    return estimated
+
+
+def _trim_text(text: str, excess: int) -> str:
+    keep = max(0, len(text) - (excess + estimate_tokens(TRUNCATION_NOTE)) * CHARS_PER_TOKEN)
+    return text[:keep] + TRUNCATION_NOTE
+
+
+def _trimmable(part: Any) -> Optional[str]:
+    """Text of a part that may be shortened: plain strings and inline text blobs"""
+    if isinstance(part, str):
+        return part
+    if isinstance(part, dict) and str(part.get('mime_type', '')).startswith('text/') and 'data' in part:
+        return bytes(part['data']).decode('utf-8', errors='replace')
+    return None
+
+
+def fit_to_budget(contents: Any, limit: int = MAX_INPUT_TOKENS) -> Any:
+    """Trim the largest text parts of a request until it fits ``limit``, or reject it.
+
+    The first part of a list is the prompt and is never trimmed.
+    """
+    estimated = estimate_tokens(contents)
+    if estimated <= limit:
+        return contents
+
+    parts: List[Any] = [contents] if isinstance(contents, str) else list(contents)
+    texts = {index: _trimmable(part) for index, part in enumerate(parts)}
+    first = 0 if isinstance(contents, str) else 1
+    candidates = [index for index, text in texts.items() if text is not None and index >= first]
+
+    for index in sorted(candidates, key=lambda index: -len(texts[index])):
+        excess = estimated - limit
+        if excess <= 0:
+            break
+        before = estimate_tokens(parts[index])
+        trimmed = _trim_text(texts[index], excess)
+        parts[index] = trimmed if isinstance(parts[index], str) else {
+            **parts[index], 'data': trimmed.encode('utf-8')
+        }
+        estimated += estimate_tokens(parts[index]) - before
+
+    if estimated > limit:
+        budget_outcomes.labels('rejected').inc()
+        raise TokenBudgetExceeded(estimated, limit)
+    budget_outcomes.labels('trimmed').inc()
+    logger.warning(f"Trimmed request text to fit the token budget of {limit:,} tokens")
+    return parts[0] if isinstance(contents, str) else parts
+
+
+def check_budget(estimated: int, limit: int = MAX_INPUT_TOKENS, what: str = 'Request') -> None:
+    """Reject a request that can't be trimmed (e.g. a chat turn) when it is over the limit"""
+    if estimated > limit:
+        budget_outcomes.labels('rejected').inc()
+        raise TokenBudgetExceeded(estimated, limit, what)
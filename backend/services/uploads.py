@@ -0,0 +1,52 @@
+"""Helpers for turning uploaded files into model request parts.
+
+Starlette already spools the multipart body into a ``SpooledTemporaryFile``;
+the upload is read from there exactly once and the resulting buffer is shared
+by hashing and the model request. The SDK sends inline data as raw bytes, so
+no temp-file round trip or base64 copy is needed.
+"""
+import io
+from pathlib import Path
+from typing import Dict
+
+from fastapi import UploadFile
+
+# Mime types sent to Gemini for each supported extension
+MIME_TYPES = {
+    '.pdf': 'application/pdf',
+    '.txt': 'text/plain',
+    '.csv': 'text/csv',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.mp3': 'audio/mpeg',
+    '.mp4': 'video/mp4'
+}
+
+
+def get_mime_type(file_name: str) -> str:
+    """Determine mime type based on file extension"""
+    return MIME_TYPES.get(Path(file_name).suffix.lower(), 'application/octet-stream')
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Read the spooled upload body into a single buffer"""
+    await file.seek(0)
+    return await file.read()
+
+
+def detach_upload(file: UploadFile) -> UploadFile:
+    """Take over the spooled file of an upload so it outlives the request handler.
+
+    FastAPI closes form files once the endpoint returns, before a streaming
+    response runs; the returned upload stays open until the caller closes it.
+    """
+    detached = UploadFile(file.file, size=file.size, filename=file.filename, headers=file.headers)
+    file.file = io.BytesIO()
+    return detached
+
+
+def inline_part(data: bytes, mime_type: str) -> Dict:
+    """Build an inline blob part for a model request from the raw bytes"""
+    return {"mime_type": mime_type, "data": data}
@@ -0,0 +1,147 @@
+"""Token usage accounting per request and per endpoint.
+
+The request middleware opens a ``RequestUsage`` in a context variable; every
+upstream call made while serving the request (map-reduce chunks, retries and
+hedges included) adds the prompt and output tokens reported in its
+``usage_metadata``, so the endpoint can return what the request actually
+cost. The same counts are aggregated per route template in the
+``UsageLedger`` (served by ``GET /usage``) and in the
+``gemini_route_tokens_total`` counter, to find the most expensive traffic.
+
+Work outside a request, such as batch job tasks, opens its own usage with
+an explicit route name. Child usages (e.g. one per file of a batch) roll up
+into the request's usage.
+"""
+import contextvars
+from typing import Any, Dict, List, Optional
+
+from services.metrics import registry
+
+route_tokens = registry.counter(
+    'gemini_route_tokens_total', 'Gemini tokens spent per route and direction (prompt, output)',
+    ('route', 'direction'))
+
+_current: contextvars.ContextVar[Optional['RequestUsage']] = contextvars.ContextVar('request_usage', default=None)
+
+
+class UsageLedger:
+    """Token usage aggregated per route; only requests that called upstream are counted"""
+
+    def __init__(self):
+        self.routes: Dict[str, Dict[str, int]] = {}
+
+    def _entry(self, route: str) -> Dict[str, int]:
+        entry = self.routes.get(route)
+        if entry is None:
+            entry = self.routes[route] = {
+                'requests': 0, 'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'estimated_tokens': 0,
+            }
+        return entry
+
+    def record_request(self, route: str) -> None:
+        self._entry(route)['requests'] += 1
+
+    def record_call(self, route: str, prompt_tokens: int, output_tokens: int, estimated_tokens: int) -> None:
+        entry = self._entry(route)
+        entry['calls'] += 1
+        entry['prompt_tokens'] += prompt_tokens
+        entry['output_tokens'] += output_tokens
+        entry['estimated_tokens'] += estimated_tokens
+        route_tokens.labels(route, 'prompt').inc(prompt_tokens)
+        route_tokens.labels(route, 'output').inc(output_tokens)
+
+    def top(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Routes by total tokens spent, most expensive first"""
+        rows = [
+            {
+                'route': route,
+                **entry,
+                'total_tokens': entry['prompt_tokens'] + entry['output_tokens'],
+                'tokens_per_request': round((entry['prompt_tokens'] + entry['output_tokens'])
+                                            / entry['requests'], 1) if entry['requests'] else None,
+            }
+            for route, entry in self.routes.items()
+        ]
+        rows.sort(key=lambda row: row['total_tokens'], reverse=True)
+        return rows[:limit]
+
+
+ledger = UsageLedger()
+
+
+class RequestUsage:
+    """Tokens spent by one request (or one unit of background work)"""
+
+    def __init__(self, route: Optional[str] = None, scope: Optional[Dict] = None,
+                 parent: Optional['RequestUsage'] = None):
+        self._route = route
+        self._scope = scope
+        self.parent = parent
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.estimated_tokens = 0
+
+    @property
+    def route(self) -> str:
+        if self._route is not None:
+            return self._route
+        if self.parent is not None:
+            return self.parent.route
+        # The route template is only known once the request has been routed
+        route = self._scope.get('route') if self._scope is not None else None
+        return route.path if route is not None else 'unmatched'
+
+    def add(self, prompt_tokens: int, output_tokens: int, estimated_tokens: int) -> None:
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.output_tokens += output_tokens
+        self.estimated_tokens += estimated_tokens
+        if self.parent is not None:
+            self.parent.add(prompt_tokens, output_tokens, estimated_tokens)
+            return
+        if self.calls == 1:
+            # Requests are counted once they reach upstream
+            ledger.record_request(self.route)
+        ledger.record_call(self.route, prompt_tokens, output_tokens, estimated_tokens)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            'calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'output_tokens': self.output_tokens,
+            'total_tokens': self.prompt_tokens + self.output_tokens,
+            'estimated_prompt_tokens': self.estimated_tokens,
+        }
+
+
+def begin_usage(route: Optional[str] = None, scope: Optional[Dict] = None) -> RequestUsage:
+    """Start counting the usage of the current request or task.
+
+    Inside a request that is already counted, the new usage rolls up into it.
+    """
+    parent = _current.get() if route is None and scope is None else None
+    usage = RequestUsage(route, scope, parent=parent)
+    _current.set(usage)
+    return usage
+
+
+def current_usage() -> Optional[RequestUsage]:
+    return _current.get()
+
+
+def usage_dict() -> Optional[Dict[str, int]]:
+    """Usage of the current request so far, for responses"""
+    usage = _current.get()
+    return usage.as_dict() if usage is not None else None
+
+
+def record_response(response: Any, estimated_tokens: int = 0) -> None:
+    """Add the usage reported on a Gemini response to the current request"""
+    usage = _current.get()
+    if usage is None:
+        return
+    metadata = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(metadata, 'prompt_token_count', None) or 0
+    output_tokens = getattr(metadata, 'candidates_token_count', None) or 0
+    usage.add(prompt_tokens, output_tokens, estimated_tokens)
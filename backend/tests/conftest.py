@@ -0,0 +1,57 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+BACKEND = Path(__file__).resolve().parent.parent
+
+# Make the `services` package importable regardless of where pytest is started
+sys.path.insert(0, str(BACKEND))
+# ... and the simulated Gemini backend used by the endpoint tests
+sys.path.insert(0, str(BACKEND / 'benchmarks'))
+
+# The app reads its settings on import: keep its state out of the working tree and never call upstream
+STATE_DIR = tempfile.mkdtemp(prefix='backend-tests-')
+os.environ.setdefault('GOOGLE_API_KEY', 'test-key')
+os.environ.update(
+    GEMINI_WARMUP='0',
+    HEALTH_PROBE_INTERVAL='0',
+    RESULT_CACHE_PATH='',
+    SHARED_STATE_PATH=os.path.join(STATE_DIR, 'shared.sqlite3'),
+    JOBS_PATH=os.path.join(STATE_DIR, 'jobs.sqlite3'),
+    JOB_DATA_DIR=os.path.join(STATE_DIR, 'jobs'),
+)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(STATE_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def app_client():
+    from fastapi.testclient import TestClient
+
+    import services.app as app_module
+
+    # One client for the session: leaving it shuts down the app's thread pools
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.fixture
+def fake_backend(app_client):
+    """Simulated Gemini backend behind the app, with an empty result cache"""
+    import services.app as app_module
+    from fake_gemini import FakeConfig, install
+
+    app_module.result_cache._memory.clear()
+    return install(app_module, FakeConfig(latency='constant:0.05', output_tokens=5, seed=1))
+
+
+@pytest.fixture
+def client(app_client, fake_backend):
+    """Client of the app, answered by ``fake_backend``"""
+    return app_client
@@ -0,0 +1,105 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from services.admission import (
+    REJECT_CLIENT_QUEUE_FULL, REJECT_QUEUE_FULL, REJECT_TIMEOUT, AdmissionController, AdmissionMiddleware,
+    AdmissionRejected, RouteQueue,
+)
+
+
+def test_waiting_clients_are_served_round_robin():
+    queue = RouteQueue('/process_file', concurrency=1, queue_size=10, client_queue=10, max_wait=5)
+    order = []
+
+    async def request(client, name):
+        await queue.acquire(client)
+        order.append(name)
+        await asyncio.sleep(0.01)
+        queue.release(0.01)
+
+    async def run():
+        tasks = [asyncio.ensure_future(request('batch', f'batch{i}')) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(request('chat', 'chat')))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    # The second client doesn't wait behind the whole batch
+    assert order == ['batch0', 'batch1', 'chat', 'batch2', 'batch3']
+    assert queue.active == 0 and queue.waiting == 0
+
+
+def test_full_queues_reject_with_retry_after():
+    queue = RouteQueue('/process_file', concurrency=1, queue_size=2, client_queue=1, max_wait=5)
+
+    async def run():
+        await queue.acquire('a')
+        waiting = asyncio.ensure_future(queue.acquire('a'))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as client_full:
+            await queue.acquire('a')
+        other = asyncio.ensure_future(queue.acquire('b'))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as queue_full:
+            await queue.acquire('c')
+        queue.release(1.0)
+        await waiting
+        queue.release(1.0)
+        await other
+        queue.release(1.0)
+        return client_full.value, queue_full.value
+
+    client_full, queue_full = asyncio.run(run())
+    assert client_full.reason == REJECT_CLIENT_QUEUE_FULL
+    assert queue_full.reason == REJECT_QUEUE_FULL
+    assert queue_full.retry_after >= 1
+    assert queue.rejected == 2 and queue.active == 0 and queue.waiting == 0
+
+
+def test_requests_waiting_too_long_are_rejected():
+    queue = RouteQueue('/process_file', concurrency=1, queue_size=5, max_wait=0.05)
+
+    async def run():
+        await queue.acquire('a')
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await queue.acquire('b')
+        queue.release(1.0)
+        return timed_out.value
+
+    assert asyncio.run(run()).reason == REJECT_TIMEOUT
+    assert queue.active == 0 and queue.waiting == 0 and not queue._clients
+
+
+def test_middleware_answers_503_when_saturated():
+    app = FastAPI()
+    controller = AdmissionController({'/slow': 1}, queue_size=0)
+    app.add_middleware(AdmissionMiddleware, controller=controller)
+    release = asyncio.Event()
+
+    @app.post('/slow')
+    async def slow():
+        await release.wait()
+        return {'ok': True}
+
+    @app.get('/fast')
+    async def fast():
+        return {'ok': True}
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            first = asyncio.ensure_future(client.post('/slow'))
+            await asyncio.sleep(0.05)
+            rejected = await client.post('/slow', headers={'X-Client-ID': 'other'})
+            unadmitted = await client.get('/fast')
+            release.set()
+            return await first, rejected, unadmitted
+
+    first, rejected, unadmitted = asyncio.run(run())
+    assert first.status_code == 200 and unadmitted.status_code == 200
+    assert rejected.status_code == 503
+    assert int(rejected.headers['retry-after']) >= 1
+    assert rejected.json()['retry_after'] == int(rejected.headers['retry-after'])
+    assert controller.stats()['/slow']['rejected'] == 1
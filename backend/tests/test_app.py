@@ -0,0 +1,314 @@
+import asyncio
+import json
+import time
+
+import fitz
+import pytest
+
+from services.health import HealthProber
+
+
+def make_pdf(pages):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        for line in range(4):
+            page.insert_text((72, 72 + 20 * line), f"Page {i}, line {line}: a proper text layer with enough to count.")
+    return doc.tobytes()
+
+
+def sse_events(body):
+    """(event, data) pairs of a Server-Sent Events body"""
+    events = []
+    for message in body.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in message.splitlines())
+        events.append((fields.get('event'), json.loads(fields['data'])))
+    return events
+
+
+def _slow_and_failing(backend):
+    """Answer prompts mentioning 'slow' late and fail those mentioning 'fail'"""
+    respond = backend.respond
+
+    async def _respond(contents, stream):
+        prompt = contents[0] if isinstance(contents, list) and isinstance(contents[0], str) else ''
+        if 'fail' in prompt:
+            raise ValueError("simulated failure")
+        if 'slow' in prompt:
+            await asyncio.sleep(0.3)
+        return await respond(contents, stream)
+
+    backend.respond = _respond
+
+
+def test_process_files_streams_in_completion_order(client, fake_backend):
+    _slow_and_failing(fake_backend)
+    files = [('files', (name, f"contents of {name}".encode(), 'text/plain'))
+             for name in ('slow.txt', 'fast.txt', 'bad.txt')]
+    prompts = {'slow.txt': 'slow summary', 'fast.txt': 'summary', 'bad.txt': 'fail here'}
+
+    response = client.post('/process-files', files=files, data={'prompts': json.dumps(prompts)})
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    # One line per file as it finishes, the slow one last, then the summary
+    assert [line['file_id'] for line in lines[:3]] == ['bad.txt', 'fast.txt', 'slow.txt']
+    failed = lines[0]
+    assert failed['success'] is False and 'simulated failure' in failed['error']
+    assert all(line['success'] and line['analysis']['text'] for line in lines[1:3])
+    assert lines[3]['done'] is True
+    assert (lines[3]['succeeded'], lines[3]['failed']) == (2, 1)
+    assert lines[3]['usage']['calls'] >= 2
+
+
+def test_process_files_rejects_mismatched_ids(client):
+    files = [('files', ('a.txt', b'a', 'text/plain'))]
+    response = client.post('/process-files', files=files, data={'file_ids': json.dumps(['a', 'b'])})
+    assert response.status_code == 400
+
+
+def test_only_oversized_documents_are_rejected_with_413(client, monkeypatch):
+    import services.app as app_module
+    from services.token_budget import check_budget
+
+    monkeypatch.setattr(app_module, 'check_budget', lambda tokens, what: check_budget(tokens, limit=1, what=what))
+    response = client.post('/documents', files={'file': ('big.txt', b'big document', 'text/plain')})
+    assert response.status_code == 413
+
+    def broken(*args, **kwargs):
+        raise ValueError("store is broken")
+
+    monkeypatch.undo()
+    monkeypatch.setattr(app_module.document_store, 'add', broken)
+    response = client.post('/documents', files={'file': ('other.txt', b'other document', 'text/plain')})
+    assert response.status_code == 500
+
+
+def test_jobs_validate_uploads_and_cap_their_size(client, monkeypatch):
+    import services.app as app_module
+
+    pdf = make_pdf(1)
+    response = client.post('/jobs', files=[('files', ('notes.exe', b'MZ', 'application/octet-stream'))],
+                           data={'prompts': '{}'})
+    assert response.status_code == 400
+
+    monkeypatch.setattr(app_module, 'JOB_MAX_BYTES', len(pdf) + 1)
+    files = [('files', (f'{name}.pdf', pdf, 'application/pdf')) for name in ('a', 'b')]
+    response = client.post('/jobs', files=files, data={'prompts': '{}'})
+    assert response.status_code == 413
+
+
+def test_empty_uploads_are_rejected_before_the_model(client, fake_backend):
+    response = client.post('/process_file', files={'file': ('empty.txt', b'', 'text/plain')})
+    assert response.status_code == 400
+    assert 'empty' in response.json()['detail']
+    assert fake_backend.calls == 0
+
+
+def test_chat_compaction_runs_in_the_background_under_its_own_usage(client, monkeypatch):
+    import services.app as app_module
+    from services.usage import ledger
+
+    monkeypatch.setattr(app_module.chat_sessions, 'token_budget', 1)
+    monkeypatch.setattr(app_module.chat_sessions, 'keep_recent', 1)
+    first = client.post('/api/chat', json={'message': 'hello'}).json()
+    second = client.post('/api/chat', json={'message': 'and again', 'session_id': first['session_id']}).json()
+    # The turn is charged for its own call only
+    assert second['usage']['calls'] == 1
+
+    deadline = time.monotonic() + 5
+    while app_module.background_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not app_module.background_tasks
+    assert any(row['route'] == 'chat_compaction' and row['calls'] for row in ledger.top())
+    assert asyncio.run(app_module.chat_sessions.get(first['session_id'])).compactions >= 1
+
+
+def test_process_file_runs_the_stages_and_caches_results(client, fake_backend):
+    pdf = make_pdf(2)
+    response = client.post('/process_file', files={'file': ('report.pdf', pdf, 'application/pdf')},
+                           data={'prompt': 'Summarise.'})
+    assert response.status_code == 200
+    analysis = response.json()['analysis']
+    assert analysis['file_info']['transport'] == 'pdf_stage'
+    assert analysis['file_info']['pdf_mode'] == 'text'
+    assert analysis['cache'] == 'miss'
+    assert response.json()['usage']['calls'] == 1
+
+    again = client.post('/process_file', files={'file': ('copy.pdf', pdf, 'application/pdf')},
+                        data={'prompt': 'Summarise.', 'fields': 'compact'})
+    assert again.json()['analysis']['cache'] == 'memory_hit'
+    assert again.json()['analysis']['file_info']['name'] == 'copy.pdf'
+    assert 'candidates' not in again.json()['analysis']
+    assert fake_backend.calls == 1
+
+    csv = client.post('/process_file', files={'file': ('data.csv', b'a,b\n1,2\n3,4\n', 'text/csv')})
+    assert csv.json()['analysis']['file_info']['transport'] == 'csv_profile'
+    assert csv.json()['analysis']['file_info']['rows'] == 2
+
+
+def test_process_multiple_pdfs_keeps_input_order_and_isolates_errors(client):
+    files = [('files', ('b.pdf', make_pdf(1), 'application/pdf')),
+             ('files', ('notes.txt', b'not a pdf', 'text/plain')),
+             ('files', ('a.pdf', make_pdf(3), 'application/pdf'))]
+
+    response = client.post('/process-multiple-pdfs', files=files, data={'prompts': json.dumps({'a.pdf': 'Topics?'})})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body['success'] is False
+    assert [result['file_id'] for result in body['results']] == ['b.pdf', 'a.pdf']
+    assert all(result['summary']['text'] for result in body['results'])
+    assert [error['file_id'] for error in body['errors']] == ['notes.txt']
+    assert body['usage']['calls'] == 2
+
+
+def test_chat_keeps_the_session_and_streams_events(client):
+    import services.app as app_module
+
+    first = client.post('/api/chat', json={'message': 'hello', 'system_prompt': 'Be brief.'})
+    assert first.status_code == 200 and first.json()['success']
+    session_id = first.json()['session_id']
+    second = client.post('/api/chat', json={'message': 'more', 'session_id': session_id})
+    assert second.json()['session_id'] == session_id
+    assert asyncio.run(app_module.chat_sessions.get(session_id)).turns == 2
+
+    response = client.post('/api/chat/stream', json={'message': 'stream it', 'session_id': session_id})
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = sse_events(response.text)
+    assert events[0] == ('session', {'session_id': session_id, 'new_session': False})
+    assert all(event is None and data['text'] for event, data in events[1:-1])
+    done_event, done = events[-1]
+    assert done_event == 'done' and done['turns'] == 3 and done['usage']['calls'] == 1
+
+
+def test_documents_are_prepared_once_and_answer_questions(client, fake_backend):
+    upload = {'file': ('notes.txt', b'Meeting notes: ship on Friday.', 'text/plain')}
+    registered = client.post('/documents', files=upload).json()
+    assert registered['reused'] is False
+    document_id = registered['document']['document_id']
+
+    again = client.post('/documents', files=upload).json()
+    assert again['reused'] is True and again['document']['document_id'] == document_id
+    assert fake_backend.calls == 0
+
+    answer = client.post(f'/documents/{document_id}/ask', json={'question': 'When do we ship?'}).json()
+    assert answer['text'] and answer['session_id']
+    assert client.get(f'/documents/{document_id}').json()['questions'] == 1
+    assert client.get('/documents/unknown').status_code == 404
+
+
+def test_jobs_run_in_the_background(client):
+    files = [('files', (f'{name}.pdf', make_pdf(index + 1), 'application/pdf')) for index, name in enumerate('ab')]
+    response = client.post('/jobs', files=files, data={'prompts': '{}'})
+    assert response.status_code == 202
+    status_url = response.json()['status_url']
+
+    deadline = time.monotonic() + 5
+    job = client.get(status_url).json()
+    while job['done'] < job['total'] and time.monotonic() < deadline:
+        time.sleep(0.02)
+        job = client.get(status_url).json()
+    assert job['status'] == 'completed'
+    assert [file['file_id'] for file in job['files']] == ['a.pdf', 'b.pdf']
+    assert all(file['result']['text'] for file in job['files'])
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_readiness_reports_upstream_failures(client, monkeypatch):
+    import services.app as app_module
+
+    async def failing():
+        raise ConnectionError("upstream unreachable")
+
+    async def answering():
+        return None
+
+    # Probes are run here instead of in the background
+    monkeypatch.setattr(app_module, 'start_health_probes', lambda: None)
+    monkeypatch.setattr(app_module, 'HEALTH_PROBE_INTERVAL', 30)
+    prober = HealthProber(failing)
+    monkeypatch.setattr(app_module, 'health_prober', prober)
+
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.json()['reasons']['gemini_api'] == 'not checked yet'
+
+    asyncio.run(prober.check())
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.json()['reasons']['gemini_api'] == 'upstream unreachable'
+
+    prober.probe = answering
+    asyncio.run(prober.check())
+    assert client.get('/health/ready').status_code == 200
+    assert client.get('/health/live').status_code == 200
+
+
+def test_usage_is_listed_per_route(client):
+    client.post('/process_file', files={'file': ('usage.txt', b'count my tokens', 'text/plain')})
+    routes = {row['route']: row for row in client.get('/usage').json()['routes']}
+    assert routes['/process_file']['calls'] >= 1
+    assert routes['/process_file']['total_tokens'] > 0
+
+
+def test_saturated_routes_answer_503_with_retry_after(client, fake_backend, monkeypatch):
+    import services.app as app_module
+
+    queue = app_module.admission.queues['/process_file']
+    monkeypatch.setattr(queue, 'active', queue.concurrency)
+    monkeypatch.setattr(queue, 'queue_size', 0)
+
+    response = client.post('/process_file', files={'file': ('busy.txt', b'busy', 'text/plain')})
+    assert response.status_code == 503
+    assert int(response.headers['retry-after']) >= 1
+    assert response.json()['retry_after'] == int(response.headers['retry-after'])
+    assert fake_backend.calls == 0
+    # Routes outside admission control still answer
+    assert client.get('/health/live').status_code == 200
+
+
+def test_turns_for_an_expired_session_need_the_context_again(client, fake_backend):
+    for route in ('/api/chat', '/api/chat/stream'):
+        response = client.post(route, json={'message': 'still there?', 'session_id': 'expired'})
+        assert response.status_code == 404
+        assert response.json()['detail'] == 'session_expired'
+    assert fake_backend.calls == 0
+
+    response = client.post('/api/chat', json={'message': 'again', 'session_id': 'expired', 'system_prompt': 'Notes.'})
+    assert response.status_code == 200
+    assert response.json()['session_id'] != 'expired'
+
+
+def test_uploads_over_the_stage_limits_go_to_the_file_api_unread(client, fake_backend, monkeypatch):
+    import services.app as app_module
+
+    async def unexpected(file):
+        raise AssertionError(f"{file.filename} was read into memory")
+
+    monkeypatch.setattr(app_module, 'read_upload', unexpected)
+    monkeypatch.setattr(app_module, 'PDF_TEXT_MAX_BYTES', 10)
+    monkeypatch.setattr(app_module, 'IMAGE_STAGE_MAX_BYTES', 10)
+    monkeypatch.setattr(app_module, 'INLINE_MAX_FILE_SIZE', 10)
+
+    for name, mime_type in (('big.pdf', 'application/pdf'), ('big.png', 'image/png')):
+        response = client.post('/process_file', files={'file': (name, b'%' * 100, mime_type)},
+                               data={'prompt': 'Describe.', 'pages': '1-2'})
+        assert response.status_code == 200
+        assert response.json()['analysis']['file_info']['transport'] == 'file_api'
+
+    registered = client.post('/documents', files={'file': ('doc.pdf', b'%' * 200, 'application/pdf')},
+                             data={'pages': '3'}).json()
+    assert registered['document']['transport'] == 'file_api'
+
+
+def test_empty_batch_pdfs_are_rejected_before_hashing(monkeypatch):
+    import services.app as app_module
+
+    def unexpected(data):
+        raise AssertionError("empty content was hashed")
+
+    monkeypatch.setattr(app_module, 'content_digest', unexpected)
+    with pytest.raises(ValueError, match='empty'):
+        asyncio.run(app_module.analyze_pdf_bytes(b'', 'empty.pdf', 'Summarise.', 'empty.pdf'))
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+from services.chat_sessions import ChatSessionStore
+from services.model_client import ModelClient
+from services.shared_state import SharedState
+
+
+def test_sessions_are_evicted_by_lru_and_ttl():
+    store = ChatSessionStore(max_sessions=2, ttl=60)
+
+    async def run():
+        first = await store.get_or_create(None, "be brief")
+        second = await store.get_or_create(None)
+        assert await store.get(first.id) is first  # first is now the most recently used
+        await store.get_or_create(None)
+
+        assert await store.get(second.id) is None
+        assert await store.get(first.id) is first
+
+        first.last_used = time.time() - 120
+        assert await store.get(first.id) is None
+        # An unknown or expired id starts a fresh session
+        assert (await store.get_or_create(first.id)).id != first.id
+
+    asyncio.run(run())
+
+
+def test_system_prompt_is_kept_until_replaced():
+    store = ChatSessionStore()
+
+    async def run():
+        session = await store.get_or_create(None, "page context")
+        assert (await store.get_or_create(session.id, None)).system_prompt == "page context"
+        assert (await store.get_or_create(session.id, "new page")).system_prompt == "new page"
+
+    asyncio.run(run())
+
+
+def test_workers_share_sessions_and_keep_concurrent_turns(tmp_path):
+    state = SharedState(str(tmp_path / 'shared.sqlite3'))
+    # Two workers: each has its own store, both on the same SQLite file
+    first, second = ChatSessionStore(shared_state=state), ChatSessionStore(shared_state=state)
+
+    async def run():
+        session = await first.get_or_create(None, "page context")
+        await first.add_exchange(session, "hi", "hello")
+
+        other = await second.get(session.id)
+        assert other is not session
+        assert other.system_prompt == "page context" and other.turns == 1
+
+        # Both workers answer a turn from the same history: neither is lost
+        await second.add_exchange(other, "from the second", "ok")
+        await first.add_exchange(session, "from the first", "ok")
+        assert session.turns == 3
+        assert [turn['parts'][0] for turn in session.history[::2]] == ["hi", "from the second", "from the first"]
+        assert (await second.get(session.id)).turns == 3
+
+        assert await second.delete(session.id)
+        assert await first.get(session.id) is None
+
+    asyncio.run(run())
+
+
+def _long_session(store, exchanges=10):
+    session = asyncio.run(store.get_or_create(None, "system"))
+    for i in range(exchanges):
+        session.add_exchange(f"question {i} " + "x" * 100, f"answer {i} " + "y" * 100)
+    return session
+
+
+def test_truncate_keeps_recent_exchanges_within_budget():
+    store = ChatSessionStore(token_budget=200, policy='truncate', keep_recent=2)
+    session = _long_session(store)
+
+    asyncio.run(store.compact(session))
+
+    assert [turn['parts'][0].split(' x')[0] for turn in session.history[::2]] == ["question 8", "question 9"]
+    assert session.summary == ''
+    assert session.system_instruction() == "system"
+    assert session.compactions == 1
+
+
+def test_summarize_folds_old_turns_into_the_system_instruction():
+    store = ChatSessionStore(token_budget=200, policy='summarize', keep_recent=2)
+    session = _long_session(store)
+    seen = []
+
+    async def summarize(text):
+        seen.append(text)
+        return "they asked eight questions"
+
+    asyncio.run(store.compact(session, summarize))
+
+    assert "question 0" in seen[0] and "question 8" not in seen[0]
+    assert len(session.history) == 4
+    assert session.system_instruction() == "system\n\nSummary of the earlier conversation:\nthey asked eight questions"
+
+    async def failing(text):
+        raise RuntimeError("upstream failure")
+
+    # A failed summary still brings the history back under budget
+    for i in range(10):
+        session.add_exchange("q " + "x" * 100, "a " + "y" * 100)
+    asyncio.run(store.compact(session, failing))
+    assert len(session.history) == 4
+    assert session.summary == "they asked eight questions"
+
+
+def test_send_chat_sends_only_history_and_new_message():
+    calls = []
+
+    class FakeChat:
+        def __init__(self, history):
+            self.history = history
+
+        async def send_message_async(self, message, **kwargs):
+            calls.append((self.history, message))
+            return f"answer to {message}"
+
+    class FakeModel:
+        def __init__(self, system_instruction):
+            self.system_instruction = system_instruction
+
+        def start_chat(self, history):
+            return FakeChat(history)
+
+    built = []
+
+    def factory(system_instruction):
+        built.append(system_instruction)
+        return FakeModel(system_instruction)
+
+    client = ModelClient(max_concurrency=1, model_factory=factory)
+    history = [{'role': 'user', 'parts': ["hi"]}, {'role': 'model', 'parts': ["hello"]}]
+
+    async def run():
+        await client.send_chat(history, "first", system_instruction="context")
+        return await client.send_chat(history, "second", system_instruction="context")
+
+    assert asyncio.run(run()) == "answer to second"
+    assert calls == [(history, "first"), (history, "second")]
+    # The model for a system instruction is built once and reused
+    assert built == ["context"]
+    assert client.in_flight == 0
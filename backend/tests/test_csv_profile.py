@@ -0,0 +1,65 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from services import csv_profile
+from services.csv_profile import csv_cache_variant, profile_csv, profile_to_text
+
+
+def make_csv(rows=5000):
+    rng = np.random.default_rng(7)
+    df = pd.DataFrame({
+        'id': range(rows),
+        'price': rng.normal(50, 5, rows),
+        'region': rng.choice(['north', 'south', 'east'], rows, p=[0.6, 0.3, 0.1]),
+    })
+    df.loc[::10, 'price'] = np.nan
+    return df, io.BytesIO(df.to_csv(index=False).encode())
+
+
+def test_statistics_match_pandas_across_chunks():
+    df, buffer = make_csv()
+    profile = profile_csv(buffer, chunk_rows=700)
+    schema = {column['name']: column for column in profile['schema']}
+
+    assert profile['rows'] == len(df)
+    assert profile['columns'] == 3
+    price = schema['price']
+    assert price['dtype'] == 'float64'
+    assert price['nulls'] == int(df['price'].isna().sum())
+    assert abs(price['mean'] - df['price'].mean()) < 1e-3
+    assert abs(price['std'] - df['price'].std()) < 1e-3
+    assert abs(price['min'] - df['price'].min()) < 1e-3
+    assert schema['id']['max'] == len(df) - 1
+    # The file position is restored for later readers
+    assert buffer.tell() == 0
+
+
+def test_top_values_and_stratified_sample():
+    df, buffer = make_csv()
+    profile = profile_csv(buffer, chunk_rows=1000, sample_rows=10)
+    region = next(column for column in profile['schema'] if column['name'] == 'region')
+
+    assert region['distinct'] == 3
+    assert region['top'][0] == ['north', int((df['region'] == 'north').sum())]
+    assert profile['sample']['stratified_by'] == 'region'
+    # Every stratum is represented, even the rare one
+    assert {row['region'] for row in profile['sample']['rows']} == {'north', 'south', 'east'}
+
+
+def test_profile_text_is_compact():
+    _, buffer = make_csv(50000)
+    profile = profile_csv(buffer)
+    text = profile_to_text(profile, 'sales.csv')
+
+    assert "'sales.csv'" in text
+    assert len(text) < len(buffer.getvalue()) / 50
+
+
+def test_cache_variant_follows_the_profile_settings(monkeypatch):
+    default = csv_cache_variant()
+    monkeypatch.setattr(csv_profile, 'CSV_PROFILE_SAMPLE_ROWS', 50)
+    sampled = csv_cache_variant()
+    monkeypatch.setattr(csv_profile, 'CSV_PROFILE_TOP_K', 10)
+    assert len({default, sampled, csv_cache_variant()}) == 3
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from services.documents import DocumentStore
+from services.shared_state import SharedState
+
+
+def get(store, document_id):
+    return asyncio.run(store.get(document_id))
+
+
+def find(store, digest, variant):
+    return asyncio.run(store.find(digest, variant))
+
+
+def _add(store, digest, size, variant=''):
+    return asyncio.run(store.add(f"{digest}.pdf", 'application/pdf', size, digest, variant,
+                                 [f"text of {digest}", {'mime_type': 'application/pdf', 'data': b'x' * size}]))
+
+
+def test_store_evicts_least_recently_used_by_size():
+    store = DocumentStore(max_bytes=2500, max_documents=10)
+    first = _add(store, 'a', 1000)
+    second = _add(store, 'b', 1000)
+    get(store, first.id)
+    third = _add(store, 'c', 1000)
+
+    assert get(store, second.id) is None
+    assert get(store, first.id) is first and get(store, third.id) is third
+    assert store.stats()['evictions'] == 1
+    assert store.bytes == first.payload_size + third.payload_size
+
+    with pytest.raises(ValueError):
+        _add(store, 'd', 5000)
+
+
+def test_same_content_and_options_map_to_one_document():
+    store = DocumentStore()
+    document = _add(store, 'a', 10, variant='pages=1-3')
+
+    assert find(store, 'a', 'pages=1-3') is document
+    assert find(store, 'a', 'pages=') is None
+
+    replacement = _add(store, 'a', 10, variant='pages=1-3')
+    assert get(store, document.id) is None
+    assert find(store, 'a', 'pages=1-3') is replacement
+    assert asyncio.run(store.delete(replacement.id))
+    assert find(store, 'a', 'pages=1-3') is None
+    assert store.bytes == 0
+
+
+def test_documents_expire_after_ttl_or_handle_expiry():
+    store = DocumentStore(ttl=60)
+    idle = _add(store, 'a', 10)
+    idle.last_used = time.time() - 120
+    handle_expired = asyncio.run(store.add('b.mp4', 'video/mp4', 10, 'b', '', [object()], expires_at=time.time() - 1))
+
+    assert get(store, idle.id) is None
+    assert get(store, handle_expired.id) is None
+    assert store.stats()['documents'] == 0
+
+
+def test_workers_share_documents_with_handles_by_name(tmp_path):
+    state = SharedState(str(tmp_path / 'shared.sqlite3'))
+
+    class Handle:
+        def __init__(self, name):
+            self.name = name
+
+    async def resolve(name):
+        return Handle(name)
+
+    # Two workers: each has its own store, both on the same SQLite file
+    first = DocumentStore(shared_state=state, resolve_handle=resolve)
+    second = DocumentStore(shared_state=state, resolve_handle=resolve)
+    document = _add(first, 'a', 10)
+    video = asyncio.run(first.add('b.mp4', 'video/mp4', 10, 'b', '', [Handle('files/b')],
+                                  expires_at=time.time() + 60))
+
+    shared = find(second, 'a', '')
+    assert shared is not document and shared.id == document.id
+    assert shared.parts == document.parts and shared.file_name == 'a.pdf'
+    assert get(second, video.id).parts[0].name == 'files/b'
+
+    asyncio.run(second.add_question(shared))
+    assert get(first, document.id).questions == 1
+
+    assert asyncio.run(first.delete(document.id))
+    assert get(second, document.id) is None
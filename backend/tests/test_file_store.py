@@ -0,0 +1,78 @@
+import asyncio
+import io
+import types
+from datetime import datetime, timedelta, timezone
+
+from services.file_store import FileStore, HANDLE_CACHED, HANDLE_COALESCED, HANDLE_UPLOADED
+
+
+class FakeUploader:
+    """Local stand-in for the Gemini File API"""
+
+    def __init__(self, processing_polls=0, lifetime=timedelta(hours=48)):
+        self.uploads = []
+        self.processing_polls = processing_polls
+        self.lifetime = lifetime
+
+    def _handle(self, name, state):
+        return types.SimpleNamespace(
+            name=name,
+            state=types.SimpleNamespace(name=state),
+            expiration_time=datetime.now(timezone.utc) + self.lifetime,
+        )
+
+    def upload(self, fileobj, mime_type, display_name):
+        self.uploads.append(fileobj.read())
+        state = 'PROCESSING' if self.processing_polls else 'ACTIVE'
+        return self._handle(f"files/{len(self.uploads)}", state)
+
+    def get(self, name):
+        self.processing_polls -= 1
+        return self._handle(name, 'PROCESSING' if self.processing_polls > 0 else 'ACTIVE')
+
+
+def test_handles_are_reused_by_content_hash():
+    uploader = FakeUploader()
+    store = FileStore(uploader=uploader)
+
+    async def run():
+        first = await store.get_or_upload('digest', io.BytesIO(b'large file'), 'video/mp4', 'a.mp4')
+        second = await store.get_or_upload('digest', io.BytesIO(b'large file'), 'video/mp4', 'b.mp4')
+        return first, second
+
+    (first, first_status), (second, second_status) = asyncio.run(run())
+
+    assert uploader.uploads == [b'large file']
+    assert (first_status, second_status) == (HANDLE_UPLOADED, HANDLE_CACHED)
+    assert first is second
+
+
+def test_concurrent_uploads_of_the_same_content_are_coalesced():
+    uploader = FakeUploader()
+    store = FileStore(uploader=uploader)
+
+    async def run():
+        return await asyncio.gather(*(
+            store.get_or_upload('digest', io.BytesIO(b'data'), 'application/pdf', 'a.pdf')
+            for _ in range(3)
+        ))
+
+    statuses = [status for _, status in asyncio.run(run())]
+    assert len(uploader.uploads) == 1
+    assert statuses == [HANDLE_UPLOADED, HANDLE_COALESCED, HANDLE_COALESCED]
+
+
+def test_waits_for_processing_and_reuploads_expiring_handles():
+    uploader = FakeUploader(processing_polls=2, lifetime=timedelta(minutes=5))
+    store = FileStore(uploader=uploader, poll_interval=0, expiry_margin=600)
+
+    async def run():
+        handle, _ = await store.get_or_upload('digest', io.BytesIO(b'video'), 'video/mp4', 'a.mp4')
+        _, status = await store.get_or_upload('digest', io.BytesIO(b'video'), 'video/mp4', 'a.mp4')
+        return handle, status
+
+    handle, status = asyncio.run(run())
+    assert handle.state.name == 'ACTIVE'
+    # The handle expires inside the safety margin, so it is not reused
+    assert status == HANDLE_UPLOADED
+    assert len(uploader.uploads) == 2
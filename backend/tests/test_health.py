@@ -0,0 +1,75 @@
+import asyncio
+
+from services.health import UPSTREAM_DOWN, UPSTREAM_UNKNOWN, UPSTREAM_UP, HealthProber, saturation_reasons
+
+
+def test_prober_caches_status_and_recovers():
+    outcomes = [RuntimeError("quota exceeded"), None]
+    calls = []
+
+    async def probe():
+        calls.append(1)
+        outcome = outcomes.pop(0)
+        if outcome:
+            raise outcome
+
+    prober = HealthProber(probe, interval=60, timeout=1)
+    assert prober.snapshot()['status'] == UPSTREAM_UNKNOWN
+    assert not prober.healthy
+
+    asyncio.run(prober.check())
+    snapshot = prober.snapshot()
+    assert snapshot['status'] == UPSTREAM_DOWN
+    assert snapshot['error'] == 'quota exceeded'
+    assert snapshot['consecutive_failures'] == 1
+
+    asyncio.run(prober.check())
+    assert prober.healthy
+    assert prober.snapshot()['status'] == UPSTREAM_UP
+    # Reading the status never probes
+    prober.snapshot()
+    assert len(calls) == 2
+
+
+def test_slow_probe_times_out():
+    async def probe():
+        await asyncio.sleep(1)
+
+    prober = HealthProber(probe, timeout=0.01)
+    asyncio.run(prober.check())
+
+    assert prober.status == UPSTREAM_DOWN
+
+
+def test_stale_status_is_not_healthy():
+    async def probe():
+        pass
+
+    prober = HealthProber(probe, max_staleness=0)
+    asyncio.run(prober.check())
+    prober.last_success_at -= 1
+
+    assert prober.snapshot()['stale']
+    assert not prober.healthy
+
+
+def test_background_probing():
+    calls = []
+
+    async def probe():
+        calls.append(1)
+
+    async def main():
+        prober = HealthProber(probe, interval=0.01)
+        prober.start()
+        await asyncio.sleep(0.05)
+        await prober.stop()
+
+    asyncio.run(main())
+    assert len(calls) >= 2
+
+
+def test_saturation_reasons():
+    assert saturation_reasons(0, 1, 64, max_queue_depth=16, max_utilization=0.9) == {}
+    reasons = saturation_reasons(20, 60, 64, max_queue_depth=16, max_utilization=0.9)
+    assert set(reasons) == {'thread_pool', 'upstream'}
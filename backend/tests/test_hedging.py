@@ -0,0 +1,109 @@
+import asyncio
+
+from services.hedging import HedgeBudget, Hedger, LatencyTracker, hedges
+from services.model_client import ModelClient
+
+
+class SlowFirstModel:
+    """The first call hangs until cancelled; later calls answer at once"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = False
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+        return f"answer {self.calls}"
+
+
+def _warm_hedger(ratio=1.0):
+    tracker = LatencyTracker(min_samples=5)
+    for _ in range(5):
+        tracker.record('generate', 0.01)
+    return Hedger(enabled=True, percentile=95, max_ratio=ratio, min_delay=0.01, tracker=tracker)
+
+
+def test_latency_percentile_needs_samples():
+    tracker = LatencyTracker(min_samples=3)
+    tracker.record('generate', 1.0)
+    assert tracker.percentile('generate', 95) is None
+    for seconds in (2.0, 3.0, 4.0):
+        tracker.record('generate', seconds)
+    assert tracker.percentile('generate', 50) == 2.0
+    assert tracker.percentile('generate', 95) == 4.0
+    assert tracker.percentile('chat', 95) is None
+    assert Hedger(enabled=False, tracker=tracker).delay('generate') is None
+
+
+def test_budget_caps_hedge_rate():
+    budget = HedgeBudget(ratio=0.25)
+    allowed = 0
+    for _ in range(40):
+        budget.earn()
+        allowed += budget.try_spend()
+    assert allowed == 10
+
+
+def test_slow_call_is_hedged_and_loser_cancelled():
+    won = hedges.labels('generate', 'won')
+    before = won.value
+    model = SlowFirstModel()
+    client = ModelClient(model, hedger=_warm_hedger())
+
+    async def run():
+        result = await client.generate("prompt")
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "answer 2"
+    assert model.calls == 2 and model.cancelled
+    assert won.value == before + 1
+    assert client.in_flight == 0
+
+
+def test_hedge_denied_without_budget():
+    denied = hedges.labels('generate', 'denied')
+    before = denied.value
+
+    class SlowModel:
+        calls = 0
+
+        async def generate_content_async(self, contents, **kwargs):
+            SlowModel.calls += 1
+            await asyncio.sleep(0.05)
+            return "slow"
+
+    client = ModelClient(SlowModel(), hedger=_warm_hedger(ratio=0))
+    assert asyncio.run(client.generate("prompt")) == "slow"
+    assert SlowModel.calls == 1
+    assert denied.value == before + 1
+
+
+def test_queue_wait_does_not_count_towards_the_hedge_delay():
+    class FastModel:
+        calls = 0
+
+        async def generate_content_async(self, contents, **kwargs):
+            FastModel.calls += 1
+            return "fast"
+
+    tracker = LatencyTracker(min_samples=5)
+    for _ in range(5):
+        tracker.record('generate', 0.01)
+    hedger = Hedger(enabled=True, percentile=95, max_ratio=1.0, min_delay=0.05, tracker=tracker)
+    client = ModelClient(FastModel(), max_concurrency=1, hedger=hedger)
+
+    async def run():
+        # Another call holds the only slot for longer than the hedge delay
+        await client.scheduler.acquire()
+        asyncio.get_event_loop().call_later(0.2, client.scheduler.release)
+        return await client.generate("prompt")
+
+    assert asyncio.run(run()) == "fast"
+    assert FastModel.calls == 1
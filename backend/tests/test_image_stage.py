@@ -0,0 +1,67 @@
+import io
+
+from PIL import Image
+
+from services.image_stage import preprocess_image
+
+
+def encode(image, fmt, **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **kwargs)
+    return buffer.getvalue()
+
+
+def test_large_photo_is_downscaled_and_stripped():
+    image = Image.effect_noise((3000, 2000), 60).convert('RGB')
+    exif = Image.Exif()
+    exif[0x010F] = 'Camera maker'
+    data = encode(image, 'JPEG', quality=98, exif=exif)
+
+    result = preprocess_image(data, 'image/jpeg', max_dimension=1000)
+
+    assert result.original_dimensions == (3000, 2000)
+    assert result.dimensions == (1000, 667)
+    assert result.payload_size < len(data)
+    assert result.info()['saved_bytes'] > 0
+    payload, mime_type = result.images[0]
+    assert mime_type == 'image/jpeg'
+    assert not Image.open(io.BytesIO(payload)).getexif()
+
+
+def test_target_size_lowers_quality():
+    data = encode(Image.effect_noise((800, 800), 80).convert('RGB'), 'PNG')
+
+    result = preprocess_image(data, 'image/png', quality=90, target_bytes=60000)
+
+    assert result.quality < 90
+
+
+def test_transparent_png_stays_png():
+    image = Image.new('RGBA', (2000, 500), (255, 0, 0, 128))
+    data = encode(image, 'PNG')
+
+    result = preprocess_image(data, 'image/png', max_dimension=500)
+
+    assert result.images[0][1] == 'image/png'
+    assert result.dimensions == (500, 125)
+
+
+def test_small_image_is_sent_unchanged():
+    data = encode(Image.new('RGB', (50, 50), 'white'), 'PNG')
+
+    result = preprocess_image(data, 'image/png')
+
+    assert result.unchanged
+    assert result.images == [(data, 'image/png')]
+
+
+def test_animated_gif_keeps_evenly_spaced_frames():
+    frames = [Image.new('RGB', (64, 64), (25 * i, 0, 0)) for i in range(10)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:])
+
+    result = preprocess_image(buffer.getvalue(), 'image/gif', max_frames=4)
+
+    assert result.total_frames == 10
+    assert result.frames == 4
+    assert len(result.images) == 4
@@ -0,0 +1,130 @@
+import asyncio
+import os
+
+from services.jobs import CANCELLED, COMPLETED, FAILED, JobQueue
+
+
+def _queue(tmp_path, workers=2, retention=60):
+    return JobQueue(path=str(tmp_path / 'jobs.sqlite3'), data_dir=str(tmp_path / 'jobs'),
+                    workers=workers, retention=retention)
+
+
+def _files(count):
+    return [{'file_id': f"f{i}", 'file_name': f"f{i}.pdf", 'content': f"content {i}".encode(),
+             'params': {'prompt': f"prompt {i}"}} for i in range(count)]
+
+
+def test_job_runs_tasks_in_parallel_and_reports_progress(tmp_path):
+    queue = _queue(tmp_path, workers=2)
+    active = []
+    peak = []
+
+    async def handler(task, content):
+        active.append(1)
+        peak.append(len(active))
+        await asyncio.sleep(0.02)
+        active.pop()
+        if task['file_id'] == 'f2':
+            raise ValueError("broken file")
+        return {'text': f"{content.decode()} / {task['params']['prompt']} / {task['params']['mode']}"}
+
+    queue.register('batch', handler)
+
+    async def run():
+        await queue.start()
+        job_id = await queue.submit('batch', _files(4), {'mode': 'single'})
+        updates = [job async for job in queue.watch(job_id, keepalive=1) if job is not None]
+        await queue.stop()
+        return updates
+
+    updates = asyncio.run(run())
+    job = updates[-1]
+
+    assert max(peak) == 2
+    assert job['status'] == COMPLETED and job['done'] == 4
+    assert job['progress'][COMPLETED] == 3 and job['progress'][FAILED] == 1
+    assert job['files'][0]['result'] == {'text': "content 0 / prompt 0 / single"}
+    assert job['files'][2]['error'] == "broken file"
+    assert len(updates) > 1
+    # Inputs are deleted once the job is finished
+    assert not (tmp_path / 'jobs' / job['job_id']).exists()
+
+
+def test_interrupted_tasks_are_resumed_after_restart(tmp_path):
+    first = _queue(tmp_path, workers=1)
+
+    async def hang(task, content):
+        await asyncio.sleep(60)
+
+    first.register('batch', hang)
+
+    async def submit_and_stop():
+        await first.start()
+        job_id = await first.submit('batch', _files(3))
+        await asyncio.sleep(0.05)
+        await first.stop()
+        return job_id
+
+    job_id = asyncio.run(submit_and_stop())
+    assert asyncio.run(first.get(job_id))['progress']['running'] == 1
+
+    second = _queue(tmp_path, workers=2)
+
+    async def done(task, content):
+        return {'text': content.decode()}
+
+    second.register('batch', done)
+
+    async def resume():
+        await second.start()
+        async for job in second.watch(job_id, keepalive=1):
+            pass
+        await second.stop()
+        return await second.get(job_id)
+
+    job = asyncio.run(resume())
+    assert job['status'] == COMPLETED
+    assert [file['result']['text'] for file in job['files']] == ["content 0", "content 1", "content 2"]
+
+
+def test_tasks_of_a_live_worker_are_not_requeued(tmp_path):
+    queue = _queue(tmp_path, workers=1)
+    job_id = 'job'
+    queue._insert(job_id, 'batch', {}, _files(2))
+    # Task 0 is running in another live worker process, task 1 in one that is gone
+    with queue._connect() as conn:
+        conn.execute('UPDATE tasks SET status = ?, owner = ? WHERE idx = 0', ('running', os.getppid()))
+        conn.execute('UPDATE tasks SET status = ?, owner = ? WHERE idx = 1', ('running', 2 ** 22 + 1))
+
+    assert queue._recover() == [(job_id, 1)]
+
+
+def test_cancel_and_retention(tmp_path):
+    queue = _queue(tmp_path, workers=1, retention=60)
+
+    async def slow(task, content):
+        await asyncio.sleep(0.05)
+        return {}
+
+    queue.register('batch', slow)
+
+    async def run():
+        await queue.start()
+        job_id = await queue.submit('batch', _files(3))
+        await asyncio.sleep(0.01)
+        await queue.cancel(job_id)
+        async for job in queue.watch(job_id, keepalive=1):
+            pass
+        await queue.stop()
+        job = await queue.get(job_id)
+
+        assert await queue.purge() == 0
+        queue.retention = 0
+        await asyncio.sleep(0.01)
+        assert await queue.purge() == 1
+        return job, await queue.get(job_id)
+
+    job, purged = asyncio.run(run())
+    assert [file['status'] for file in job['files']] == [COMPLETED, CANCELLED, CANCELLED]
+    assert job['status'] == COMPLETED
+    assert purged is None
@@ -0,0 +1,84 @@
+import asyncio
+import types
+
+import pytest
+
+from services.map_reduce import (
+    ANALYSIS_MAP_REDUCE, ANALYSIS_SINGLE, REDUCE_TREE, map_reduce_pdf, plan_chunks, should_map_reduce
+)
+from services.pdf_text import MODE_TEXT, PdfExtraction
+
+
+def text_extraction(page_count):
+    page_texts = {number: f"text of page {number + 1}" for number in range(page_count)}
+    return PdfExtraction(MODE_TEXT, page_count, list(range(page_count)), 1000,
+                         text='', text_pages=list(page_texts), page_texts=page_texts)
+
+
+class RecordingModel:
+    """Fake generate() that records calls and tracks peak concurrency"""
+
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+
+    async def generate(self, parts):
+        self.calls.append(parts)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(0.01)
+            return types.SimpleNamespace(text=f"answer {len(self.calls)}")
+        finally:
+            self.active -= 1
+
+
+async def no_pdf_part(data, name):
+    raise AssertionError("text-only documents never send PDF parts")
+
+
+def test_plan_chunks_by_pages_and_token_budget():
+    pages = list(range(7))
+    assert plan_chunks(pages, {}, chunk_pages=3) == [[0, 1, 2], [3, 4, 5], [6]]
+
+    tokens = {0: 50, 1: 50, 2: 120, 3: 10, 4: 10}
+    assert plan_chunks(list(range(5)), tokens, chunk_pages=10, chunk_tokens=100) == [[0, 1], [2], [3, 4]]
+
+
+def test_should_map_reduce_modes():
+    assert should_map_reduce(text_extraction(5), ANALYSIS_MAP_REDUCE)
+    assert not should_map_reduce(text_extraction(500), ANALYSIS_SINGLE)
+    assert not should_map_reduce(text_extraction(5), None)
+    assert should_map_reduce(text_extraction(500), None)
+    with pytest.raises(ValueError):
+        should_map_reduce(text_extraction(5), 'everything')
+
+
+def test_map_reduce_single_strategy():
+    model = RecordingModel()
+    response, stats = asyncio.run(map_reduce_pdf(
+        b'', text_extraction(10), 'Summarise', 'doc.pdf', model.generate, no_pdf_part,
+        chunk_pages=3, concurrency=2
+    ))
+
+    assert stats['chunks'] == 4
+    assert stats['reduce_calls'] == 1
+    assert model.peak == 2
+    # The reduce call sees every partial answer in page order
+    assert model.calls[-1][1].index('pages 1-3') < model.calls[-1][1].index('page 10')
+    assert response.text == 'answer 5'
+
+
+def test_map_reduce_tree_strategy():
+    model = RecordingModel()
+    _, stats = asyncio.run(map_reduce_pdf(
+        b'', text_extraction(10), 'Summarise', 'doc.pdf', model.generate, no_pdf_part,
+        chunk_pages=1, strategy=REDUCE_TREE, fan_in=3
+    ))
+
+    # 10 partials -> 4 groups -> 2 groups -> final reduce
+    assert stats['chunks'] == 10
+    assert stats['reduce_levels'] == 3
+    assert stats['reduce_calls'] == 4 + 2 + 1
+    assert len(model.calls) == 10 + 7
@@ -0,0 +1,54 @@
+import asyncio
+
+from services.metrics import InstrumentedThreadPool, Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.labels('/a').observe(value)
+
+    text = registry.render()
+
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{route="/a"} 4' in text
+    assert 'latency_seconds_sum{route="/a"} 3.65' in text
+
+
+def test_counters_gauges_and_label_escaping():
+    registry = Registry()
+    errors = registry.counter('errors_total', 'Errors', ('type',))
+    errors.labels('Bad"Value').inc()
+    errors.labels('Bad"Value').inc(2)
+    in_flight = registry.gauge('in_flight', 'In flight')
+    in_flight.inc()
+    in_flight.inc()
+    in_flight.dec()
+    registry.gauge('queue_depth', 'Queue', callback=lambda: 7)
+
+    text = registry.render()
+
+    assert 'errors_total{type="Bad\\"Value"} 3' in text
+    assert 'in_flight 1' in text
+    assert 'queue_depth 7' in text
+
+
+def test_thread_pool_tracks_active_workers():
+    pool = InstrumentedThreadPool(max_workers=2)
+    seen = []
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(loop.run_in_executor(pool, lambda: seen.append(pool.active)) for _ in range(4)))
+
+    asyncio.run(main())
+
+    assert len(seen) == 4
+    assert all(1 <= active <= 2 for active in seen)
+    assert pool.active == 0
+    assert pool.queue_depth == 0
+    pool.shutdown(wait=True)
@@ -0,0 +1,108 @@
+import asyncio
+
+from services.model_client import ModelClient
+
+
+class FakeModel:
+    """Stand-in for genai.GenerativeModel that records peak concurrency"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            return f"response to {contents}"
+        finally:
+            self.active -= 1
+
+
+def test_generate_respects_concurrency_limit():
+    model = FakeModel()
+    client = ModelClient(model, max_concurrency=3)
+
+    async def run():
+        return await asyncio.gather(*(client.generate(f"prompt {i}") for i in range(10)))
+
+    results = asyncio.run(run())
+
+    assert results == [f"response to prompt {i}" for i in range(10)]
+    assert model.peak == 3
+    assert client.stats()['in_flight'] == 0
+
+
+def test_generate_releases_slot_on_error():
+    class FailingModel:
+        async def generate_content_async(self, contents, **kwargs):
+            raise RuntimeError("upstream failure")
+
+    client = ModelClient(FailingModel(), max_concurrency=1)
+
+    async def run():
+        for _ in range(2):
+            try:
+                await client.generate("prompt")
+            except RuntimeError:
+                pass
+
+    asyncio.run(run())
+    assert client.in_flight == 0
+
+
+def test_generate_stream_yields_chunks_and_releases_slot_when_abandoned():
+    class StreamingModel:
+        def __init__(self):
+            self.chunks_sent = 0
+
+        async def generate_content_async(self, contents, stream=False, **kwargs):
+            assert stream
+
+            async def chunks():
+                for i in range(100):
+                    self.chunks_sent += 1
+                    yield f"chunk {i}"
+            return chunks()
+
+    model = StreamingModel()
+    client = ModelClient(model, max_concurrency=1)
+
+    async def run():
+        received = []
+        stream = client.generate_stream("prompt")
+        async for chunk in stream:
+            received.append(chunk)
+            if len(received) == 2:
+                break
+        await stream.aclose()
+        return received
+
+    assert asyncio.run(run()) == ["chunk 0", "chunk 1"]
+    assert model.chunks_sent < 100
+    assert client.in_flight == 0
+
+
+def test_model_is_built_on_first_use(monkeypatch):
+    from services import model_client as module
+
+    built = []
+
+    class FakeGenai:
+        @staticmethod
+        def GenerativeModel(name):
+            built.append(name)
+            return FakeModel(delay=0)
+
+    monkeypatch.setattr(module, '_genai', FakeGenai)
+    client = ModelClient(model_name='test-model')
+    assert built == []
+    assert client.stats()['model_ready'] is False
+
+    asyncio.run(client.generate("hello"))
+    asyncio.run(client.generate("again"))
+
+    assert built == ['test-model']
+    assert client.stats()['model_ready'] is True
@@ -0,0 +1,101 @@
+import asyncio
+import tempfile
+
+import fitz
+import pytest
+
+from services import pdf_text
+from services.pdf_text import (
+    MODE_BINARY, MODE_HYBRID, MODE_TEXT, PageRangeError, extract_pdf, parse_page_ranges
+)
+
+PAGE_TEXT = "This page has a proper text layer with enough characters to count. " * 3
+
+
+def make_pdf(text_pages, blank_pages=0):
+    doc = fitz.open()
+    for i in range(text_pages):
+        doc.new_page().insert_text((72, 72), f"{i}: {PAGE_TEXT[:80]}")
+        doc[-1].insert_text((72, 100), PAGE_TEXT[80:])
+    for _ in range(blank_pages):
+        doc.new_page()
+    return doc.tobytes()
+
+
+def test_parse_page_ranges():
+    assert parse_page_ranges(None, 3) == [0, 1, 2]
+    assert parse_page_ranges("1-2, 5,2", 5) == [0, 1, 4]
+    with pytest.raises(PageRangeError):
+        parse_page_ranges("0-2", 5)
+    with pytest.raises(PageRangeError):
+        parse_page_ranges("4-9", 5)
+    with pytest.raises(PageRangeError):
+        parse_page_ranges("a", 5)
+
+
+def test_text_pdf_is_sent_as_text():
+    data = make_pdf(3)
+    extraction = asyncio.run(extract_pdf(data))
+
+    assert extraction.mode == MODE_TEXT
+    assert extraction.pdf_bytes is None
+    assert "--- Page 3 ---" in extraction.text
+    assert extraction.info()['text_pages'] == 3
+
+
+def test_scanned_pages_are_sent_as_a_smaller_pdf():
+    data = make_pdf(3, blank_pages=1)
+    extraction = asyncio.run(extract_pdf(data))
+
+    assert extraction.mode == MODE_HYBRID
+    assert extraction.scanned_pages == [3]
+    with fitz.open(stream=extraction.pdf_bytes, filetype='pdf') as subset:
+        assert subset.page_count == 1
+
+
+def test_mostly_scanned_pdf_falls_back_to_binary_of_selected_pages():
+    data = make_pdf(1, blank_pages=3)
+
+    whole = asyncio.run(extract_pdf(data))
+    assert whole.mode == MODE_BINARY
+    assert whole.pdf_bytes == data
+
+    selected = asyncio.run(extract_pdf(data, "2-3"))
+    assert selected.mode == MODE_BINARY
+    with fitz.open(stream=selected.pdf_bytes, filetype='pdf') as subset:
+        assert subset.page_count == 2
+
+
+def test_big_documents_are_extracted_in_the_process_pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(pdf_text, 'PDF_TEXT_PARALLEL_MIN_PAGES', 4)
+    monkeypatch.setattr(pdf_text, 'PROCESS_POOL_WORKERS', 3)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    data = make_pdf(6)
+    pool = pdf_text.get_process_pool()
+    sent = []
+
+    class RecordingPool:
+        def submit(self, fn, *args):
+            sent.append(args)
+            return pool.submit(fn, *args)
+
+    monkeypatch.setattr(pdf_text, 'get_process_pool', RecordingPool)
+    try:
+        extraction = asyncio.run(extract_pdf(data))
+    finally:
+        pool.shutdown(wait=True)
+        monkeypatch.setattr('services.process_pool._process_pool', None)
+
+    # Each batch gets the path of one temp copy, removed afterwards, and its page numbers
+    assert len(sent) > 1 and all(isinstance(path, str) for path, _ in sent)
+    assert len({path for path, _ in sent}) == 1 and not list(tmp_path.iterdir())
+    assert extraction.mode == MODE_TEXT
+    assert [line for line in extraction.text.splitlines() if line.startswith('--- Page')] == [
+        f"--- Page {n} ---" for n in range(1, 7)
+    ]
+
+
+def test_unreadable_pdf_is_sent_unchanged():
+    extraction = asyncio.run(extract_pdf(b"%PDF-1.4\n%not really a pdf"))
+    assert extraction.mode == MODE_BINARY
+    assert extraction.pdf_bytes == b"%PDF-1.4\n%not really a pdf"
@@ -0,0 +1,67 @@
+import gzip
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from services import responses
+from services.responses import CompressionMiddleware, DefaultJSONResponse, choose_encoding, select_fields
+
+ANALYSIS = {'text': 'answer', 'candidates': ['answer'], 'prompt_feedback': None, 'prompt': 'p',
+            'file_info': {'name': 'a.txt'}, 'cache': 'miss'}
+
+
+def _app():
+    app = FastAPI(default_response_class=DefaultJSONResponse)
+    app.add_middleware(CompressionMiddleware, minimum_size=500, enabled=True)
+
+    @app.get('/small')
+    async def small():
+        return {'text': 'short'}
+
+    @app.get('/large')
+    async def large():
+        return {'text': 'word ' * 1000}
+
+    @app.get('/stream')
+    async def stream():
+        return StreamingResponse(iter(['{"n": 1}\n' * 100, '{"n": 2}\n' * 100]), media_type='application/x-ndjson')
+
+    return app
+
+
+def test_select_fields():
+    assert select_fields(ANALYSIS, None) is ANALYSIS
+    assert select_fields(ANALYSIS, 'full') is ANALYSIS
+    assert select_fields(ANALYSIS, 'compact') == {'text': 'answer', 'file_info': {'name': 'a.txt'}, 'cache': 'miss'}
+    assert select_fields(ANALYSIS, 'text, cache') == {'text': 'answer', 'cache': 'miss'}
+
+
+def test_choose_encoding():
+    assert choose_encoding('gzip, deflate') == 'gzip'
+    assert choose_encoding('gzip;q=0, identity') is None
+    assert choose_encoding('') is None
+    assert choose_encoding('br, gzip') == ('br' if responses.brotli is not None else 'gzip')
+
+
+def test_large_json_is_compressed_and_streams_are_not():
+    client = TestClient(_app())
+    headers = {'Accept-Encoding': 'gzip'}
+
+    response = client.get('/large', headers=headers)
+    assert response.headers['content-encoding'] == 'gzip'
+    assert int(response.headers['content-length']) < 1000
+    assert 'Accept-Encoding' in response.headers['vary']
+    assert response.json() == {'text': 'word ' * 1000}
+
+    assert 'content-encoding' not in client.get('/small', headers=headers).headers
+    assert 'content-encoding' not in client.get('/large', headers={'Accept-Encoding': 'identity'}).headers
+
+    response = client.get('/stream', headers=headers)
+    assert 'content-encoding' not in response.headers
+    assert response.text.count('\n') == 200
+
+
+def test_gzip_body_round_trips():
+    body = b'{"text": "' + b'x' * 5000 + b'"}'
+    assert gzip.decompress(responses.compress(body, 'gzip')) == body
@@ -0,0 +1,105 @@
+import asyncio
+
+from services.result_cache import (
+    ResultCache, cache_key, COALESCED, DISK_HIT, MEMORY_HIT, MISS
+)
+
+
+def test_cache_key_depends_on_every_input():
+    base = cache_key(b'data', 'application/pdf', 'prompt', 'model')
+    assert base == cache_key(b'data', 'application/pdf', 'prompt', 'model')
+    assert base != cache_key(b'other', 'application/pdf', 'prompt', 'model')
+    assert base != cache_key(b'data', 'text/plain', 'prompt', 'model')
+    assert base != cache_key(b'data', 'application/pdf', 'other prompt', 'model')
+    assert base != cache_key(b'data', 'application/pdf', 'prompt', 'other-model')
+
+
+def test_concurrent_requests_share_one_computation(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'results.sqlite3'))
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'text': 'summary'}
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute('key', compute) for _ in range(5)))
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    # The first caller registers the key before its disk lookup; the others join it
+    assert [status for _, status in results] == [MISS] + [COALESCED] * 4
+    assert all(value == {'text': 'summary'} for value, _ in results)
+
+
+def test_memory_then_disk_hits(tmp_path):
+    path = str(tmp_path / 'results.sqlite3')
+    cache = ResultCache(path=path)
+
+    async def compute():
+        return {'text': 'summary'}
+
+    async def run(target):
+        return await target.get_or_compute('key', compute)
+
+    assert asyncio.run(run(cache))[1] == MISS
+    assert asyncio.run(run(cache))[1] == MEMORY_HIT
+    # A fresh instance only sees the SQLite tier
+    assert asyncio.run(run(ResultCache(path=path)))[1] == DISK_HIT
+
+
+def test_expired_and_evicted_entries_are_recomputed(tmp_path):
+    cache = ResultCache(max_entries=1, ttl=0, path=str(tmp_path / 'results.sqlite3'))
+
+    async def run():
+        await cache.put('a', {'text': 'a'})
+        await asyncio.sleep(0.01)
+        return await cache.get('a')
+
+    assert asyncio.run(run()) == (None, None)
+
+    lru = ResultCache(max_entries=1, path=None)
+    asyncio.run(lru.put('a', {'text': 'a'}))
+    asyncio.run(lru.put('b', {'text': 'b'}))
+    assert asyncio.run(lru.get('a')) == (None, None)
+    assert asyncio.run(lru.get('b')) == ({'text': 'b'}, MEMORY_HIT)
+
+
+def test_failed_computation_is_not_cached(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'results.sqlite3'))
+
+    async def fail():
+        raise RuntimeError("upstream failure")
+
+    async def run():
+        try:
+            await cache.get_or_compute('key', fail)
+        except RuntimeError:
+            pass
+        return await cache.get('key')
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def test_workers_share_one_computation(tmp_path):
+    path = str(tmp_path / 'results.sqlite3')
+    # Two caches on one file stand in for two worker processes
+    first = ResultCache(path=path, shared=True, poll_interval=0.01)
+    second = ResultCache(path=path, shared=True, poll_interval=0.01)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'text': 'summary'}
+
+    async def run():
+        return await asyncio.gather(first.get_or_compute('key', compute), second.get_or_compute('key', compute))
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert sorted(status for _, status in results) == [COALESCED, MISS]
+    assert all(value == {'text': 'summary'} for value, _ in results)
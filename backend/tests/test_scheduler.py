@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from services import model_client as model_client_module
+from services.model_client import ModelClient
+from services.scheduler import (
+    LANE_BATCH, LANE_INTERACTIVE, TokenBucket, UpstreamScheduler, backoff_delay, is_retryable, retry_hint,
+)
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+def test_interactive_lane_is_served_before_batch():
+    scheduler = UpstreamScheduler(max_concurrency=1)
+    order = []
+
+    async def call(name, lane):
+        await scheduler.acquire(lane=lane)
+        order.append(name)
+        await asyncio.sleep(0.01)
+        scheduler.release()
+
+    async def run():
+        await scheduler.acquire()
+        tasks = [asyncio.ensure_future(call(f"batch {i}", LANE_BATCH)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(call("chat", LANE_INTERACTIVE)))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 4
+        scheduler.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["chat", "batch 0", "batch 1", "batch 2"]
+    assert scheduler.in_flight == 0
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)
+    assert bucket.try_take(60) == 0
+    assert bucket.try_take(1) == pytest.approx(1.0, abs=0.05)
+    # Usage above the estimate is charged afterwards
+    bucket.adjust(30)
+    assert bucket.try_take(1) == pytest.approx(31.0, abs=0.05)
+    assert TokenBucket(0).try_take(10 ** 9) == 0
+
+
+def test_retry_hints_and_backoff():
+    assert retry_hint(ResourceExhausted("Quota exceeded. Please retry in 12.5s.")) == 12.5
+    assert retry_hint(ResourceExhausted("retry_delay {\n  seconds: 7\n}")) == 7
+    assert retry_hint(ResourceExhausted("quota exceeded")) is None
+    assert is_retryable(ResourceExhausted()) and not is_retryable(ValueError("bad request"))
+
+    for attempt in range(6):
+        assert 0 <= backoff_delay(attempt, base=1, cap=8) <= 8
+    assert backoff_delay(0, hint=5, base=1, cap=60) >= 5
+
+
+def test_throttled_calls_are_retried(monkeypatch):
+    delays = []
+    monkeypatch.setattr(model_client_module, 'backoff_delay',
+                        lambda attempt, hint=None: delays.append((attempt, hint)) or 0)
+
+    class FlakyModel:
+        def __init__(self, failures, error):
+            self.failures = failures
+            self.error = error
+            self.calls = 0
+
+        async def generate_content_async(self, contents, **kwargs):
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise self.error
+            return "ok"
+
+    throttled = FlakyModel(2, ResourceExhausted("Please retry in 3s"))
+    client = ModelClient(throttled, max_concurrency=2, max_retries=3)
+    assert asyncio.run(client.generate("prompt")) == "ok"
+    assert throttled.calls == 3
+    assert delays == [(0, 3.0), (1, 3.0)]
+    assert client.in_flight == 0
+
+    broken = FlakyModel(1, ValueError("bad request"))
+    with pytest.raises(ValueError):
+        asyncio.run(ModelClient(broken, max_retries=3).generate("prompt"))
+    assert broken.calls == 1
+
+    exhausted = FlakyModel(10, ResourceExhausted("quota"))
+    with pytest.raises(ResourceExhausted):
+        asyncio.run(ModelClient(exhausted, max_retries=2).generate("prompt"))
+    assert exhausted.calls == 3
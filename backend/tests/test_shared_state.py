@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+from services.shared_state import SharedState, SharedTokenBucket
+
+
+def test_workers_draw_from_one_bucket(tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    # Two instances stand in for two worker processes
+    first = SharedTokenBucket(SharedState(path), 'rpm', 60)
+    second = SharedTokenBucket(SharedState(path), 'rpm', 60)
+
+    assert first.try_take(60) == 0
+    assert second.try_take(1) == pytest.approx(1.0, abs=0.05)
+    second.adjust(-30)
+    assert first.try_take(30) == 0
+    assert SharedTokenBucket(SharedState(path), 'tpm', 0).try_take(10 ** 9) == 0
+
+
+def test_workers_cannot_overdraw_a_bucket(tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    # Each thread stands in for a worker process with its own connection
+    buckets = [SharedTokenBucket(SharedState(path), 'rpm', 60) for _ in range(8)]
+    taken = []
+
+    def draw(bucket):
+        for _ in range(20):
+            if bucket.try_take(1) == 0:
+                taken.append(1)
+
+    threads = [threading.Thread(target=draw, args=(bucket,)) for bucket in buckets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 60 tokens plus at most what refilled while the threads ran
+    assert 60 <= len(taken) <= 62
+
+
+def test_file_handles_are_visible_to_every_worker(tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    SharedState(path).put_handle('digest:video/mp4', 'files/abc', 2e9)
+
+    assert SharedState(path).get_handle('digest:video/mp4') == ('files/abc', 2e9)
+    assert SharedState(path).get_handle('other:video/mp4') is None
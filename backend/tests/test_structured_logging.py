@@ -0,0 +1,81 @@
+import io
+import json
+import logging
+import queue
+
+from services import structured_logging
+from services.structured_logging import (
+    NonBlockingQueueHandler, StructuredFormatter, configure_logging, log_event,
+    parse_sample_rates, resolve_fields, shutdown_logging, start_request
+)
+
+
+def test_lazy_fields_are_not_evaluated_below_the_level():
+    logger = logging.getLogger('test.lazy')
+    logger.setLevel(logging.INFO)
+    calls = []
+
+    log_event(logger, logging.DEBUG, 'debug_event', expensive=lambda: calls.append(1))
+
+    assert calls == []
+
+
+def test_unsampled_requests_only_keep_warnings():
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    stream = io.StringIO()
+    calls = []
+    try:
+        configure_logging(stream, level='INFO', json_output=True)
+        structured_logging._sample_rates = parse_sample_rates('/health=0')
+        logger = logging.getLogger('test.sampling')
+
+        start_request('r1', '/health')
+        log_event(logger, logging.INFO, 'skipped', expensive=lambda: calls.append(1))
+        log_event(logger, logging.WARNING, 'kept')
+        start_request('r2', '/process_file')
+        log_event(logger, logging.INFO, 'sampled', prompt='secret prompt', size=3)
+    finally:
+        shutdown_logging()
+        structured_logging._sample_rates = parse_sample_rates(structured_logging.LOG_SAMPLE_RATES)
+        for handler in saved_handlers:
+            root.addHandler(handler)
+        root.setLevel(saved_level)
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line['event'] for line in lines] == ['kept', 'sampled']
+    assert calls == []
+    assert lines[0]['request_id'] == 'r1'
+    assert lines[1]['prompt'] == '<redacted 13 chars>'
+    assert lines[1]['size'] == 3
+
+
+def test_payloads_are_redacted():
+    fields = resolve_fields({
+        'data': b'\x00' * 10,
+        'headers': {'authorization': 'Bearer abc', 'accept': '*/*'},
+        'chars': lambda: 42,
+    })
+
+    assert fields['data'] == '<10 bytes>'
+    assert fields['headers'] == {'authorization': '<redacted 10 chars>', 'accept': '*/*'}
+    assert fields['chars'] == 42
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(1))
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'event', None, None)
+
+    handler.handle(record)
+    handler.handle(record)
+
+    assert handler.dropped == 1
+
+
+def test_text_format():
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'request', None, None)
+    record.fields = {'status': 200}
+
+    line = StructuredFormatter(json_output=False).format(record)
+
+    assert line.endswith('INFO test - request status=200')
@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services.model_client import ModelClient
+from services.token_budget import (
+    IMAGE_TOKENS, PDF_PAGE_TOKENS, TRUNCATION_NOTE, TokenBudgetExceeded, check_file, estimate_bytes_tokens,
+    estimate_tokens, fit_to_budget,
+)
+from services.usage import begin_usage, ledger
+
+
+class UsageModel:
+    """Answers every call and reports a fixed usage"""
+
+    def __init__(self):
+        self.contents = []
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.contents.append(contents)
+        return SimpleNamespace(text="ok", usage_metadata=SimpleNamespace(
+            prompt_token_count=100, candidates_token_count=20))
+
+
+def test_estimates_follow_content_type():
+    assert estimate_tokens("x" * 400) == 101
+    assert estimate_tokens({'mime_type': 'image/png', 'data': b'\0' * 100_000}) == IMAGE_TOKENS
+    assert estimate_bytes_tokens(250 * 1024, 'application/pdf') == 10 * PDF_PAGE_TOKENS
+    assert estimate_bytes_tokens(250 * 1024, 'application/pdf', pages=3) == 3 * PDF_PAGE_TOKENS
+    # One minute of 128 kbit/s audio is about 32 tokens per second
+    assert 1800 < estimate_bytes_tokens(60 * 16_000, 'audio/mpeg') < 2100
+    handle = SimpleNamespace(size_bytes=4000, mime_type='text/csv')
+    assert estimate_tokens(["prompt", handle]) == estimate_tokens("prompt") + 1001
+
+
+def test_large_text_is_trimmed_to_fit():
+    prompt = "Summarize this."
+    text = "y" * 8000
+    fitted = fit_to_budget([prompt, text], limit=1000)
+    assert fitted[0] == prompt
+    assert fitted[1].endswith(TRUNCATION_NOTE)
+    assert estimate_tokens(fitted) <= 1000
+    assert fit_to_budget([prompt, "short"], limit=1000) == [prompt, "short"]
+
+
+def test_untrimmable_request_is_rejected():
+    with pytest.raises(TokenBudgetExceeded):
+        fit_to_budget(["prompt", *[{'mime_type': 'image/png', 'data': b'\0'}] * 5], limit=1000)
+    with pytest.raises(TokenBudgetExceeded):
+        check_file(2 * 1024 ** 3, 'video/mp4', 'movie.mp4', limit=1_000_000)
+    assert check_file(1024, 'text/plain', 'notes.txt') == 257
+
+
+def test_usage_rolls_up_to_request_and_route():
+    client = ModelClient(UsageModel())
+
+    async def run():
+        request = begin_usage(route='test:usage')
+
+        async def one_file():
+            file_usage = begin_usage()
+            await client.generate(["prompt", "text"])
+            return file_usage.as_dict()
+
+        files = await asyncio.gather(one_file(), one_file())
+        return request.as_dict(), files
+
+    request, files = asyncio.run(run())
+    assert files[0] == {'calls': 1, 'prompt_tokens': 100, 'output_tokens': 20, 'total_tokens': 120,
+                        'estimated_prompt_tokens': estimate_tokens(["prompt", "text"])}
+    assert request['calls'] == 2 and request['total_tokens'] == 240
+    row = next(row for row in ledger.top() if row['route'] == 'test:usage')
+    assert row['requests'] == 1 and row['tokens_per_request'] == 240
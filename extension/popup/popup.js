@@ -51,6 +51,36 @@ async function testConnection() {
     }
 }
 
+// Longest Retry-After, in seconds, the popup waits out before giving up on a busy server
+const MAX_RETRY_WAIT_SECONDS = 30;
+
+// Identifies this extension install, so the backend queues its requests fairly against other clients
+let clientIdPromise = null;
+function getClientId() {
+    if (!clientIdPromise) {
+        clientIdPromise = chrome.storage.local.get('clientId').then(async ({ clientId }) => {
+            if (clientId) return clientId;
+            const newId = crypto.randomUUID();
+            await chrome.storage.local.set({ clientId: newId });
+            return newId;
+        });
+    }
+    return clientIdPromise;
+}
+
+// fetch() for the backend; a busy server (503 with Retry-After) is tried once more after the suggested delay
+async function apiFetch(path, options = {}) {
+    const request = { ...options, headers: { ...(options.headers || {}), 'X-Client-ID': await getClientId() } };
+    const response = await fetch(`${API_BASE_URL}${path}`, request);
+    const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+    if (response.status === 503 && retryAfter > 0 && retryAfter <= MAX_RETRY_WAIT_SECONDS) {
+        console.log(`Server busy, retrying ${path} in ${retryAfter}s`);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        return fetch(`${API_BASE_URL}${path}`, request);
+    }
+    return response;
+}
+
 // Helper function to format file size
 function formatFileSize(size) {
     if (size < 1024) return size + ' B';
@@ -88,6 +118,92 @@ function addMessage(message, type = 'info') {
     messageDiv.textContent = message;
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv;
+}
+
+// Chat session kept by the backend; only new messages are posted
+let chatSessionId = null;
+// System prompt last sent for this session, re-sent only when it changes
+let chatSessionContext = null;
+
+// Post a chat turn to the streaming API; context is null when the session already has it
+function postChatMessage(message, context) {
+    return apiFetch('/api/chat/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        },
+        body: JSON.stringify({
+            message: message,
+            session_id: chatSessionId,
+            system_prompt: context
+        })
+    });
+}
+
+// Read a Server-Sent Events chat stream, calling onText for every chunk
+async function readChatStream(response, onText) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        // Events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const rawEvent of events) {
+            let eventType = 'message';
+            let data = '';
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event: ')) eventType = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (!data) continue;
+            
+            const payload = JSON.parse(data);
+            if (eventType === 'error') {
+                throw new Error(payload.error || 'Unknown error');
+            }
+            if (eventType === 'session' && payload.session_id) {
+                if (payload.new_session) {
+                    // Unknown or expired session: the context has to be sent again
+                    chatSessionContext = null;
+                }
+                chatSessionId = payload.session_id;
+            }
+            if (eventType === 'message' && payload.text) {
+                onText(payload.text);
+            }
+        }
+    }
+}
+
+// Read a newline-delimited JSON response, calling onRecord for every record
+async function readNdjson(response, onRecord) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value, { stream: !done });
+        
+        const lines = buffer.split('\n');
+        buffer = done ? '' : lines.pop();
+        
+        for (const line of lines) {
+            if (line.trim()) {
+                await onRecord(JSON.parse(line));
+            }
+        }
+        if (done) break;
+    }
 }
 
 // Get default prompt based on file type
@@ -288,24 +404,30 @@ document.addEventListener('DOMContentLoaded', async function() {
                 const allFileSummaries = await getAllFileSummaries();
                 const contextWithSummaries = createContextWithSummaries(allFileSummaries);
                 
-                // Send message to API
-                const response = await fetch(`${API_BASE_URL}/api/chat`, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify({
-                        message: message,
-                        system_prompt: contextWithSummaries
-                    })
-                });
+                // The session keeps the context; send it only when it changed
+                let sentContext = contextWithSummaries === chatSessionContext ? null : contextWithSummaries;
+                let response = await postChatMessage(message, sentContext);
+
+                if (response.status === 404 && sentContext === null) {
+                    // The session expired before this turn: start a new one with the full context
+                    chatSessionId = null;
+                    chatSessionContext = null;
+                    sentContext = contextWithSummaries;
+                    response = await postChatMessage(message, sentContext);
+                }
                 
-                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
                 
-                if (data.success) {
-                    addMessage(`Assistant: ${data.response}`, 'assistant');
-                } else {
-                    addMessage(`Error: ${data.error || 'Unknown error'}`, 'error');
+                // Show the answer as it arrives
+                const assistantMessage = addMessage('Assistant: ', 'assistant');
+                await readChatStream(response, (text) => {
+                    assistantMessage.textContent += text;
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                });
+                if (sentContext !== null) {
+                    chatSessionContext = sentContext;
                 }
             } catch (error) {
                 addMessage(`Error: ${error.message}`, 'error');
@@ -543,10 +665,11 @@ document.addEventListener('DOMContentLoaded', async function() {
                 const formData = new FormData();
                 formData.append('file', fileToSend);
                 formData.append('prompt', prompt); // Add custom prompt to FormData
+                formData.append('fields', 'compact'); // Only the answer text is shown
                 
                 console.log(`Reprocessing file ${fileData.name} with prompt: ${prompt}`);
                 
-                const response = await fetch(`${API_BASE_URL}/process_file`, {
+                const response = await apiFetch('/process_file', {
                     method: 'POST',
                     body: formData
                 });
@@ -582,7 +705,7 @@ document.addEventListener('DOMContentLoaded', async function() {
                         } else {
                     statusSpan.textContent = 'Error';
                     statusSpan.className = 'file-status error';
-                    addMessage(`Error processing file: ${data.error || 'Unknown error'}`, 'error');
+                    addMessage(`Error processing file: ${data.error || data.detail || 'Unknown error'}`, 'error');
                 }
             } catch (error) {
                 console.error('Error reprocessing file:', error);
@@ -610,7 +733,12 @@ document.addEventListener('DOMContentLoaded', async function() {
             
             addMessage(`Processing ${files.length} file(s)...`, 'info');
             
-            // Process each file
+            // Create a container and storage record for every file, then analyze them all in one request
+            const pending = new Map();
+            const formData = new FormData();
+            const fileIds = [];
+            const prompts = {};
+            
             for (const file of Array.from(files)) {
                 try {
                     // Create a unique ID for the file
@@ -658,82 +786,95 @@ document.addEventListener('DOMContentLoaded', async function() {
                         dataLength: savedFileData.data ? savedFileData.data.length : 0
                     });
                     
-                    // Get the prompt from the input
-                    const promptInput = fileContainer.querySelector('.prompt-input');
-                    const prompt = defaultPrompt; // Always use default prompt, ignoring custom input
-                    
-                    // Process the file with the backend
-                    const formData = new FormData();
-                    formData.append('file', file);
-                    formData.append('prompt', prompt); // Add the prompt parameter to the form data
-                    
                     statusSpan.textContent = 'Processing...';
                     statusSpan.className = 'file-status processing';
                     
-                    const response = await fetch(`${API_BASE_URL}/process_file`, {
-                        method: 'POST',
-                        body: formData
-                    });
-                    
-                    const data = await response.json();
-                    
-                    if (data.success) {
-                        // Save the summary along with the prompt used
-                        await storage.saveSummary(fileId, {
-                            text: data.analysis.text,
-                            prompt: prompt
-                        });
-                        
-                        console.log('File summary saved:', {
-                            id: fileId,
-                            textLength: data.analysis.text.length,
-                prompt: prompt
-            });
-
-                        // Update the UI
-                        const summaryDiv = fileContainer.querySelector('.file-summary');
-                        const summaryTextarea = summaryDiv.querySelector('.summary-text');
-                        summaryTextarea.textContent = data.analysis.text;
-                        
-                        summaryDiv.style.display = 'block';
-                        statusSpan.textContent = 'Completed';
-                        statusSpan.className = 'file-status completed';
-                        
-                        // Show and enable download button
-                        const downloadBtn = fileContainer.querySelector('.download-summary');
-                        if (downloadBtn) {
-                            downloadBtn.style.display = 'inline-flex';
-                            downloadBtn.addEventListener('click', () => {
-                                downloadSummary(fileId, file.name, data.analysis.text);
-                            });
-                        }
-                        
-                        addMessage(`File processed: ${file.name}`, 'success');
-            } else {
-                        statusSpan.textContent = 'Error';
-                        statusSpan.className = 'file-status error';
-                        addMessage(`Error processing file: ${data.error || 'Unknown error'}`, 'error');
-                    }
+                    // Always use the default prompt, ignoring custom input
+                    pending.set(fileId, { name: file.name, fileContainer, prompt: defaultPrompt });
+                    formData.append('files', file);
+                    fileIds.push(fileId);
+                    prompts[fileId] = defaultPrompt;
                 } catch (error) {
-                    console.error(`Error processing file ${file.name}:`, error);
+                    console.error(`Error preparing file ${file.name}:`, error);
                     addMessage(`Error processing file ${file.name}: ${error.message}`, 'error');
-                    
-                    // Find the file container and update status
-                    const fileContainers = Array.from(fileList.querySelectorAll('.file-container'));
-                    const fileContainer = fileContainers.find(container => {
-                        const nameSpan = container.querySelector('.file-name');
-                        return nameSpan && nameSpan.textContent === file.name;
-                    });
-                    
-                    if (fileContainer) {
-                        const statusSpan = fileContainer.querySelector('.file-status');
-                        if (statusSpan) {
-                            statusSpan.textContent = 'Error';
-                            statusSpan.className = 'file-status error';
-                        }
-                    }
                 }
             }
+            
+            if (pending.size === 0) return;
+            formData.append('file_ids', JSON.stringify(fileIds));
+            formData.append('prompts', JSON.stringify(prompts));
+            formData.append('fields', 'compact');
+            
+            try {
+                const response = await apiFetch('/process-files', {
+                    method: 'POST',
+                    body: formData
+                });
+                
+                if (!response.ok) {
+                    const data = await response.json().catch(() => ({}));
+                    throw new Error(data.detail || `Server error: ${response.status}`);
+                }
+                
+                // Each file's result arrives as soon as it is done
+                await readNdjson(response, async (result) => {
+                    const entry = pending.get(result.file_id);
+                    if (!entry) return;
+                    pending.delete(result.file_id);
+                    await showFileResult(result.file_id, entry, result);
+                });
+            } catch (error) {
+                console.error('Error processing files:', error);
+                addMessage(`Error processing files: ${error.message}`, 'error');
+            }
+            
+            // Files left without a result (e.g. the connection dropped) are marked as failed
+            for (const { fileContainer } of pending.values()) {
+                const statusSpan = fileContainer.querySelector('.file-status');
+                if (statusSpan) {
+                    statusSpan.textContent = 'Error';
+                    statusSpan.className = 'file-status error';
+                }
+            }
+        }
+        
+        // Show the result of one file of a batch
+        async function showFileResult(fileId, entry, result) {
+            const { name, fileContainer, prompt } = entry;
+            const statusSpan = fileContainer.querySelector('.file-status');
+            
+            if (!result.success) {
+                statusSpan.textContent = 'Error';
+                statusSpan.className = 'file-status error';
+                addMessage(`Error processing file ${name}: ${result.error || 'Unknown error'}`, 'error');
+                return;
+            }
+            
+            // Save the summary along with the prompt used
+            await storage.saveSummary(fileId, {
+                text: result.analysis.text,
+                prompt: prompt
+            });
+            
+            // Update the UI
+            const summaryDiv = fileContainer.querySelector('.file-summary');
+            const summaryTextarea = summaryDiv.querySelector('.summary-text');
+            summaryTextarea.textContent = result.analysis.text;
+            
+            summaryDiv.style.display = 'block';
+            statusSpan.textContent = 'Completed';
+            statusSpan.className = 'file-status completed';
+            
+            // Show and enable download button
+            const downloadBtn = fileContainer.querySelector('.download-summary');
+            if (downloadBtn) {
+                downloadBtn.style.display = 'inline-flex';
+                downloadBtn.addEventListener('click', () => {
+                    downloadSummary(fileId, name, result.analysis.text);
+                });
+            }
+            
+            addMessage(`File processed: ${name}`, 'success');
         }
     } catch (error) {
         console.error('Extension initialization error:', error);